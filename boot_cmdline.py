@@ -354,6 +354,21 @@ def _textOption(_match):
 def _mediaCheckOption(_match):
     return [('--mediacheck', None)]
 
+def _mediaCheckFilesOption(_match):
+    return [('--mediacheck', None), ('--mediacheckfiles', None)]
+
+def _mediaCheckStateOption(match):
+    return [('--mediacheckstate', match.group(1))]
+
+def _directReadOption(_match):
+    return [('--directread', None)]
+
+def _packageCacheOption(match):
+    return [('--pkgcache', match.group(1))]
+
+def _packageSeedOption(match):
+    return [('--pkgseed', match.group(1))]
+
 def _askMediaOption(_match):
     return [('--askmedia', None)]
 
@@ -489,7 +504,12 @@ def translateBootCmdLine(cmdline):
         (r'askmedia', _askMediaOption),
         (r'askmethod', _askMediaOption),
         (r'noeject', _noEjectOption),
+        (r'mediacheckfiles', _mediaCheckFilesOption),
         (r'mediacheck', _mediaCheckOption),
+        (r'mediacheckstate=(/.+)', _mediaCheckStateOption),
+        (r'directread', _directReadOption),
+        (r'pkgcache=(/.+)', _packageCacheOption),
+        (r'pkgseed=(/.+)', _packageSeedOption),
         (r'videodriver=(.+)', _setVideoDriver),
         (r'console=ttyS.*', _setSerialTty),
 
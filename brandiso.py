@@ -23,8 +23,10 @@
 
 import os
 import sys
+import Queue
 import getopt
 import struct
+import threading
 try:
     import task_progress
 except ImportError:
@@ -38,6 +40,9 @@ except ImportError:
 class BrandISOException(Exception):
     '''Exception raise by the brandiso module'''
 
+class CheckCancelled(BrandISOException):
+    '''Raised by calc_md5 when its checkpoint has been cancelled'''
+
 VERBOSE = 0
 
 SECTOR_SIZE = 2048
@@ -51,6 +56,17 @@ CHECKSUM_OFFSET = 0
 CHECKSUM_SIZE = 16
 READ_BLOCK_SIZE = 4096
 
+# calc_md5 reads the image on a separate thread, in blocks of this size, so
+# the drive keeps streaming while the previous block is being hashed.  At
+# most READ_AHEAD_BLOCKS blocks are waiting to be hashed at any time.
+READ_AHEAD_BLOCK_SIZE = 1024 * 1024
+READ_AHEAD_BLOCKS = 2
+
+# name of the per-file checksum list, in md5sum(1) format, at the root of
+# the media
+FILE_CHECKSUMS_NAME = 'MD5SUMS'
+FILE_CHECK_THREADS = 4
+
 # Map of byte lengths to struct.pack format letters.
 PACK_FORMAT = {
     1 : "B",
@@ -131,44 +147,233 @@ def fill_fields():
         fields[nm] = (off, sz, tpfn)
         off += sz
 
-# returns md5 hash of a file with a hole,
-# the hole contents is treated as zeros
-def calc_md5(f, zpos, zlen, isosize):
-    from md5 import md5
-
-    f.seek(0, SEEK_END)
-    fileSize = f.tell()
-    task_progress.taskStarted('brandiso.calc_md5', fileSize)
-    m = md5()
-    f.seek(0, SEEK_SET)
-    pos = 0
+# yields the contents of a file in blocks, with the hole replaced by zeros
+def read_blocks(f, zpos, zlen, isosize, blockSize=READ_BLOCK_SIZE, start=0):
+    pos = start
+    if zpos < pos < zpos + zlen:
+        yield '\0' * (zpos + zlen - pos)
+        pos = zpos + zlen
+    f.seek(pos, SEEK_SET)
     while pos < isosize:
         # Read up to the start of the zero-d out spot, skip that and then read
         # through the rest of the file.
         if pos < zpos:
-            blockSize = min(zpos - pos, READ_BLOCK_SIZE)
+            size = min(zpos - pos, blockSize)
         elif pos == zpos:
-            task_progress.taskProgress('brandiso.calc_md5', zlen)
             pos = zpos + zlen
             f.seek(pos, SEEK_SET)
-            m.update('\0' * zlen) # Still need to update the digest with zeroes.
+            yield '\0' * zlen # Still need to update the digest with zeroes.
             continue
         else:
-            blockSize = min(isosize - pos, READ_BLOCK_SIZE)
+            size = min(isosize - pos, blockSize)
 
-        block = f.read(blockSize)
+        block = f.read(size)
         if not block:
             break
 
-        task_progress.taskProgress('brandiso.calc_md5', len(block))
-        m.update(block)
         pos += len(block)
+        yield block
+
+class ReadAhead(object):
+    '''Iterates over the blocks produced by another iterator, which is run
+    on a separate thread so that reading and hashing overlap.'''
+
+    def __init__(self, blocks, depth=READ_AHEAD_BLOCKS):
+        self.queue = Queue.Queue(depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(blocks,),
+                                       name='brandiso-reader')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.isSet():
+            try:
+                self.queue.put(item, True, 0.5)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _run(self, blocks):
+        try:
+            for block in blocks:
+                if not self._put(('block', block)):
+                    return
+            self._put(('done', None))
+        except:
+            self._put(('error', sys.exc_info()))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        kind, value = self.queue.get()
+        if kind == 'block':
+            return value
+        self.stopped.set()
+        if kind == 'error':
+            raise value[0], value[1], value[2]
+        raise StopIteration
+
+    def close(self):
+        # wait for the reader so it is done with the file before the caller
+        # seeks or reads from it again
+        self.stopped.set()
+        self.thread.join()
+
+class Checkpoint(object):
+    '''The state of a partially finished calc_md5.  Passing the same
+    checkpoint to calc_md5 again continues hashing where it stopped, which
+    lets a long check be cancelled, with cancel(), and resumed later.'''
+
+    def __init__(self):
+        self.offset = 0
+        self.digest = None
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+# returns md5 hash of a file with a hole,
+# the hole contents is treated as zeros
+def calc_md5(f, zpos, zlen, isosize=None, readAhead=True, checkpoint=None):
+    from md5 import md5
+
+    f.seek(0, SEEK_END)
+    fileSize = f.tell()
+    if isosize is None:
+        isosize = fileSize
+    task_progress.taskStarted('brandiso.calc_md5', fileSize)
+
+    pos = 0
+    if checkpoint and checkpoint.digest:
+        # hash a copy so the checkpoint is left alone if this run fails
+        pos = checkpoint.offset
+        m = checkpoint.digest.copy()
+        task_progress.taskProgress('brandiso.calc_md5', pos)
+    else:
+        m = md5()
+
+    if readAhead:
+        blocks = ReadAhead(read_blocks(f, zpos, zlen, isosize,
+                                       READ_AHEAD_BLOCK_SIZE, pos))
+    else:
+        blocks = read_blocks(f, zpos, zlen, isosize, start=pos)
+
+    # the progress is reported from this thread since task_progress is not
+    # thread-safe
+    try:
+        for block in blocks:
+            if checkpoint and checkpoint.cancelled:
+                checkpoint.cancelled = False
+                raise CheckCancelled("check cancelled at offset %d" % pos)
+            task_progress.taskProgress('brandiso.calc_md5', len(block))
+            m.update(block)
+            pos += len(block)
+            if checkpoint:
+                checkpoint.offset = pos
+                checkpoint.digest = m
+    finally:
+        if readAhead:
+            blocks.close()
 
     digest = m.digest()
     assert len(digest) == CHECKSUM_SIZE
     task_progress.taskFinish('brandiso.calc_md5')
     
     return digest
+
+# returns the md5 of a regular file as a hex string
+def file_md5(path):
+    from md5 import md5
+
+    m = md5()
+    f = open(path, 'rb')
+    try:
+        while True:
+            block = f.read(READ_AHEAD_BLOCK_SIZE)
+            if not block:
+                break
+            m.update(block)
+    finally:
+        f.close()
+    return m.hexdigest()
+
+# writes an md5sum(1) style list of every file under rootdir, to be put on
+# the media before the image is made
+def write_file_checksums(rootdir, listname=FILE_CHECKSUMS_NAME):
+    out = open(os.path.join(rootdir, listname), 'w')
+    try:
+        for dirpath, _dirnames, filenames in os.walk(rootdir):
+            filenames.sort()
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                relpath = path[len(rootdir):].lstrip(os.sep)
+                if relpath == listname or not os.path.isfile(path):
+                    continue
+                out.write("%s  %s\n" % (file_md5(path), relpath))
+    finally:
+        out.close()
+
+# checks every file in the checksum list under rootdir with a few threads
+# and returns the list of files that are missing or don't match
+def verify_file_checksums(rootdir, listname=FILE_CHECKSUMS_NAME,
+                          numThreads=FILE_CHECK_THREADS):
+    entries = []
+    totalSize = 0
+    for line in open(os.path.join(rootdir, listname)):
+        line = line.rstrip('\n')
+        if not line:
+            continue
+        expected, relpath = line.split(None, 1)
+        relpath = relpath.lstrip('*') # binary mode marker
+        path = os.path.join(rootdir, relpath)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+        entries.append((path, relpath, expected.lower(), size))
+        totalSize += size
+
+    work = Queue.Queue()
+    for entry in entries:
+        work.put(entry)
+    results = Queue.Queue()
+
+    def checker():
+        while True:
+            try:
+                path, relpath, expected, size = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                ok = file_md5(path) == expected
+            except (IOError, OSError):
+                ok = False
+            results.put((relpath, size, ok))
+
+    threads = []
+    for _index in range(min(numThreads, len(entries))):
+        thread = threading.Thread(target=checker, name='brandiso-checker')
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+
+    task_progress.taskStarted('brandiso.calc_md5', totalSize)
+    failures = []
+    for _index in range(len(entries)):
+        relpath, size, ok = results.get()
+        task_progress.taskProgress('brandiso.calc_md5', size)
+        if not ok:
+            failures.append(relpath)
+    task_progress.taskFinish('brandiso.calc_md5')
+
+    for thread in threads:
+        thread.join()
+
+    failures.sort()
+    return failures
     
 
 # prints fields of the primary volume descriptor
@@ -236,8 +441,27 @@ def brand_iso(filename, idstr):
     finally:
         img.close()
 
+# returns the checksum and volume id written into a primary volume
+# descriptor
+def _read_brand(sec):
+    chsum_off, _, _ = fields[CHECKSUM_FIELD]
+    id_off, id_len, _ = fields[ID_FIELD]
+    written_digest = sec[chsum_off + CHECKSUM_OFFSET:
+                             chsum_off + CHECKSUM_OFFSET + CHECKSUM_SIZE]
+    id_str = sec[id_off: id_off + id_len]
+    return written_digest, id_str
+
+# returns the checksum and volume id written into an image, without hashing
+# the image itself
+def read_iso_brand(filename):
+    img = open(filename, 'rb')
+    try:
+        return _read_brand(seek_to_primary(img))
+    finally:
+        img.close()
+
 # verifies an md5 hash of a branded image and prints its sys id
-def extract_iso_checksums(filename):
+def extract_iso_checksums(filename, checkpoint=None):
     img = open(filename, 'rb')
     retval = None
     try:
@@ -245,15 +469,13 @@ def extract_iso_checksums(filename):
 
         sec_off = img.tell()
         chsum_off, _, _ = fields[CHECKSUM_FIELD]
-        id_off, id_len, _ = fields[ID_FIELD]
-        written_digest = sec[chsum_off + CHECKSUM_OFFSET:
-                                 chsum_off + CHECKSUM_OFFSET + CHECKSUM_SIZE]
-        id_str = sec[id_off: id_off + id_len]
+        written_digest, id_str = _read_brand(sec)
 
         # calculating the actual checksum
         digest = calc_md5(img, sec_off + chsum_off + CHECKSUM_OFFSET,
                           CHECKSUM_SIZE,
-                          iso_size(sec))
+                          iso_size(sec),
+                          checkpoint=checkpoint)
 
         retval = (written_digest, digest, id_str)
     finally:
@@ -270,6 +492,14 @@ def verify_iso(filename):
             id_str.strip(), pretty(written_digest), pretty(digest))
         sys.exit(1)
 
+def verify_files(rootdir):
+    failures = verify_file_checksums(rootdir)
+    if failures:
+        for relpath in failures:
+            print "%s: FAILED" % relpath
+        sys.exit(1)
+    print "%s: OK" % rootdir
+
 # prints fields of the primary volume descriptor
 def list_iso(filename):
     img = open(filename, 'rb')
@@ -300,6 +530,11 @@ def usage(argv):
     print "  -c             Check the checksum in a branded ISO image."
     print "  -l             List the fields of the primary volume descriptor."
     print "  -z             Zero out the checksum (for debugging)."
+    print "  -s             Write the %s file for a directory that is going" \
+          % FILE_CHECKSUMS_NAME
+    print "                 to be made into an ISO image."
+    print "  -S             Check the files in a directory (or mounted image)"
+    print "                 against its %s file." % FILE_CHECKSUMS_NAME
     print
     print "Options:"
     print "  -h             Print this help message."
@@ -322,7 +557,7 @@ fill_fields()
 if __name__ == '__main__':
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hvb:clz")
+        opts, args = getopt.getopt(sys.argv[1:], "hvb:clzsS")
 
         if len(args) != 1:
             raise getopt.error("expecting ISO path")
@@ -348,9 +583,14 @@ if __name__ == '__main__':
                 modeFunction = lambda: list_iso(isoPath)
             elif opt == "-z":
                 modeFunction = lambda: zfill_iso(isoPath)
+            elif opt == "-s":
+                modeFunction = lambda: write_file_checksums(isoPath)
+            elif opt == "-S":
+                modeFunction = lambda: verify_files(isoPath)
 
         if not modeFunction:
-            raise getopt.error("expecting mode argument (i.e. -b, -l, -c, -z)")
+            raise getopt.error(
+                "expecting mode argument (i.e. -b, -l, -c, -z, -s, -S)")
 
         modeFunction()
     except IOError, ioe:
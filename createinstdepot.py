@@ -30,6 +30,15 @@
 # directory.  This size is used by the ESX installer to dynamically
 # determine the minimum partition sizes.
 #
+# The same data is written to packageData.dat, which the installer reads in
+# preference to the pickle, along with a digest of every RPM that the
+# installer uses to verify and cache downloads.  See depotindex.py for the
+# format.
+#
+# It also writes packageHeaders.idx, which holds all of the RPM headers in one
+# file so the installer does not have to read a piece of every RPM to build
+# its transaction set.
+#
 # The script will also check to make sure all the dependencies for the RPMs
 # in the depot are satisfied, and that no conflicts are present.
 
@@ -43,6 +52,8 @@ import struct
 import shutil
 import tempfile
 
+import depotindex
+
 SEEK_CUR = 1
 
 FILEOBJ_FILENAME = 0
@@ -53,6 +64,8 @@ BLOCK_SIZE = 4 * 1024
 
 transactionSet = None
 rpmDict = { 'headerSizes': {}, 'fileSizes': {} }
+headerBlobs = {}
+packageDigests = {}
 
 # kludge the space checker by making it require more space to
 # accomodate packages that dynamically eat up extra space
@@ -116,6 +129,9 @@ def processRPMHeaderInfo(fileName):
 
     headerSizes[os.path.basename(fileName)] = (
         header['name'], pkgSize, hdrstart, hdrend)
+    headerBlobs[os.path.basename(fileName)] = header.unload()
+    packageDigests[os.path.basename(fileName)] = \
+        depotindex.fileDigest(fileName)
 
 
 def processFileSize(fileName):
@@ -228,6 +244,12 @@ def main():
         cPickle.dump(rpmDict, pf)
         pf.close()
 
+        depotindex.writePackageData(
+            os.path.join(rpmDir, depotindex.PACKAGE_DATA_NAME),
+            rpmDict['headerSizes'], rpmDict['fileSizes'], packageDigests)
+        depotindex.writeHeaderIndex(
+            os.path.join(rpmDir, depotindex.HEADER_INDEX_NAME), headerBlobs)
+
         unsatisfiedDeps = transactionSet.check()
     finally:
         shutil.rmtree(tmpdir)
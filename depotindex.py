@@ -0,0 +1,362 @@
+
+###############################################################################
+# Copyright (c) 2008-2009 VMware, Inc.
+#
+# This file is part of Weasel.
+#
+# Weasel is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation version 2 and no later version.
+#
+# Weasel is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# version 2 for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin St, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+'''
+depotindex
+
+Readers and writers for the metadata files that createinstdepot.py puts
+next to the RPMs in an installation depot.
+
+The header index (packageHeaders.idx) holds the header of every RPM in the
+depot so the installer can build its transaction set from one sequential
+download instead of fetching a fragment of every package.  The layout is:
+
+    magic       8 bytes, HEADER_INDEX_MAGIC
+    version     uint32
+    count       uint32
+    table       count entries of:
+                    name length   uint16
+                    name          the package basename
+                    offset        uint32, from the start of the data
+                    length        uint32
+    data        the headers, as returned by hdr.unload(), back to back
+
+The package data file (packageData.dat) replaces packageData.pkl.  It holds
+the same two tables, the header sizes keyed by package basename and the
+unpacked directory sizes keyed by path, without having to unpickle data
+that came over the network or load all of it into memory:
+
+    magic       8 bytes, PACKAGE_DATA_MAGIC
+    version     uint32
+    sections    the header sizes section, then the file sizes section and,
+                starting with version 2, the digests section
+
+    section:
+    count       uint32
+    size        uint32, number of bytes of record data
+    offsets     count uint32s, where each record starts in the record data
+    records     key length (uint16), key, then the value
+
+The records in a section are sorted by key so a lookup is a binary search
+through the offsets.  A header sizes value is the package name (uint16
+length, then the name), then the package size (uint64), header start and
+header end (uint32).  A file sizes value is a uint64.  A digest value is
+a string (uint16 length, then the string) of the form "algorithm:hexdigest",
+for example "md5:d41d8cd98f00b204e9800998ecf8427e".
+
+All integers are big-endian.  Readers reject any version they do not know.
+'''
+
+import os
+import struct
+
+HEADER_INDEX_NAME = 'packageHeaders.idx'
+HEADER_INDEX_MAGIC = 'WSLHDRS\n'
+HEADER_INDEX_VERSION = 1
+
+PACKAGE_DATA_NAME = 'packageData.dat'
+PACKAGE_DATA_MAGIC = 'WSLPKGD\n'
+PACKAGE_DATA_VERSION = 2
+PACKAGE_DATA_VERSIONS_SUPPORTED = (1, 2)
+
+# The installer runs on python 2.4, which has no hashlib, so MD5 is the only
+# digest it can always check.
+DEFAULT_DIGEST_ALGORITHM = 'md5'
+
+class DepotIndexError(Exception): pass
+
+def _readExactly(fileObj, amount):
+    data = fileObj.read(amount)
+    if len(data) != amount:
+        raise DepotIndexError('unexpected end of file in %s' % fileObj.name)
+    return data
+
+def _unpack(fileObj, fmt):
+    return struct.unpack(fmt, _readExactly(fileObj, struct.calcsize(fmt)))
+
+def _packString(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return struct.pack('>H', len(value)) + value
+
+def _readString(fileObj):
+    (length,) = _unpack(fileObj, '>H')
+    return _readExactly(fileObj, length)
+
+
+def writeHeaderIndex(path, headerBlobs):
+    '''Write the header index to path.  headerBlobs is a dictionary that maps
+    package basenames to unloaded headers.'''
+    names = headerBlobs.keys()
+    names.sort()
+
+    table = []
+    offset = 0
+    for name in names:
+        length = len(headerBlobs[name])
+        table.append(struct.pack('>H', len(name)) + name +
+                     struct.pack('>II', offset, length))
+        offset += length
+
+    out = open(path, 'wb')
+    try:
+        out.write(HEADER_INDEX_MAGIC)
+        out.write(struct.pack('>II', HEADER_INDEX_VERSION, len(names)))
+        out.write(''.join(table))
+        for name in names:
+            out.write(headerBlobs[name])
+    finally:
+        out.close()
+
+
+class HeaderIndex(object):
+    '''Read-only access to a header index file.  Only the offset table is
+    kept in memory, the headers themselves are read as they are asked for.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._table = {}
+        self._file = open(path, 'rb')
+        try:
+            self._readTable()
+        except (DepotIndexError, struct.error):
+            self._file.close()
+            raise
+
+    def _readTable(self):
+        magic = self._file.read(len(HEADER_INDEX_MAGIC))
+        if magic != HEADER_INDEX_MAGIC:
+            raise DepotIndexError('%s is not a header index' % self.path)
+        version, count = _unpack(self._file, '>II')
+        if version != HEADER_INDEX_VERSION:
+            raise DepotIndexError('%s has unsupported version %d' %
+                                  (self.path, version))
+        for _index in range(count):
+            (nameLength,) = _unpack(self._file, '>H')
+            name = _readExactly(self._file, nameLength)
+            self._table[name] = _unpack(self._file, '>II')
+        self._dataStart = self._file.tell()
+
+    def __contains__(self, name):
+        return name in self._table
+
+    def __len__(self):
+        return len(self._table)
+
+    def read(self, name):
+        '''Return the unloaded header for the given package basename or None
+        if it is not in the index.'''
+        if name not in self._table:
+            return None
+        offset, length = self._table[name]
+        self._file.seek(self._dataStart + offset)
+        return _readExactly(self._file, length)
+
+    def close(self):
+        self._file.close()
+
+
+def newHasher(algorithm):
+    '''Return a new hash object for the named algorithm, or None if this
+    python does not have it.'''
+    try:
+        import hashlib
+    except ImportError:
+        if algorithm == 'md5':
+            import md5
+            return md5.new()
+        return None
+    try:
+        return hashlib.new(algorithm)
+    except ValueError:
+        return None
+
+def fileDigest(path, algorithm=DEFAULT_DIGEST_ALGORITHM):
+    '''Return the "algorithm:hexdigest" string for a file.'''
+    hasher = newHasher(algorithm)
+    fileObj = open(path, 'rb')
+    try:
+        while True:
+            data = fileObj.read(1024 * 1024)
+            if not data:
+                break
+            hasher.update(data)
+    finally:
+        fileObj.close()
+    return '%s:%s' % (algorithm, hasher.hexdigest())
+
+def _packHeaderSizes(value):
+    name, pkgSize, hdrStart, hdrEnd = value
+    return _packString(name) + struct.pack('>QII', pkgSize, hdrStart, hdrEnd)
+
+def _unpackHeaderSizes(fileObj):
+    name = _readString(fileObj)
+    return (name,) + _unpack(fileObj, '>QII')
+
+def _packFileSize(value):
+    return struct.pack('>Q', value)
+
+def _unpackFileSize(fileObj):
+    return _unpack(fileObj, '>Q')[0]
+
+def _unpackDigest(fileObj):
+    return _readString(fileObj)
+
+def _writeSection(out, mapping, packValue):
+    keys = mapping.keys()
+    keys.sort()
+
+    offsets = []
+    records = []
+    size = 0
+    for key in keys:
+        record = _packString(key) + packValue(mapping[key])
+        offsets.append(size)
+        records.append(record)
+        size += len(record)
+
+    out.write(struct.pack('>II', len(keys), size))
+    out.write(struct.pack('>%dI' % len(offsets), *offsets))
+    out.write(''.join(records))
+
+def writePackageData(path, headerSizes, fileSizes, digests=None):
+    '''Write the package data file to path.  headerSizes and fileSizes are
+    the same dictionaries that go into packageData.pkl, digests maps package
+    basenames to "algorithm:hexdigest" strings.'''
+    if digests is None:
+        digests = {}
+    out = open(path, 'wb')
+    try:
+        out.write(PACKAGE_DATA_MAGIC)
+        out.write(struct.pack('>I', PACKAGE_DATA_VERSION))
+        _writeSection(out, headerSizes, _packHeaderSizes)
+        _writeSection(out, fileSizes, _packFileSize)
+        _writeSection(out, digests, _packString)
+    finally:
+        out.close()
+
+
+class _Section(object):
+    '''A read-only, dictionary-like view of one section of a package data
+    file.  Nothing is cached, every lookup goes to the file.'''
+    def __init__(self, fileObj, unpackValue):
+        self._file = fileObj
+        self._unpackValue = unpackValue
+        self._count, size = _unpack(fileObj, '>II')
+        self._offsetsStart = fileObj.tell()
+        self._recordsStart = self._offsetsStart + 4 * self._count
+        self.end = self._recordsStart + size
+        fileObj.seek(self.end)
+
+    def _keyAt(self, index):
+        self._file.seek(self._offsetsStart + 4 * index)
+        (offset,) = _unpack(self._file, '>I')
+        self._file.seek(self._recordsStart + offset)
+        return _readString(self._file)
+
+    def get(self, key, default=None):
+        low = 0
+        high = self._count
+        while low < high:
+            middle = (low + high) / 2
+            middleKey = self._keyAt(middle)
+            if middleKey == key:
+                return self._unpackValue(self._file)
+            elif middleKey < key:
+                low = middle + 1
+            else:
+                high = middle
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return self._count
+
+    def iteritems(self):
+        '''Read the records in order, one at a time.'''
+        position = self._recordsStart
+        for _index in range(self._count):
+            # other lookups may move the file position between records
+            self._file.seek(position)
+            key = _readString(self._file)
+            value = self._unpackValue(self._file)
+            position = self._file.tell()
+            yield key, value
+
+    def iterkeys(self):
+        for key, _value in self.iteritems():
+            yield key
+    __iter__ = iterkeys
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def items(self):
+        return list(self.iteritems())
+
+
+class PackageDataFile(object):
+    '''Read-only access to a package data file.
+    Accessible attributes:
+        .headerSizes : package basename -> (name, size, header start, end)
+        .fileSizes   : directory -> size of the files it will hold
+        .digests     : package basename -> "algorithm:hexdigest"
+    Both behave like read-only dictionaries.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._readSections()
+        except (DepotIndexError, struct.error):
+            self._file.close()
+            raise
+
+    def _readSections(self):
+        magic = self._file.read(len(PACKAGE_DATA_MAGIC))
+        if magic != PACKAGE_DATA_MAGIC:
+            raise DepotIndexError('%s is not a package data file' % self.path)
+        (version,) = _unpack(self._file, '>I')
+        if version not in PACKAGE_DATA_VERSIONS_SUPPORTED:
+            raise DepotIndexError('%s has unsupported version %d' %
+                                  (self.path, version))
+        self.headerSizes = _Section(self._file, _unpackHeaderSizes)
+        self.fileSizes = _Section(self._file, _unpackFileSize)
+        end = self.fileSizes.end
+        if version >= 2:
+            self.digests = _Section(self._file, _unpackDigest)
+            end = self.digests.end
+        else:
+            self.digests = {}
+
+        # The lookups are lazy, so catch a short download up front.
+        if os.fstat(self._file.fileno()).st_size != end:
+            raise DepotIndexError('%s is the wrong size' % self.path)
+
+    def close(self):
+        self._file.close()
@@ -19,6 +19,7 @@
 #
 
 import os
+import re
 import operator
 import parted
 import partition
@@ -29,9 +30,10 @@ import userchoices
 import datastore
 import time
 import fsset
-import glob
 import esxconf
 import shutil
+import workerpool
+import task_progress
 
 from exception import InstallationError
 from singleton import Singleton
@@ -40,9 +42,20 @@ from log import log
 from precheck import VMDK_OVERHEAD_SIZE
 
 VMKCTL_SCSI_DISK = 0
+LUN_PROBE_WORKERS = 8
 DEFAULT_COS_IMAGE = 'esxconsole.vmdk'
 
-TMP_MOUNT_PATH = '/mnt/testdir'
+# The vmkfstools provisioning policies for the COS vmdk.  Thin disks are
+# quick to create, eager-zeroed ones don't pay for zeroing blocks on first
+# write later on but take a long time to create, so they are only used when
+# asked for.
+VMDK_DISK_TYPES = ('thin', 'zeroedthick', 'eagerzeroedthick')
+VMDK_LOCAL_DISK_TYPE = 'zeroedthick'
+VMDK_SHARED_DISK_TYPE = 'thin'
+
+# Where the kernel publishes the I/O limits of block devices.  Older kernels
+# don't have the queue limits, in which case the sector size is used.
+SYSFS_BLOCK_PATH = '/sys/block'
 
 PATHID_ADAPTER_NAME = 0
 PATHID_CHANNEL = 1
@@ -54,7 +67,43 @@ class InvalidDriveOrder(Exception):
     with the --driveorder flag that doesn't exist (physically)
     '''
 
-class DiskDev:
+def readLabelSector(path, size=512):
+    '''Return the first sector of a disk, where its partition table is.'''
+    dev = open(path, 'rb')
+    try:
+        return dev.read(size)
+    finally:
+        dev.close()
+
+def prefetchLabelSector(path):
+    '''Return the label sector of a disk, or None if it can't be read.  It
+    ends up in the buffer cache, where libparted finds it when the partition
+    table is parsed.  Only the device node is read, so this is safe to run in
+    a worker thread.'''
+    try:
+        return readLabelSector(path)
+    except (IOError, OSError), e:
+        log.debug("could not read the label of %s -- %s" % (path, str(e)))
+        return None
+
+def readLunIdentity(consoleDevicePath):
+    '''Return the size in bytes and the label sector of a device, or None if
+    it can't be read.  The label is always read from the device, so changes
+    made behind our back, by a %pre script for example, are noticed.  Only
+    the device node is read, so this is safe to run in a worker thread.'''
+    try:
+        dev = open(consoleDevicePath, 'rb')
+        try:
+            dev.seek(0, 2)
+            size = dev.tell()
+        finally:
+            dev.close()
+        return (size, readLabelSector(consoleDevicePath))
+    except (IOError, OSError), e:
+        log.debug("could not read %s -- %s" % (consoleDevicePath, str(e)))
+        return None
+
+class DiskDev(object):
     # Name of the driver for USB storage.
     DRIVER_USB_STORAGE = "usb-storage"
     
@@ -77,7 +126,9 @@ class DiskDev:
            sizeUnit             - KB or MB for kilobytes or megabytes
            deviceExists         - used for virtual devices to not probe
                                   the partition table
-           probePartitions      - boolean value to search for partitions
+           probePartitions      - boolean value to search for partitions,
+                                  the partition table is read the first
+                                  time the partitions are used
            driverName           - name of the driver associated with the
                                   device
            pathIds              -
@@ -114,16 +165,16 @@ class DiskDev:
         # Determines whether we'll be able to install to this disk.
         self.supportsVmfs = supportsVmfs
 
-        self.partitions = None
+        self._partitions = None
+        self._partitionsPending = probePartitions
+        self._labelSector = None
+        self._ioLimits = None
         self.requests = None
 
         # Stable refers to whether or not the device object can change out
         # from under us.
         self.stable = False
 
-        if probePartitions:
-            self.probePartitions()
-
     def __str__(self):
         return "%s (console %s) -- %s (%d MB, %s)" % (
             self.name,
@@ -149,12 +200,76 @@ class DiskDev:
     def getFormattedSize(self):
         return util.formatValue(self.getSizeInKilobytes())
 
-    def probePartitions(self):
+    def _getPartitions(self):
+        if self._partitionsPending:
+            self.probePartitions()
+        return self._partitions
+
+    def _setPartitions(self, partitions):
+        self._partitionsPending = False
+        self._partitions = partitions
+
+    partitions = property(_getPartitions, _setPartitions)
+
+    def _readPartitions(self):
         # XXX - we should probably raise an exception here
         if not self.deviceExists:
             log.error("Device was probed but doesn't exist yet!")
-        else:
-            self.partitions = partition.PartitionSet(device=self, scan=True)
+            return None
+        return partition.PartitionSet(device=self, scan=True)
+
+    def probePartitions(self):
+        self._partitionsPending = False
+        self.partitions = self._readPartitions()
+
+    def getLabelSector(self):
+        '''Return the first 512 bytes of the disk, where the msdos label is.
+        They are read once and kept until labelWritten() is called.'''
+        if self._labelSector is None:
+            self._labelSector = readLabelSector(self.consoleDevicePath)
+        return self._labelSector
+
+    def _readSysfsValue(self, name):
+        if not self.consoleDevicePath or \
+                not self.consoleDevicePath.startswith('/dev/'):
+            return None
+
+        # sysfs uses '!' in place of the '/' in names like cciss/c0d0
+        blockName = self.consoleDevicePath[len('/dev/'):].replace('/', '!')
+        try:
+            sysfsFile = open(os.path.join(SYSFS_BLOCK_PATH, blockName,
+                                          'queue', name))
+            try:
+                return int(sysfsFile.read().strip())
+            finally:
+                sysfsFile.close()
+        except (IOError, ValueError):
+            return None
+
+    def getIOLimits(self):
+        '''Return a dictionary with the physicalBlockSize, minimumIOSize,
+        optimalIOSize and alignmentOffset of the disk, in bytes.  Values the
+        kernel doesn't report are filled in with the sector size, or zero
+        for the optimalIOSize and alignmentOffset.'''
+        if self._ioLimits is None:
+            physicalBlockSize = self._readSysfsValue('physical_block_size')
+            minimumIOSize = self._readSysfsValue('minimum_io_size')
+            optimalIOSize = self._readSysfsValue('optimal_io_size')
+            alignmentOffset = self._readSysfsValue('alignment_offset')
+
+            self._ioLimits = {
+                'physicalBlockSize' : physicalBlockSize or self.sectorSize,
+                'minimumIOSize' : minimumIOSize or self.sectorSize,
+                'optimalIOSize' : optimalIOSize or 0,
+                'alignmentOffset' : alignmentOffset or 0,
+                }
+            log.debug("I/O limits for %s -- %s" % (self.name, self._ioLimits))
+        return self._ioLimits
+
+    def labelWritten(self):
+        '''Called after the partition table has been written to the disk.'''
+        self._labelSector = None
+        invalidateDisk(self.name)
 
     def getPartitionDevicePath(self, partitionNumber):
         '''Return the '/vmfs/devices' path for a given partition number.
@@ -246,7 +361,7 @@ class VirtualDiskDev(DiskDev):
 
     def __init__(self, name, size=5500, imagePath='',
                  imageName='', physicalDeviceName=None,
-                 vmfsVolume=None):
+                 vmfsVolume=None, diskType=None):
 
         # XXX isinstance(str) is not py3k compliant.
         assert physicalDeviceName is None or isinstance(physicalDeviceName, str)
@@ -262,6 +377,9 @@ class VirtualDiskDev(DiskDev):
         self.physicalDeviceName = physicalDeviceName
         self.vmfsVolume = vmfsVolume
 
+        assert diskType is None or diskType in VMDK_DISK_TYPES
+        self.diskType = diskType
+
         self.stable = True
 
         if not self.imagePath:
@@ -290,13 +408,26 @@ class VirtualDiskDev(DiskDev):
         if not os.path.exists(path):
             os.makedirs(path)
 
+        diskType = self.getDiskType()
+        log.info("creating %s virtualdisk %s" % (diskType, fullPath))
+
         args = [ "/usr/sbin/vmkfstools", "-c", "%dM" % (self.size,),
-                 fullPath ]
+                 "-d", diskType, fullPath ]
+
+        # Only eager-zeroing takes long enough to be worth showing progress.
+        progress = None
+        if diskType == 'eagerzeroedthick':
+            progress = VmkfstoolsProgress('vmdk.create')
 
         try:
-            util.execWithLog(args[0], args, raiseException=True)
-        except Exception, e:
-            raise InstallationError("Could not create new COS vmdk.", e)
+            try:
+                util.execWithLog(args[0], args, raiseException=True,
+                                 outputCallback=progress)
+            except Exception, e:
+                raise InstallationError("Could not create new COS vmdk.", e)
+        finally:
+            if progress:
+                progress.finish()
 
         '''
         Add a disk database entry that will allow upper layers to know this
@@ -309,6 +440,20 @@ class VirtualDiskDev(DiskDev):
         except Exception, e:
             raise InstallationError("Could not bless COS vmdk.", e)
 
+    def getDiskType(self):
+        '''Return the vmkfstools disk type to create the vmdk with.  If it was
+        not chosen for this disk, the COS disk is thin on shared storage and
+        zeroedthick on local storage.'''
+        if self.diskType:
+            return self.diskType
+
+        disk = None
+        if self.physicalDeviceName:
+            disk = DiskSet().findDisk(self.physicalDeviceName)
+        if disk and disk.local:
+            return VMDK_LOCAL_DISK_TYPE
+        return VMDK_SHARED_DISK_TYPE
+
     def mount(self):
         path = os.path.join("/vmfs/volumes", self.vmfsVolume, self.imagePath,
                             self.imageName)
@@ -345,6 +490,27 @@ class VirtualDiskDev(DiskDev):
     def getFormattedSize(self):
         raise NotImplementedError, "getFormattedSize() not implemented."
 
+class VmkfstoolsProgress:
+    '''Output callback for vmkfstools that turns the "Create: 42% done."
+    lines it prints while zeroing into task_progress updates.'''
+
+    def __init__(self, taskTitle):
+        self.taskTitle = taskTitle
+        self.percent = 0
+        task_progress.taskStarted(self.taskTitle, 100)
+
+    def __call__(self, output):
+        for match in re.findall(r'(\d+)% done', output):
+            percent = min(int(match), 100)
+            if percent > self.percent:
+                task_progress.taskProgress(self.taskTitle,
+                                           percent - self.percent)
+                self.percent = percent
+
+    def finish(self):
+        task_progress.taskFinish(self.taskTitle)
+
+
 def removeVmdkFile(vmdkPath):
     if os.path.exists(vmdkPath):
         # remove the vmdk file with vmkfstools first and then attempt
@@ -359,6 +525,13 @@ def removeVmdkFile(vmdkPath):
         log.debug("Removing %s" % vmdkPath)
         shutil.rmtree(os.path.dirname(vmdkPath))
 
+def invalidateDisk(diskName=None):
+    '''Forget the cached probe results for the given disk, or all disks,
+    without probing them if the DiskSet hasn't been created yet.'''
+    diskSet = DiskSet.__dict__.get('_the_only_instance')
+    if diskSet:
+        diskSet.invalidate(diskName)
+
 class DiskSet(Singleton):
     ''' An iterable data structure that represents all the disks on
     the system.
@@ -368,10 +541,33 @@ class DiskSet(Singleton):
     cause the disk list to lose all information about the disks that has
     been contributed by client code.  Particularly 
     PartitionRequestSet.fitPartitionsOnDevice.
+
+    A reprobe only reads the luns that have changed since the last probe,
+    the DiskDevs for the others are reused.  Code that changes a DiskDev
+    without writing the change to the disk should call invalidateDisk() so
+    the change is thrown away on the next reprobe.
     '''
     def _singleton_init(self, forceReprobe=False):
         self.disks = {}
 
+        # The DiskDevs from the last probe and the generation of the lun they
+        # were made from, keyed by lun name.  A reprobe reuses the DiskDev if
+        # the generation has not changed.
+        self.inventory = {}
+
+        # Every name a disk goes by, mapped to its DiskDev.  See
+        # _getDiskAliases() for the kinds of names.
+        self.aliases = {}
+
+        # The partitions on each disk, keyed by console device path.  They
+        # are indexed the first time they are looked up and again whenever
+        # the partition table changes.
+        self.partitionIndex = {}
+
+        # Partition UUIDs that have been looked up and the partition console
+        # path they were found on.
+        self.uuidAliases = {}
+
         # XXX temporary workaround for unsupported ide disks, remove later
         self.nonStandardDisks = []
 
@@ -407,16 +603,120 @@ class DiskSet(Singleton):
     def _attachMountPoint(self, uuid, mountPoint):
         '''Find the partition matching the given UUID and set its mountPoint
         field to the given value.'''
-        partitionPath = util.uuidToDevicePath(uuid)
-        devicePath, _partNum = partition.splitPath(partitionPath)
-        device = self.getDiskByPath(devicePath)
-        if device:
-            for part in device.partitions:
-                if part.consoleDevicePath == partitionPath:
-                    part.mountPoint = mountPoint
+        diskPartTuple = self.findPartitionByUuid(uuid)
+        if diskPartTuple:
+            _disk, part = diskPartTuple
+            part.mountPoint = mountPoint
         else:
             log.error("could not find partition with UUID (%s) for "
                       "mount point -- %s" % (uuid, mountPoint))
+
+    def _getDiskAliases(self, disk):
+        '''Return the names a disk can be referred to by: the vml name, the
+        devfs path, the console path with and without /dev and the
+        vmhbaA:C:T:L name of each path to the disk.'''
+        retval = [disk.name]
+        if disk.path:
+            retval.append(disk.path)
+        if disk.consoleDevicePath:
+            retval.append(disk.consoleDevicePath)
+            m = re.match(r'/dev/(.+)', disk.consoleDevicePath)
+            if m:
+                retval.append(m.group(1))
+        if disk.vmkLun:
+            try:
+                for vmkctlPath in disk.vmkLun.GetPaths() or []:
+                    retval.append("%s:%s:%s:%s" % (
+                        vmkctlPath.GetAdapterName(),
+                        vmkctlPath.GetChannelNumber(),
+                        vmkctlPath.GetTargetNumber(),
+                        vmkctlPath.GetLun()))
+            except vmkctl.HostCtlException, ex:
+                log.debug("could not get paths for %s -- %s" %
+                          (disk.name, str(ex.GetMessage())))
+        return retval
+
+    def _indexDisks(self):
+        self.aliases = {}
+        self.partitionIndex = {}
+        self.uuidAliases = {}
+        for disk in self.values():
+            for alias in self._getDiskAliases(disk):
+                # The first disk in the sorted order wins if two disks
+                # somehow have the same alias.
+                self.aliases.setdefault(alias, disk)
+
+    def _getPartitionIndex(self, disk):
+        '''Return a dictionary of the partitions on a disk keyed by their
+        console device paths.'''
+        partitions = disk.partitions
+        if partitions is None:
+            return {}
+
+        # The PartitionSet replaces its list of partitions when it is
+        # rescanned or cleared, so this notices any changes to the table.
+        cached = self.partitionIndex.get(disk.name)
+        if cached and cached[0] is partitions and \
+                cached[1] is partitions.partitions and \
+                cached[2] == len(partitions.partitions):
+            return cached[3]
+
+        index = {}
+        for part in partitions:
+            if part.consoleDevicePath:
+                index[part.consoleDevicePath] = part
+        self.partitionIndex[disk.name] = (partitions,
+                                          partitions.partitions,
+                                          len(partitions.partitions),
+                                          index)
+        return index
+
+    def findDisk(self, alias):
+        '''Find a disk by any of its names, for example, its vml name,
+        "sda", "/dev/sda" or "vmhba0:0:0:0".  Returns None if there is no
+        such disk.'''
+        return self.aliases.get(alias)
+
+    def getDiskAliases(self):
+        '''Return a dictionary that maps every name a disk goes by to the
+        disk's canonical name.'''
+        retval = {}
+        for alias, disk in self.aliases.items():
+            retval[alias] = disk.name
+        return retval
+
+    def findPartition(self, path):
+        '''Find a partition by its console device path, with or without the
+        /dev prefix.  Returns a (disk, partition) tuple or None.'''
+        if not path.startswith('/dev/'):
+            path = os.path.join('/dev', path)
+        if not re.match(r'/dev/.*\d$', path):
+            return None
+
+        devicePath, _partNum = partition.splitPath(path)
+        disk = self.getDiskByPath(devicePath)
+        if not disk:
+            return None
+
+        part = self._getPartitionIndex(disk).get(path)
+        if not part:
+            return None
+        return (disk, part)
+
+    def findPartitionByUuid(self, uuid):
+        '''Find the partition with the given file system UUID.  Returns a
+        (disk, partition) tuple or None.'''
+        if uuid in self.uuidAliases:
+            retval = self.findPartition(self.uuidAliases[uuid])
+            if retval:
+                return retval
+
+        partitionPath = util.uuidToDevicePath(uuid)
+        if not partitionPath:
+            return None
+
+        self.uuidAliases[uuid] = partitionPath
+        return self.findPartition(partitionPath)
     
     def _attachUpgradableMounts(self):
         '''Fill out the mountPoint fields for the partitions from the previous
@@ -435,6 +735,196 @@ class DiskSet(Singleton):
         return adapter.GetInterfaceType() not in [
             vmkctl.ScsiInterface.SCSI_IFACE_TYPE_USB]
     
+    def _getConsoleDevicePath(self, entry):
+        '''Return a (consoleDevicePath, warning) pair for a vmkctl lun.  The
+        path is None and warning says why if the lun is not a disk that can
+        be installed on.  The warning is logged by the caller so the skipped
+        luns are reported in the same order as the luns that fail later.'''
+        path = entry.GetDevfsPath()
+
+        log.debug(" lun -- %s" % entry.GetName())
+
+        # skip anything which isn't a disk
+        # XXX - replace this with the correct constant from vmkctl
+        #       if vmkctlpy gets fixed
+        if entry.GetLunType() != VMKCTL_SCSI_DISK:
+            return None, "Lun at %s is not a proper disk. Skipping lun." % path
+
+        if entry.IsPseudoLun():
+            return None, "Lun at %s is a pseudo lun.  Skipping lun." % path
+
+        # XXX - Console Device paths are broken for some USB devices.
+        try:
+            consoleDevicePath = entry.GetConsoleDevice()
+        except vmkctl.HostCtlException, msg:
+            return None, "No Console Path for %s.  Skipping lun." % path
+
+        if not consoleDevicePath.startswith("/dev"):
+            return None, "Got bogus console path for %s.  Skipping lun" % path
+
+        # XXX - check to see if the disk has been initialized
+        # we should probably be prompting the user to initialize it 
+        if consoleDevicePath:
+            log.debug("  Trying %s" % (consoleDevicePath))
+        else:
+            # XXX work around bug 173969 in vmklinux26 that causes
+            # broken luns to be reported
+            return None, "No Console Path for %s.  Skipping lun." % path
+
+        return consoleDevicePath, None
+
+    def _settleDeviceNodes(self, consoleDevicePaths):
+        '''Make sure the console device nodes exist before probing.'''
+
+        # XXX If the mkblkdevs happened in the middle of a scan some of
+        # the devices will have been missed so we double check here and
+        # run the mkblkdevs on-demand.  This is done once for all of the
+        # luns, instead of waiting for each missing device in turn.
+        for attempt in range(0, 3):
+            missing = [path for path in consoleDevicePaths
+                       if not os.path.exists(path)]
+            if not missing:
+                return
+
+            log.debug("console devices, %s, do not exist.  trying "
+                      "mkblkdevs again (attempt %d)" %
+                      (", ".join(missing), attempt + 1))
+            time.sleep(3) # wait for things to settle
+            partition.createDeviceNodes()
+
+    def _getLunPathIds(self, entry):
+        '''Return the adapter/channel/target/lun of each path to a lun, or
+        None if vmkctl could not list them.'''
+        try:
+            pathIds = []
+            for vmkctlPath in entry.GetPaths() or []:
+                pathIds.append((vmkctlPath.GetAdapterName(),
+                                vmkctlPath.GetChannelNumber(),
+                                vmkctlPath.GetTargetNumber(),
+                                vmkctlPath.GetLun()))
+        except vmkctl.HostCtlException, ex:
+            log.debug("could not get paths for %s -- %s" %
+                      (entry.GetName(), str(ex.GetMessage())))
+            return None
+
+        return pathIds
+
+    def _getLunGeneration(self, consoleDevicePath, lunPathIds, identity):
+        '''Return a value that changes when the lun is resized, its paths
+        change or its partition table is rewritten, or None if that can't be
+        determined.'''
+        from md5 import md5
+
+        if lunPathIds is None or identity is None:
+            return None
+
+        size, labelSector = identity
+        return (consoleDevicePath, size, tuple(lunPathIds),
+                md5(labelSector).hexdigest())
+
+    def invalidate(self, diskName=None):
+        '''Forget what is known about the given disk, or all disks, so the
+        next reprobe reads it again.  Call this after changing a disk in a way
+        the generation check would not notice, like editing the in-memory
+        partition table.'''
+        if diskName is None:
+            self.inventory = {}
+        elif diskName in self.inventory:
+            del self.inventory[diskName]
+
+    def _probeLun(self, entry, consoleDevicePath):
+        '''Open a lun and return the DiskDev for it, or None if it can't be
+        used.'''
+        path = entry.GetDevfsPath()
+
+        if not os.path.exists(consoleDevicePath):
+            log.warn("console device is missing -- %s" % consoleDevicePath)
+            return None
+
+        # XXX - this needs to be wrapped in a try/except
+        # and display a proper warning if the device can't be
+        # accessed
+        try:
+            partedDev = parted.PedDevice.get(consoleDevicePath)
+        except parted.error, msg:
+            log.warn("Parted couldn't open device %s.  Skipping lun." %
+                     (consoleDevicePath))
+            return None
+
+        driverName = None
+        supportsVmfs = False
+
+        # Set a default path with a large value so it's at the end of
+        # the sorted list.
+        pathIds = [ 'z' * 5 ]
+
+        paths = entry.GetPaths()
+        pathStrings = []
+        if paths:
+            for vmkctlPath in paths:
+                try:
+                    transportMap = vmkctlPath.GetTransportMapping()
+                    if transportMap:
+                        targetString = transportMap.GetTargetString()
+                        log.info("Target String: " + targetString)
+                        if targetString not in pathStrings:
+                            pathStrings.append(targetString)
+                except vmkctl.HostCtlException, ex:
+                    log.warn("Could not get transport mapping -- %s " %
+                             str(ex.GetMessage()))
+
+            try:
+                adapter = paths[0].GetAdapter()
+                driverName = adapter.GetDriver()
+                pathIds = [
+                    util.splitInts(paths[0].GetAdapterName()),
+                    paths[0].GetChannelNumber(),
+                    paths[0].GetTargetNumber(),
+                    paths[0].GetLun()]
+
+                supportsVmfs = self._adapterSupportsVmfs(adapter)
+            except vmkctl.HostCtlException, ex:
+                ## Should be a problem only until iSCSI driver situation is stabilized.
+                log.warn("Could not get driver for path %s -- %s" %
+                         (consoleDevicePath, str(ex.GetMessage())))
+        else:
+            log.warn("Could not get driver name for %s" % consoleDevicePath)
+
+        return DiskDev(name=entry.GetName(), device=partedDev,
+            path=path, consoleDevicePath=consoleDevicePath,
+            model=entry.GetModel(), vendor=entry.GetVendor(),
+            size=partedDev.length, sectorSize=partedDev.sector_size,
+            driverName=driverName, pathIds=pathIds,
+            pathStrings=pathStrings, vmkLun=entry,
+            supportsVmfs=supportsVmfs, local=entry.IsLocal())
+
+    def scanPartitions(self, disks=None):
+        '''Read the partition tables of the given disks, or all of the disks,
+        that have not been read yet.
+
+        The label sectors are read in parallel first, which gets the seek on
+        every spindle out of the way at once.  libparted is not safe to call
+        from more than one thread, so the tables are then parsed here, one
+        disk at a time.'''
+        if disks is None:
+            disks = self.values()
+        pending = [disk for disk in disks if disk._partitionsPending]
+        if not pending:
+            return
+
+        log.debug("scanning partitions on %d disks" % len(pending))
+        unread = [disk for disk in pending
+                  if disk.deviceExists and disk.consoleDevicePath and
+                  disk._labelSector is None]
+        labels = workerpool.parallelMap(
+            prefetchLabelSector,
+            [disk.consoleDevicePath for disk in unread],
+            LUN_PROBE_WORKERS, 'partscan')
+        for disk, labelSector in zip(unread, labels):
+            disk._labelSector = labelSector
+        for disk in pending:
+            disk.probePartitions()
+
     def probeDisks(self, diskList=None):
         self.disks = {} # Need to reset in case of a reprobe.
 
@@ -452,126 +942,60 @@ class DiskSet(Singleton):
             storage = vmkctl.StorageInfoImpl()
             luns = storage.GetDiskLuns()
 
+            checked = []
+            candidates = []
             for entry in luns:
-                path = entry.GetDevfsPath()
-
-                log.debug(" lun -- %s" % entry.GetName())
-
-                # skip anything which isn't a disk
-                # XXX - replace this with the correct constant from vmkctl
-                #       if vmkctlpy gets fixed
-                if entry.GetLunType() != VMKCTL_SCSI_DISK:
-                    log.warn("Lun at %s is not a proper disk. Skipping lun." %
-                             (path))
-                    continue
-
-                if entry.IsPseudoLun():
-                    log.warn("Lun at %s is a pseudo lun.  Skipping lun." %
-                             (path))
-                    continue
-
-                # XXX - Console Device paths are broken for some USB devices.
-                try:
-                    consoleDevicePath = entry.GetConsoleDevice()
-                except vmkctl.HostCtlException, msg:
-                    log.warn("No Console Path for %s.  Skipping lun." % (path))
-                    continue
-
-                if not consoleDevicePath.startswith("/dev"):
-                    log.warn("Got bogus console path for %s.  Skipping lun" % 
-                             (path))
-                    continue
-
-                # XXX - check to see if the disk has been initialized
-                # we should probably be prompting the user to initialize it 
+                consoleDevicePath, warning = self._getConsoleDevicePath(entry)
+                checked.append((entry, consoleDevicePath, warning))
                 if consoleDevicePath:
-                    log.debug("  Trying %s" % (consoleDevicePath))
-                else:
-                    # XXX work around bug 173969 in vmklinux26 that causes
-                    # broken luns to be reported
-                    log.warn("No Console Path for %s.  Skipping lun." % (path))
-                    continue
-
-                # XXX If the mkblkdevs happened in the middle of a scan some of
-                # the devices will have been missed so we double check here and
-                # run the mkblkdevs on-demand.
-                for attempt in range(0, 3):
-                    if os.path.exists(consoleDevicePath):
-                        break
-
-                    log.debug("console device, '%s', does not exist.  trying "
-                              "mkblkdevs again (attempt %d)" %
-                              (consoleDevicePath, attempt + 1))
-                    time.sleep(3) # wait for things to settle
-                    partition.createDeviceNodes()
-
-                if not os.path.exists(consoleDevicePath):
-                    log.warn("console device is missing -- %s" %
-                             consoleDevicePath)
-                    continue
-                
-                # XXX - this needs to be wrapped in a try/except
-                # and display a proper warning if the device can't be
-                # accessed
-                try:
-                    partedDev = parted.PedDevice.get(consoleDevicePath)
-                except parted.error, msg:
-                    log.warn("Parted couldn't open device %s.  Skipping lun." %
-                             (consoleDevicePath))
+                    candidates.append((entry, consoleDevicePath))
+
+            self._settleDeviceNodes(
+                [consoleDevicePath for _entry, consoleDevicePath in candidates])
+
+            # Reading the size and label sector of each device for the
+            # generation check is the slow part with a lot of SAN luns, so
+            # it is spread over a few threads.  vmkctl and libparted are not
+            # safe to call from more than one thread, so the workers only get
+            # the device paths, the rest is done here, and the disks are
+            # added in the order vmkctl returned them.
+            identities = iter(workerpool.parallelMap(
+                readLunIdentity,
+                [consoleDevicePath for _entry, consoleDevicePath in candidates],
+                LUN_PROBE_WORKERS, 'lunprobe'))
+
+            inventory = {}
+            for entry, consoleDevicePath, warning in checked:
+                if not consoleDevicePath:
+                    log.warn(warning)
                     continue
 
-                driverName = None
-                supportsVmfs = False
-
-                # Set a default path with a large value so it's at the end of
-                # the sorted list.
-                pathIds = [ 'z' * 5 ]
-
-                paths = entry.GetPaths()
-                pathStrings = []
-                if paths:
-                    for vmkctlPath in paths:
-                        try:
-                            transportMap = vmkctlPath.GetTransportMapping()
-                            if transportMap:
-                                targetString = transportMap.GetTargetString()
-                                log.info("Target String: " + targetString)
-                                if targetString not in pathStrings:
-                                    pathStrings.append(targetString)
-                        except vmkctl.HostCtlException, ex:
-                            log.warn("Could not get transport mapping -- %s " %
-                                     str(ex.GetMessage()))
-
-                    try:
-                        adapter = paths[0].GetAdapter()
-                        driverName = adapter.GetDriver()
-                        pathIds = [
-                            util.splitInts(paths[0].GetAdapterName()),
-                            paths[0].GetChannelNumber(),
-                            paths[0].GetTargetNumber(),
-                            paths[0].GetLun()]
-
-                        supportsVmfs = self._adapterSupportsVmfs(adapter)
-                    except vmkctl.HostCtlException, ex:
-                        ## Should be a problem only until iSCSI driver situation is stabilized.
-                        log.warn("Could not get driver for path %s -- %s" %
-                                 (consoleDevicePath, str(ex.GetMessage())))
+                identity = identities.next()
+                generation = self._getLunGeneration(
+                    consoleDevicePath, self._getLunPathIds(entry), identity)
+                cached = self.inventory.get(entry.GetName())
+                if generation and cached and cached[0] == generation:
+                    log.debug("lun %s has not changed, reusing it" %
+                              entry.GetName())
+                    diskDev = cached[1]
                 else:
-                    log.warn("Could not get driver name for %s" %
-                             consoleDevicePath)
+                    diskDev = self._probeLun(entry, consoleDevicePath)
+                    if diskDev and identity:
+                        # The label was just read, so it doesn't have to be
+                        # read again when the partitions are parsed.
+                        diskDev._labelSector = identity[1]
 
-                diskDev = DiskDev(name=entry.GetName(), device=partedDev,
-                    path=path, consoleDevicePath=consoleDevicePath,
-                    model=entry.GetModel(), vendor=entry.GetVendor(),
-                    size=partedDev.length, sectorSize=partedDev.sector_size,
-                    driverName=driverName, pathIds=pathIds,
-                    pathStrings=pathStrings, vmkLun=entry,
-                    supportsVmfs=supportsVmfs, local=entry.IsLocal())
+                if not diskDev:
+                    continue
 
                 log.info("Discovered lun -- %s" % str(diskDev))
 
-                self.disks[entry.GetName()] = diskDev
+                self.disks[diskDev.name] = diskDev
+                if generation:
+                    inventory[diskDev.name] = (generation, diskDev)
+            self.inventory = inventory
 
+        self._indexDisks()
         self._attachUpgradableMounts()
 
     def getOrderedDrives(self, allowUserOverride=True):
@@ -615,13 +1039,12 @@ class DiskSet(Singleton):
 
     def getDiskByPath(self, path, console=True):
         '''Find the disk that exactly matches path.'''
-        for disk in self.disks.values():
-            if console:
-                if disk.consoleDevicePath == path:
-                    return disk
-            else:
-                if disk.path == path:
-                    return disk
+        disk = self.aliases.get(path)
+        if disk:
+            if console and disk.consoleDevicePath == path:
+                return disk
+            if not console and disk.path == path:
+                return disk
         return None
 
     def _buildDisksToSearch(self, searchVirtual=False):
@@ -661,6 +1084,7 @@ class DiskSet(Singleton):
         '''
         candidate = None
         disksToSearch = self._buildDisksToSearch(searchVirtual)
+        self.scanPartitions(disksToSearch)
 
         for disk in disksToSearch:
             for currentPart in disk.partitions:
@@ -680,6 +1104,7 @@ class DiskSet(Singleton):
         '''Find the first partition in this set of disks that matches the given
         set of constraints.'''
         disksToSearch = self._buildDisksToSearch(False)
+        self.scanPartitions(disksToSearch)
         
         for disk in disksToSearch:
             match = disk.findFirstPartitionMatching(fsTypes,
@@ -694,7 +1119,13 @@ class DiskSet(Singleton):
         '''Find the disk containing part.
         Returns None if part can't be found
         '''
+        if part.consoleDevicePath:
+            diskPartTuple = self.findPartition(part.consoleDevicePath)
+            if diskPartTuple and diskPartTuple[1] is part:
+                return diskPartTuple[0]
+
         disksToSearch = self._buildDisksToSearch(searchVirtual)
+        self.scanPartitions(disksToSearch)
 
         for disk in disksToSearch:
             if part in disk.partitions:
@@ -766,36 +1197,6 @@ def runtimeActionFindMaxVmdkSize():
         return min(fsset.vmfs3FileSystem.blockSizeMB * 256 * util.SIZE_MB,
                    size - VMDK_OVERHEAD_SIZE)
 
-def runtimeActionFindExistingEsx(devName):
-    '''Search through the first partition on a disk to see if it
-       contains traces of an ESX Installation.
-    '''
-
-    foundEsx = False
-
-    dev = DiskSet()[devName]
-
-    if not os.path.exists(TMP_MOUNT_PATH):
-        os.makedirs(TMP_MOUNT_PATH)
-
-    # don't bother looking if there are no partitions or the
-    # first partition isn't ext2/3
-    if len(dev.partitions) and dev.partitions[0].partitionId == 1 and \
-       dev.partitions[0].fsType and \
-       dev.partitions[0].fsType.name in ['ext2', 'ext3']:
-
-        dev.partitions[0].fsType.mount(dev.partitions[0].consoleDevicePath,
-                                       TMP_MOUNT_PATH)
-
-        if glob.glob(os.path.join(TMP_MOUNT_PATH, '*vmnix*')) or \
-           glob.glob(os.path.join(TMP_MOUNT_PATH, '*ESX')) or \
-           glob.glob(os.path.join(TMP_MOUNT_PATH, 'boot', '*vmnix*')):
-            foundEsx = True
-
-        dev.partitions[0].fsType.umount(TMP_MOUNT_PATH)
-
-    return foundEsx
-
 def runtimeActionFindExistingVmdkSize(existingVmdk):
     if existingVmdk:
         vmdkPath, ext = os.path.splitext(existingVmdk)
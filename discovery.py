@@ -0,0 +1,270 @@
+###############################################################################
+# Copyright (c) 2008-2009 VMware, Inc.
+#
+# This file is part of Weasel.
+#
+# Weasel is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation version 2 and no later version.
+#
+# Weasel is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# version 2 for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin St, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+'''
+discovery
+
+Find out what is already installed on the disks: an old ESX /boot partition,
+the COS vmdk it was using and the datastores on the disk.
+
+A disk is inspected by mounting its first partition read-only on a mount
+point of its own, so any number of disks can be looked at in parallel.  The
+reports are cached until the disk changes, as told by the generation that
+the DiskSet keeps for each lun, so going back and forth between the storage
+screens does not mount the same partition over and over.
+
+All of the functions here should be called from the main thread, only the
+mounting and reading of the partitions is done by the workers.
+'''
+
+import os
+import glob
+
+import devices
+import datastore
+import initrd
+import workerpool
+
+from log import log
+from esxconffile import EsxConf, ESXCONF_FILE
+
+DISCOVERY_MOUNT_PATH = '/mnt/discovery'
+DISCOVERY_WORKERS = 4
+
+# Seconds to wait for a disk before giving up on it.  A dead SAN lun can
+# leave mount hanging, the worker is left behind to finish on its own.
+DISCOVERY_TIMEOUT = 60.0
+
+# Files in /boot that give away an ESX installation, along with the major
+# version their kernel belongs to.
+ESX_BOOT_GLOBS = [
+    ('*ELvmnix*', '3'),
+    ('*vmnix*', None),
+    ('*ESX', '4'),
+    ]
+ESX_BOOT_DIRS = ['', 'boot']
+
+class ExistingEsxReport(object):
+    '''What was found on a disk.
+
+    The esxVersion is only the major version, since that is all the kernel
+    file names tell us.  If the disk could not be inspected, error is set to
+    the reason or timedOut is set and the rest of the fields are left empty.
+    '''
+
+    def __init__(self, diskName):
+        self.diskName = diskName
+        self.foundEsx = False
+        self.esxVersion = None
+        self.vmdkPath = None
+        self.vmdkSize = 0
+        self.datastores = []
+        self.timedOut = False
+        self.error = None
+
+    def _getComplete(self):
+        return not (self.timedOut or self.error)
+    complete = property(_getComplete)
+
+    def __repr__(self):
+        return "<ExistingEsxReport %s esx=%s version=%s vmdk=%s>" % (
+            self.diskName, self.foundEsx, self.esxVersion, self.vmdkPath)
+
+
+# The last report for each disk and the generation of the lun it was made
+# from, keyed by disk name.
+_cache = {}
+
+# The Jobs that timed out and are still running, keyed by disk name.  They
+# are picked up again instead of mounting the partition a second time.
+_pending = {}
+
+def clearCache():
+    _cache.clear()
+
+def getMountPoint(diskName):
+    '''Return the mount point that is used for the given disk.'''
+    return os.path.join(DISCOVERY_MOUNT_PATH, diskName.replace('/', '_'))
+
+def _getBootPartition(disk):
+    '''Return the partition that would hold an old /boot, which is the first
+    partition if it is ext2/3.'''
+    if len(disk.partitions) and disk.partitions[0].partitionId == 1 and \
+       disk.partitions[0].fsType and \
+       disk.partitions[0].fsType.name in ['ext2', 'ext3']:
+        return disk.partitions[0]
+
+    return None
+
+def _getGeneration(diskName):
+    entry = devices.DiskSet().inventory.get(diskName)
+    if entry:
+        return entry[0]
+    return None
+
+def _findEsxVersion(mountPoint):
+    '''Return a (foundEsx, esxVersion) pair for a mounted /boot.'''
+    foundEsx = False
+    for pattern, version in ESX_BOOT_GLOBS:
+        for subdir in ESX_BOOT_DIRS:
+            if glob.glob(os.path.join(mountPoint, subdir, pattern)):
+                if version:
+                    return (True, version)
+                foundEsx = True
+
+    return (foundEsx, None)
+
+def _findVmdkPath(mountPoint):
+    initrdFilePath = os.path.join(mountPoint, 'initrd.img')
+    if not os.path.exists(initrdFilePath):
+        return None
+
+    try:
+        contents = initrd.readMember(initrdFilePath, ESXCONF_FILE)
+    except (IOError, initrd.InitrdError), e:
+        log.warn("could not read esx.conf from %s -- %s" %
+                 (initrdFilePath, str(e)))
+        return None
+
+    if contents is None:
+        return None
+
+    return EsxConf(initrdFilePath, data=contents).get('/boot/cosvmdk')
+
+def _inspectPartition(diskName, consoleDevicePath, fsType):
+    '''Mount the partition and return the ExistingEsxReport for the disk,
+    without the datastores.  This is run in a worker thread.'''
+    report = ExistingEsxReport(diskName)
+    mountPoint = getMountPoint(diskName)
+
+    fsType.mount(consoleDevicePath, mountPoint, readOnly=True)
+    try:
+        report.foundEsx, report.esxVersion = _findEsxVersion(mountPoint)
+        if report.foundEsx:
+            report.vmdkPath = _findVmdkPath(mountPoint)
+    finally:
+        fsType.umount(mountPoint)
+
+    report.vmdkSize = devices.runtimeActionFindExistingVmdkSize(
+        report.vmdkPath)
+
+    return report
+
+def _collectResult(diskName, job, timeout):
+    '''Wait for the Job inspecting a disk and return its report.'''
+    if not job.wait(timeout):
+        log.warn("gave up on looking for ESX on %s after %s seconds" %
+                 (diskName, timeout))
+        _pending[diskName] = job
+        report = ExistingEsxReport(diskName)
+        report.timedOut = True
+        return report
+
+    if diskName in _pending:
+        del _pending[diskName]
+
+    try:
+        return job.result()
+    except Exception, e:
+        log.warn("could not look for ESX on %s -- %s" % (diskName, str(e)))
+        report = ExistingEsxReport(diskName)
+        report.error = str(e)
+        return report
+
+def discoverDisks(diskNames=None, timeout=DISCOVERY_TIMEOUT):
+    '''Return the ExistingEsxReports for the given disks, or all disks, in
+    the same order.
+
+    The disks that have not changed since they were last inspected are not
+    looked at again.  The rest are inspected in parallel and each one is
+    given timeout seconds to answer.
+    '''
+    diskSet = devices.DiskSet()
+    if diskNames is None:
+        diskNames = diskSet.keys()
+
+    reports = {}
+    fresh = []
+    jobs = []
+    pool = None
+    idle = False
+    try:
+        for diskName in diskNames:
+            generation = _getGeneration(diskName)
+            cached = _cache.get(diskName)
+            if generation and cached and cached[0] == generation:
+                reports[diskName] = cached[1]
+                continue
+
+            fresh.append(diskName)
+
+            job = _pending.get(diskName)
+            if not job:
+                part = _getBootPartition(diskSet[diskName])
+                if not part:
+                    reports[diskName] = ExistingEsxReport(diskName)
+                    continue
+
+                if pool is None:
+                    pool = workerpool.WorkerPool(
+                        min(DISCOVERY_WORKERS, len(diskNames)), 'discovery')
+                job = pool.submit(_inspectPartition, diskName,
+                                  part.consoleDevicePath, part.fsType)
+            jobs.append((diskName, job))
+
+        for diskName, job in jobs:
+            reports[diskName] = _collectResult(diskName, job, timeout)
+        idle = not [diskName for diskName, _job in jobs
+                    if diskName in _pending]
+    finally:
+        if pool:
+            # The workers are only left behind when a disk timed out, they
+            # are idle otherwise and can be joined right away.
+            pool.shutdown(wait=idle)
+
+    # vmkctl is not safe to call from the workers, so the datastores are
+    # filled in here.  They do not depend on mounting the partition, so
+    # every report gets them, even if the inspection failed.
+    datastoreSet = None
+    for diskName in fresh:
+        report = reports[diskName]
+        if datastoreSet is None:
+            datastoreSet = datastore.DatastoreSet()
+        report.datastores = [ds.name for ds in
+                             datastoreSet.getEntriesByDriveName(diskName)]
+
+        if not report.complete:
+            continue
+
+        generation = _getGeneration(diskName)
+        if generation:
+            _cache[diskName] = (generation, report)
+
+    return [reports[diskName] for diskName in diskNames]
+
+def prefetchReports(timeout=DISCOVERY_TIMEOUT):
+    '''Inspect all of the disks in parallel, so the later getReport calls
+    for the disks are served from the cache.  Meant to be called when the
+    storage screens are entered.'''
+    discoverDisks(timeout=timeout)
+
+def getReport(diskName, timeout=DISCOVERY_TIMEOUT):
+    '''Return the ExistingEsxReport for a single disk, from the cache if
+    the disk has not changed since it was inspected.'''
+    return discoverDisks([diskName], timeout)[0]
@@ -19,27 +19,22 @@
 #
 
 import os
-import md5
 import glob
-import shutil
-import shlex
 import userchoices
 
-import tempfile
 import devices
-import util
 
 from log import log
 from consts import HOST_ROOT
 from migrate import clonePath
+from esxconffile import ESXCONF_FILE, getEsxConf
 
 INITRD_ESX_CONF_CHECKSUM = None
-ESXCONF_FILE = "/etc/vmware/esx.conf"
 
 def _computeEsxConfChecksum():
-    m = md5.new()
-    m.update(open(ESXCONF_FILE).read())
-    retval = m.hexdigest()
+    # The file has to be read again here, the point is to notice changes
+    # that might not show up in the modification time.
+    retval = getEsxConf(ESXCONF_FILE, refresh=True).digest
     log.info("digest of initrd esx.conf -- %s" % retval)
 
     return retval
@@ -96,53 +91,9 @@ def hostActionRemoveVmdk(_context):
         #shutil.rmtree(os.path.split(vmdkLocation)[0])
         devices.removeVmdkFile(vmdkLocation)
 
-def runtimeActionExtractVmdkPathFromInitrd(driveName):
-    '''Open the initrd.img file on a disk and find the location of the
-       Console VMDK file from esx.conf.
-    '''
-    diskSet = devices.DiskSet()
-    drive = diskSet[driveName]
-    partition = drive.findFirstPartitionMatching(fsTypes=('ext3'))
-    
-    if not partition or partition.partitionId != 1:
-        return ''
-
-    tmpMntDir = tempfile.mkdtemp(prefix='weasel', dir='/mnt')
-    partition.fsType.mount(partition.consoleDevicePath, tmpMntDir)
-
-    tmpDir = tempfile.mkdtemp(prefix='weasel')
-
-    initrdFilePath = os.path.join(tmpMntDir, 'initrd.img')
-
-    cmd = "cd %s && zcat %s | cpio -id %s" % \
-        (tmpDir, initrdFilePath, ESXCONF_FILE[1:])
-    util.execCommand(cmd)
-
-    vmdkPath = getValueFromConfig(os.path.join(tmpDir, ESXCONF_FILE[1:]),
-                                  '/boot/cosvmdk')   
-
-    partition.fsType.umount(tmpMntDir)
-
-    shutil.rmtree(tmpMntDir)
-    shutil.rmtree(tmpDir)
-
-    return vmdkPath
-
 def getValueFromConfig(fileName, esxKey):
     '''Search through esx.conf and find the value for a given key'''
     if not os.path.exists(fileName):
         return None
 
-    lines = open(fileName).readlines()
-    for line in lines:
-        tokens = shlex.split(line)
-
-        if len(tokens) == 3:
-            key = tokens[0]
-            value = tokens[2]
-
-            if key != esxKey:
-                continue
-            else:
-                return value
-    return None
+    return getEsxConf(fileName).get(esxKey)
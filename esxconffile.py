@@ -0,0 +1,215 @@
+###############################################################################
+# Copyright (c) 2008-2009 VMware, Inc.
+#
+# This file is part of Weasel.
+#
+# Weasel is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation version 2 and no later version.
+#
+# Weasel is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# version 2 for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin St, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+'''
+esxconffile
+
+Parser for esx.conf files.
+
+This module does not depend on the rest of the installer since it is also
+used by the precheck and upgrade scripts that run on the old ESX host, so it
+has to stick to what the python 2.2 there can do.
+
+>>> conf = EsxConf(data='/net/pnic/child[0000]/name = "vmnic0"\\n'
+...                     '/net/pnic/child[0001]/name = "vmnic1"\\n'
+...                     '/system/uuid = "473027ac-5705f21d-6d09"\\n')
+>>> conf['/system/uuid']
+'473027ac-5705f21d-6d09'
+>>> conf.subtree('/net/pnic')
+[('/net/pnic/child[0000]/name', 'vmnic0'), ('/net/pnic/child[0001]/name', 'vmnic1')]
+>>> conf.children('/net/pnic')
+['child[0000]', 'child[0001]']
+>>> conf.find('/net/pnic/*/name')
+[('/net/pnic/child[0000]/name', 'vmnic0'), ('/net/pnic/child[0001]/name', 'vmnic1')]
+'''
+
+import os
+import md5
+import stat
+import bisect
+import fnmatch
+
+ESXCONF_FILE = "/etc/vmware/esx.conf"
+
+def parseConfigLine(line):
+    '''Split an esx.conf line into a (key, value) pair, or return None if it
+    is not a setting.
+
+    >>> parseConfigLine('/boot/cosvmdk = "/vmfs/volumes/x/cos.vmdk"\\n')
+    ('/boot/cosvmdk', '/vmfs/volumes/x/cos.vmdk')
+    >>> parseConfigLine('/a/b = "say \\\\"hi\\\\""')
+    ('/a/b', 'say "hi"')
+    >>> parseConfigLine('') is None
+    True
+    '''
+    # python 2.2 can't do "' = ' in line"
+    if line.find(' = ') == -1:
+        return None
+
+    key, value = line.split(' = ', 1)
+    key = key.strip()
+    value = value.strip()
+    if len(value) < 2 or value[0] != '"' or value[-1] != '"':
+        return None
+
+    value = value[1:-1]
+    if '"' not in value and '\\' not in value:
+        # Almost every line is a plain quoted string.
+        return (key, value)
+
+    return (key, _unescape(value))
+
+def _unescape(value):
+    '''Undo the escaping in a quoted value, where a backslash escapes a double
+    quote or another backslash.  Raises ValueError if there is a quote that
+    is not escaped.'''
+    chars = []
+    escaped = False
+    for ch in value:
+        if escaped:
+            if ch not in '"\\':
+                chars.append('\\')
+            chars.append(ch)
+            escaped = False
+        elif ch == '\\':
+            escaped = True
+        elif ch == '"':
+            raise ValueError("unescaped quote in %r" % value)
+        else:
+            chars.append(ch)
+
+    if escaped:
+        raise ValueError("trailing backslash in %r" % value)
+    return ''.join(chars)
+
+
+class EsxConf(object):
+    '''The settings in an esx.conf, parsed once into a dictionary.
+
+    The keys are also kept sorted so that all of the settings under a path,
+    like the physical NICs under "/net/pnic", can be found without going
+    through the whole file.  If a key is set more than once, the first
+    setting is used.
+    '''
+
+    def __init__(self, path=ESXCONF_FILE, data=None):
+        self.path = path
+        if data is None:
+            fileobj = open(path)
+            try:
+                data = fileobj.read()
+            finally:
+                fileobj.close()
+
+        self.digest = md5.new(data).hexdigest()
+        self.values = {}
+        self.badLines = []
+        for line in data.splitlines():
+            try:
+                pair = parseConfigLine(line)
+            except ValueError:
+                self.badLines.append(line)
+                continue
+            if pair and pair[0] not in self.values:
+                self.values[pair[0]] = pair[1]
+
+        self.sortedKeys = self.values.keys()
+        self.sortedKeys.sort()
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def __len__(self):
+        return len(self.values)
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def keys(self):
+        return list(self.sortedKeys)
+
+    def subtree(self, prefix):
+        '''Return the sorted (key, value) pairs for the keys under prefix.'''
+        prefix = prefix.rstrip('/') + '/'
+        retval = []
+        index = bisect.bisect_left(self.sortedKeys, prefix)
+        while index < len(self.sortedKeys):
+            key = self.sortedKeys[index]
+            if not key.startswith(prefix):
+                break
+            retval.append((key, self.values[key]))
+            index += 1
+        return retval
+
+    def children(self, prefix):
+        '''Return the names of the nodes directly under prefix.'''
+        prefix = prefix.rstrip('/') + '/'
+        retval = []
+        for key, _value in self.subtree(prefix):
+            name = key[len(prefix):].split('/', 1)[0]
+            if not retval or retval[-1] != name:
+                retval.append(name)
+        return retval
+
+    def find(self, pattern):
+        '''Return the sorted (key, value) pairs for the keys that match a
+        shell-style pattern, for example "/net/pnic/*/name".  Only the subtree
+        before the first wildcard is searched.'''
+        fixed = pattern
+        for wildcard in '*?[':
+            index = fixed.find(wildcard)
+            if index != -1:
+                fixed = fixed[:index]
+        if fixed == pattern:
+            if pattern in self.values:
+                return [(pattern, self.values[pattern])]
+            return []
+
+        fixed = fixed[:fixed.rfind('/') + 1]
+        return [(key, value) for key, value in self.subtree(fixed)
+                if fnmatch.fnmatchcase(key, pattern)]
+
+
+_cache = {}
+
+def getEsxConf(path=ESXCONF_FILE, refresh=False):
+    '''Return the EsxConf for path, reusing the last one that was parsed if
+    the file's modification time and size have not changed.  Pass refresh to
+    force the file to be read again.'''
+    st = os.stat(path)
+    stamp = (st[stat.ST_MTIME], st[stat.ST_SIZE])
+
+    cached = _cache.get(path)
+    if not refresh and cached and cached[0] == stamp:
+        return cached[1]
+
+    conf = EsxConf(path)
+    _cache[path] = (stamp, conf)
+    return conf
+
+def clearCache():
+    _cache.clear()
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
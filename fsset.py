@@ -165,16 +165,25 @@ class extFileSystem(FileSystemType):
     linuxnativefs = True
     maxSizeMB = 2 * 1024 * 1024
 
-    def __init__(self, label=None):
+    def __init__(self, label=None, inodeRatio=None):
         FileSystemType.__init__(self)
 
         assert label is None or len(label) < 16
         self.label = label
+        # bytes per inode, None for the mke2fs default
+        self.inodeRatio = inodeRatio
 
-    def formatDevice(self, devicePath="", progress=None, chroot='/'):
-        args = ["/usr/sbin/mkfs.ext2"]
+    def getFormatArgs(self):
+        args = []
         if self.label:
             args += ["-L", self.label]
+        if self.inodeRatio:
+            args += ["-i", str(self.inodeRatio)]
+        return args
+
+    def formatDevice(self, devicePath="", progress=None, chroot='/'):
+        args = ["/usr/sbin/mkfs.ext2"]
+        args += self.getFormatArgs()
 
         args += [devicePath]
         args.extend(self.extraFormatArgs)
@@ -206,17 +215,50 @@ class ext3FileSystem(extFileSystem):
     vmdkable = True
     supported = True
 
-    def __init__(self, label=None):
-        extFileSystem.__init__(self, label)
+    def __init__(self, label=None, inodeRatio=None, journalSizeMB=None):
+        extFileSystem.__init__(self, label, inodeRatio)
+
+        # None lets mke2fs pick a size based on the size of the partition
+        self.journalSizeMB = journalSizeMB
 
     def formatDevice(self, devicePath="", progress=None, chroot='/'):
-        extFileSystem.formatDevice(self, devicePath, progress, chroot)
+        try:
+            self._formatJournalled(devicePath)
+        except Exception, e:
+            log.warn("could not create ext3 on %s directly, falling back to "
+                     "mkfs.ext2 and tune2fs -- %s" % (devicePath, str(e)))
+            self._formatLegacy(devicePath, progress, chroot)
 
-        # XXX - crufty hack for ext3
-        os.system('touch /etc/mtab')
+        self._disablePeriodicChecks(devicePath)
 
+    def getJournalledFormatArgs(self, devicePath):
+        '''Return the mke2fs command that creates the file system with its
+        journal in one pass.'''
         # XXX - add back -Odir_index when htree is safe
-        args = ["/usr/sbin/tune2fs", "-c0", "-i0", "-j", devicePath]
+        args = ["/usr/sbin/mke2fs", "-j"]
+        args += self.getFormatArgs()
+        if self.journalSizeMB:
+            args += ["-J", "size=%d" % self.journalSizeMB]
+        args += [devicePath]
+        args.extend(self.extraFormatArgs)
+
+        return args
+
+    def _formatJournalled(self, devicePath):
+        '''Create the file system with its journal in one pass.'''
+        args = self.getJournalledFormatArgs(devicePath)
+        util.execWithLog(args[0], args, raiseException=True)
+
+    def _formatLegacy(self, devicePath, progress, chroot):
+        '''Create an ext2 file system and then add the journal to it.'''
+        extFileSystem.formatDevice(self, devicePath, progress, chroot)
+
+        _touchMtab()
+
+        args = ["/usr/sbin/tune2fs", "-j"]
+        if self.journalSizeMB:
+            args += ["-J", "size=%d" % self.journalSizeMB]
+        args += [devicePath]
 
         try:
             util.execWithLog(args[0], args, raiseException=True)
@@ -224,6 +266,23 @@ class ext3FileSystem(extFileSystem):
             raise InstallationError(
                 "Could not enable journalling on a linux partition.", e)
 
+    def _disablePeriodicChecks(self, devicePath):
+        # XXX - crufty hack for ext3, tune2fs wants an mtab to look at
+        _touchMtab()
+
+        # This only rewrites the superblock, so it is cheap next to the format.
+        args = ["/usr/sbin/tune2fs", "-c0", "-i0", devicePath]
+
+        try:
+            util.execWithLog(args[0], args, raiseException=True)
+        except Exception, e:
+            raise InstallationError(
+                "Could not disable checks on a linux partition.", e)
+
+def _touchMtab():
+    if not os.path.exists('/etc/mtab'):
+        open('/etc/mtab', 'a').close()
+
 class vmfs3FileSystem(FileSystemType):
     partedFileSystemType = parted.file_system_type_get("vmfs3")
     partedFileSystemName = "vmfs3"
@@ -352,22 +411,104 @@ def findVmfsVolumeName():
                   volumePath)
 
 
+VMFS_VOLUMES_PATH = "/vmfs/volumes"
+
+# Limits on how long to wait for the vmfs volumes to settle after a rescan.
+# A rescan can take a moment to start showing its changes, so it is always
+# given the minimum time.
+VMFS_SETTLE_TIMEOUT = 30.0
+VMFS_SETTLE_MINIMUM = 3.0
+VMFS_SETTLE_FIRST_POLL = 0.25
+VMFS_SETTLE_MAX_POLL = 2.0
+
+def getVmfsVolumeEntries():
+    '''Return a sorted list of (name, link target) pairs for the entries in
+    /vmfs/volumes.  The volume UUIDs are directories and the volume names are
+    links to them, so the list changes when a volume comes, goes or is
+    renamed.
+
+    The directory is looked at instead of asking vmkctl since listing the
+    volumes through vmkctl puts them back in the kernel cache we might be
+    trying to flush.
+    '''
+    retval = []
+    try:
+        names = os.listdir(VMFS_VOLUMES_PATH)
+    except OSError:
+        return retval
+
+    for name in names:
+        path = os.path.join(VMFS_VOLUMES_PATH, name)
+        target = None
+        if os.path.islink(path):
+            try:
+                target = os.readlink(path)
+            except OSError:
+                pass
+        retval.append((name, target))
+    retval.sort()
+
+    return retval
+
+def waitForVmfsVolumes(goneVolumes=(), newVolumes=(),
+                       timeout=VMFS_SETTLE_TIMEOUT,
+                       minimum=VMFS_SETTLE_MINIMUM):
+    '''Poll /vmfs/volumes, backing off between polls, until the volumes in
+    goneVolumes have disappeared, the ones in newVolumes have appeared and
+    the directory looks the same twice in a row.  The volumes can be given
+    by name or UUID.  At least minimum seconds are spent sleeping between
+    polls.  Returns the settled list of entries, or the last one seen if the
+    timeout runs out first.'''
+    deadline = time.time() + timeout
+    delay = VMFS_SETTLE_FIRST_POLL
+    slept = 0.0
+    last = getVmfsVolumeEntries()
+
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            log.warn("vmfs volumes did not settle after %d seconds" % timeout)
+            return last
+
+        pause = min(delay, remaining)
+        time.sleep(pause)
+        slept += pause
+        delay = min(delay * 2, VMFS_SETTLE_MAX_POLL)
+
+        current = getVmfsVolumeEntries()
+        names = [name for name, _target in current]
+        lingering = [name for name in goneVolumes if name in names]
+        missing = [name for name in newVolumes if name not in names]
+        if lingering or missing:
+            log.debug("waiting for vmfs volumes, still there: %s, not there "
+                      "yet: %s" % (lingering, missing))
+        elif current != last:
+            log.debug("vmfs volumes changed, waiting for them to settle")
+        elif slept >= minimum:
+            return current
+        last = current
+
 def flushVmfsVolumes():
     import vmkctl
 
     # XXX A side-effect of rescan is that it will flush any volumes that happen
     # to be squirreled away somewhere in a cache.
     vmkctl.StorageInfoImpl().RescanVmfs()
-    # XXX The rescan does not seem to be completely synchronous for this
-    # purpose, sleep a bit.
-    time.sleep(3)
-
-def rescanVmfsVolumes():
+    # The rescan does not seem to be completely synchronous for this purpose,
+    # wait for the volumes to stop changing.
+    waitForVmfsVolumes()
+
+def rescanVmfsVolumes(goneVolumes=()):
+    '''Rescan the vmfs volumes after partition tables have been changed and
+    wait for the volumes in goneVolumes, the ones that were on the cleared
+    drives, to disappear.'''
     import vmkctl
 
-    # XXX wait for vmfs volumes to settle down, six is the magic number.
-    time.sleep(6)
+    # Wait for any volumes on the devices that just changed to come and go
+    # before asking for the rescan, and then for the rescan to be reflected.
+    waitForVmfsVolumes()
     vmkctl.StorageInfoImpl().RescanVmfs()
+    waitForVmfsVolumes(goneVolumes)
 
 
 class swapFileSystem(FileSystemType):
@@ -22,6 +22,7 @@
 from common_windows import MessageWindow
 
 import devices
+import discovery
 import exception
 import partition
 import storage_widgets
@@ -55,6 +56,10 @@ class EsxLocationWindow(GenericLocationWindow):
 
         storage_widgets.setupStorageView(self.view)
 
+        # Look at all of the disks at once, instead of one by one as they
+        # are picked.
+        discovery.prefetchReports()
+
         # only repopulate the esxlocation if we need to
         if userchoices.getResetEsxLocation():
             model = \
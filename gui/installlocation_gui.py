@@ -29,7 +29,7 @@ import storage_widgets
 import datastore
 import iscsi_detour
 import userchoices
-import esxconf
+import discovery
 import os.path
 from storage_widgets import STORAGEVIEW_DISK_ENTRY, SUPPORTED_DISK_ENTRY
 from storage_widgets import StorageDetailsWindow
@@ -69,10 +69,9 @@ class GenericLocationWindow:
             if rc == storage_widgets.EXISTING_DATA_STAY_ON_SCREEN:
                 raise exception.StayOnScreen
             elif rc == storage_widgets.EXISTING_DATA_PRESERVE_VMFS:
-                vmdkPath = \
-                    esxconf.runtimeActionExtractVmdkPathFromInitrd(drive)
-                vmdkSize = \
-                    devices.runtimeActionFindExistingVmdkSize(vmdkPath)
+                report = discovery.getReport(drive)
+                vmdkPath = report.vmdkPath
+                vmdkSize = report.vmdkSize
 
                 log.debug("VMDK Size = %d Path = %s" % (vmdkSize, vmdkPath))
 
@@ -161,6 +160,10 @@ class InstallLocationWindow(GenericLocationWindow):
 
         storage_widgets.setupStorageView(self.view)
 
+        # Look at all of the disks at once, instead of one by one as they
+        # are picked.
+        discovery.prefetchReports()
+
         model = storage_widgets.populateStorageModel(
             self.view, self.scrolled, devices.DiskSet())
 
@@ -27,6 +27,7 @@ import userchoices
 import datastore
 import partition
 import devices
+import discovery
 import os.path
 
 from common_windows import populateViewColumns
@@ -326,7 +327,7 @@ def promptDeviceHasExistingData(deviceName, allowPreserve=True):
 
     datastoreName = ""
 
-    foundEsx = devices.runtimeActionFindExistingEsx(deviceName)
+    foundEsx = discovery.getReport(deviceName).foundEsx
 
     datastoreSet = datastore.DatastoreSet()
 
@@ -374,7 +375,6 @@ class StorageDetailsWindow(CommonWindow):
         self.drive = drive
         self.diskSet = devices.DiskSet()
         self.disk = self.diskSet[drive]
-        self.datastoreSet = datastore.DatastoreSet()
 
         self.dialog = self.xml.get_widget('details')
 
@@ -399,12 +399,13 @@ class StorageDetailsWindow(CommonWindow):
         if len(self.disk.pathIds) == 4:
             lunId = str(self.disk.pathIds[PATHID_LUN])
 
+        report = discovery.getReport(self.drive)
+
         existingEsxLabel = "No"
-        if devices.runtimeActionFindExistingEsx(self.drive):
+        if report.foundEsx:
             existingEsxLabel = "Yes"
 
-        datastoreNames = [ds.name for ds in self.datastoreSet.getEntriesByDriveName(self.drive)]
-        datastoreLabel = ', '.join(datastoreNames)
+        datastoreLabel = ', '.join(report.datastores)
 
         if not datastoreLabel:
             datastoreLabel = "None"
@@ -22,11 +22,18 @@
 import gtk
 import gobject
 import media
+import task_progress
 from common_windows import ProgressWindowTaskListener, MountMediaDelegate
 from common_windows import MessageWindow
 
 from consts import HV_DISABLED_TEXT
 
+MEDIA_CHECK_CANCELLED_TEXT = """\
+The media check was stopped before it finished.
+
+Do you want to continue checking the media?  The check picks up where it
+stopped."""
+
 class WelcomeWindow:
     SCREEN_NAME = 'welcome'
     
@@ -38,15 +45,7 @@ class WelcomeWindow:
         controlState.displayBanner = False
 
         if media.needsToBeChecked():
-            self.progressDialog = \
-                ProgressWindowTaskListener(None, \
-                           'Verifying Media', \
-                           'Verifying media ... please wait.',
-                           ['brandiso.calc_md5'],
-                           )
-
-            self.mediaCheckID = gobject.idle_add(self.startMediaCheck)
-            #self.progressDialog.setCancelCallback(self.stopMediaCheck)
+            self.queueMediaCheck()
 
     def getNext(self):
         self.checkForVT()
@@ -57,14 +56,31 @@ class WelcomeWindow:
         if cpuInfo.GetHVSupport() == cpuInfo.HV_DISABLED:
             MessageWindow(None, "VT Disabled", HV_DISABLED_TEXT, type="ok")
 
-    # leave commented as a hint for what to do in next version
-    #def stopMediaCheck(self):
-        # TODO: stop the media check in the brandiso module
-        #self.progressDialog.finish()
-        #gobject.source_remove(self.mediaCheckID)
+    def queueMediaCheck(self):
+        self.progressDialog = \
+            ProgressWindowTaskListener(None, \
+                       'Verifying Media', \
+                       'Verifying media ... please wait.',
+                       ['brandiso.calc_md5'],
+                       )
+        # The progress dialog handles its events while the media is being
+        # read, so the check can be stopped with its Cancel button.
+        self.progressDialog.setCancelCallback(media.cancelMediaCheck)
+
+        self.mediaCheckID = gobject.idle_add(self.startMediaCheck)
 
     def startMediaCheck(self):
         mediaDelegate = MountMediaDelegate()
-        media.runtimeActionMediaCheck()
-        self.progressDialog.finish()
+        try:
+            result = media.runtimeActionMediaCheck()
+        finally:
+            task_progress.removeNotificationListener(self.progressDialog)
+            self.progressDialog.finish()
+
+        if result is None:
+            window = MessageWindow(None, "Media Check Cancelled",
+                                   MEDIA_CHECK_CANCELLED_TEXT, type="yesno")
+            if window.affirmativeResponse:
+                self.queueMediaCheck()
 
+        return False
@@ -0,0 +1,225 @@
+###############################################################################
+# Copyright (c) 2008-2009 VMware, Inc.
+#
+# This file is part of Weasel.
+#
+# Weasel is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation version 2 and no later version.
+#
+# Weasel is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# version 2 for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin St, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+'''
+initrd
+
+Read files out of an initrd.img without unpacking it to disk.
+
+An initrd is one or more gzipped "newc" cpio archives concatenated together
+(see grubupdate.appendConfToInitrd).  The archives are decompressed as they
+are read and the data for members that are not wanted is skipped, so
+finding a file near the start of the image is cheap.
+'''
+
+import gzip
+
+from log import log
+
+NEWC_MAGIC = '070701'
+NEWC_CRC_MAGIC = '070702'
+NEWC_HEADER_SIZE = 110
+NEWC_TRAILER = 'TRAILER!!!'
+
+GZIP_MAGIC = '\x1f\x8b'
+
+SKIP_BLOCK_SIZE = 64 * 1024
+
+class InitrdError(Exception):
+    '''Raised when the initrd is not a cpio archive we can read.'''
+
+
+class CpioMember:
+    '''A file in a cpio archive.  The data is only available while the
+    archive is positioned on this member, that is, before the iterator moves
+    on to the next one.'''
+
+    def __init__(self, reader, name, mode, size):
+        self.reader = reader
+        self.name = name
+        self.mode = mode
+        self.size = size
+        self.consumed = False
+
+    def read(self):
+        assert not self.consumed, "member data has already been read"
+        self.consumed = True
+        return self.reader.readExactly(self.size)
+
+
+class CpioReader:
+    '''Iterates over the members of a stream of newc cpio archives.
+
+    >>> import StringIO
+    >>> data = makeNewcArchive([('etc/hosts', '127.0.0.1 localhost\\n')])
+    >>> [m.name for m in CpioReader(StringIO.StringIO(data))]
+    ['etc/hosts']
+    '''
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.offset = 0
+
+    def readExactly(self, size):
+        data = self.fileobj.read(size)
+        if len(data) != size:
+            raise InitrdError("truncated cpio archive at offset %d" %
+                              self.offset)
+        self.offset += size
+        return data
+
+    def skip(self, size):
+        while size > 0:
+            chunkSize = min(size, SKIP_BLOCK_SIZE)
+            self.readExactly(chunkSize)
+            size -= chunkSize
+
+    def skipPadding(self):
+        '''Headers and data are aligned to four bytes.'''
+        self.skip((4 - self.offset % 4) % 4)
+
+    def _readMagic(self):
+        '''Read up to the magic number of the next header, skipping over the
+        zero padding between concatenated archives.  Returns None at the end
+        of the stream.'''
+        while True:
+            try:
+                word = self.fileobj.read(4)
+            except IOError, e:
+                # Junk after the last gzip member, the kernel ignores it too.
+                log.debug("stopped reading initrd -- %s" % str(e))
+                return None
+            if not word:
+                return None
+            self.offset += len(word)
+            if word != '\0\0\0\0':
+                break
+
+        return word + self.readExactly(len(NEWC_MAGIC) - len(word))
+
+    def __iter__(self):
+        while True:
+            magic = self._readMagic()
+            if magic is None:
+                return
+            if magic not in (NEWC_MAGIC, NEWC_CRC_MAGIC):
+                raise InitrdError("bad cpio magic %r at offset %d" %
+                                  (magic, self.offset - len(magic)))
+
+            header = self.readExactly(NEWC_HEADER_SIZE - len(magic))
+            try:
+                fields = [int(header[i:i + 8], 16)
+                          for i in range(0, len(header), 8)]
+            except ValueError:
+                raise InitrdError("bad cpio header at offset %d" %
+                                  self.offset)
+            # ino, mode, uid, gid, nlink, mtime, filesize, devmajor,
+            # devminor, rdevmajor, rdevminor, namesize, check
+            mode = fields[1]
+            fileSize = fields[6]
+            nameSize = fields[11]
+
+            name = self.readExactly(nameSize).rstrip('\0')
+            self.skipPadding()
+
+            if name == NEWC_TRAILER:
+                # The end of this archive, there may be another one after it.
+                continue
+
+            member = CpioMember(self, normalizeName(name), mode, fileSize)
+            yield member
+
+            if not member.consumed:
+                self.skip(fileSize)
+            self.skipPadding()
+
+
+def normalizeName(name):
+    '''Archive names can be written as "etc/x", "./etc/x" or "/etc/x".
+
+    >>> normalizeName('./etc/vmware/esx.conf')
+    'etc/vmware/esx.conf'
+    >>> normalizeName('/etc/vmware/esx.conf')
+    'etc/vmware/esx.conf'
+    '''
+    while name.startswith('./'):
+        name = name[2:]
+    return name.lstrip('/')
+
+def openInitrd(path):
+    '''Open an initrd, which may or may not be compressed.'''
+    fileobj = open(path, 'rb')
+    magic = fileobj.read(len(GZIP_MAGIC))
+    fileobj.seek(0)
+    if magic == GZIP_MAGIC:
+        # GzipFile reads through concatenated gzip members on its own.
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    return fileobj
+
+def readMember(path, memberName, last=False):
+    '''Return the contents of memberName in the initrd at path, or None if
+    it is not in there.
+
+    The search stops at the first copy of the member.  When last is True,
+    the whole initrd is read and the last copy is returned instead, which is
+    the one the kernel ends up with when files have been appended to the
+    image.
+    '''
+    memberName = normalizeName(memberName)
+
+    fileobj = openInitrd(path)
+    try:
+        retval = None
+        for member in CpioReader(fileobj):
+            if member.name != memberName:
+                continue
+            retval = member.read()
+            if not last:
+                break
+    finally:
+        fileobj.close()
+
+    return retval
+
+def makeNewcArchive(files):
+    '''Build an uncompressed newc archive out of (name, data) pairs, mostly
+    useful for testing.'''
+    def pad(data):
+        return data + '\0' * ((4 - len(data) % 4) % 4)
+
+    retval = ''
+    ino = 1
+    for name, data in files + [(NEWC_TRAILER, '')]:
+        if name == NEWC_TRAILER:
+            mode = 0
+        else:
+            mode = 0100644
+        header = NEWC_MAGIC + ''.join([
+            '%08x' % value for value in
+            (ino, mode, 0, 0, 1, 0, len(data), 0, 0, 0, 0, len(name) + 1, 0)])
+        retval += pad(header + name + '\0') + pad(data)
+        ino += 1
+
+    # cpio pads the archive out to a full block
+    return retval + '\0' * ((512 - len(retval) % 512) % 512)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -37,6 +37,14 @@ MOUNT_MEDIA_DELEGATE = None
 CDROM_MOUNT_SCRIPT = "11.85.mount-cdrom"
 MEDIA_CHECKED = False
 
+# Images that passed the media check, one "<checksum> <volume id>" line for
+# each, so the same image is not checked again on every boot.
+MEDIA_CHECK_STATE_PATH = "/var/lib/weasel/mediacheck"
+
+# The partially finished check of the current image, if one was cancelled.
+MEDIA_CHECKPOINT = None
+MEDIA_CHECKPOINT_KEY = None
+
 class MediaDescriptor:
     def __init__(self, diskName=None, partPath=None, partFsName=None,
                  isoPath=None):
@@ -227,6 +235,71 @@ def runtimeActionEjectMedia():
 def needsToBeChecked():
     return (not MEDIA_CHECKED and userchoices.getMediaCheck())
 
+def _getMediaCheckStatePath():
+    return userchoices.getMediaCheckState().get('stateFile',
+                                                MEDIA_CHECK_STATE_PATH)
+
+def _getMediaCheckKey(media):
+    '''Returns the key for the image on the media, made from the checksum
+    and volume id that were branded into it, or None if it can't be read.'''
+    try:
+        writtenDigest, idStr = brandiso.read_iso_brand(media.partPath)
+    except (brandiso.BrandISOException, IOError), e:
+        log.debug("could not read the brand of the media -- %s" % str(e))
+        return None
+    return "%s %s" % (brandiso.pretty(writtenDigest), idStr.strip())
+
+def _isCheckedMedia(key):
+    try:
+        stateFile = open(_getMediaCheckStatePath())
+    except IOError:
+        return False
+    try:
+        for line in stateFile:
+            if line.rstrip('\n') == key:
+                return True
+    finally:
+        stateFile.close()
+    return False
+
+def _addCheckedMedia(key):
+    path = _getMediaCheckStatePath()
+    try:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        stateFile = open(path, 'a+')
+        try:
+            stateFile.seek(0, 2)
+            if stateFile.tell():
+                # don't add the key onto a truncated last line
+                stateFile.seek(-1, 2)
+                if stateFile.read(1) != '\n':
+                    key = "\n" + key
+                stateFile.seek(0, 2)
+            stateFile.write("%s\n" % key)
+        finally:
+            stateFile.close()
+    except (IOError, OSError), e:
+        log.warn("could not record the media check result in %s -- %s" %
+                 (path, str(e)))
+
+def _getCheckpoint(key):
+    '''Returns the checkpoint for the image with the given key, so a check
+    that was cancelled picks up where it stopped.'''
+    global MEDIA_CHECKPOINT, MEDIA_CHECKPOINT_KEY
+
+    if MEDIA_CHECKPOINT is None or key is None or \
+            key != MEDIA_CHECKPOINT_KEY:
+        MEDIA_CHECKPOINT = brandiso.Checkpoint()
+        MEDIA_CHECKPOINT_KEY = key
+    return MEDIA_CHECKPOINT
+
+def cancelMediaCheck():
+    '''Stop a media check that is in progress.  The next call to
+    runtimeActionMediaCheck will resume it.'''
+    if MEDIA_CHECKPOINT:
+        MEDIA_CHECKPOINT.cancel()
+
 def runtimeActionMediaCheck(uiDelegate=None):
     global MEDIA_CHECKED
     
@@ -236,11 +309,15 @@ def runtimeActionMediaCheck(uiDelegate=None):
         uiDelegate = MOUNT_MEDIA_DELEGATE
 
     media = userchoices.getMediaDescriptor() or DEFAULT_MEDIA
+    key = _getMediaCheckKey(media)
 
     def verify():
         try:
-            d1, d2, _id = brandiso.extract_iso_checksums(media.partPath)
+            d1, d2, _id = brandiso.extract_iso_checksums(
+                media.partPath, _getCheckpoint(key))
             return d1 == d2
+        except brandiso.CheckCancelled:
+            raise
         except brandiso.BrandISOException, inst:
             log.warn(inst)
             return None
@@ -248,20 +325,62 @@ def runtimeActionMediaCheck(uiDelegate=None):
             log.warn(e)
             return None
 
-    if isInstallMediaMounted():
+    def verifyUnmounted():
         runtimeActionUnmountMedia()
-        retval = verify()
-        runtimeActionMountMedia()
-    else:
-        retval = verify()
+        try:
+            return verify()
+        finally:
+            runtimeActionMountMedia()
+
+    def verifyFiles():
+        try:
+            failures = brandiso.verify_file_checksums(
+                MEDIA_DEVICE_MOUNT_POINT)
+        except (IOError, ValueError), e:
+            log.warn(e)
+            return None
+        for relpath in failures:
+            log.warn("checksum mismatch for %s on the media" % relpath)
+        return not failures
+
+    def hasFileChecksums():
+        return os.path.exists(os.path.join(MEDIA_DEVICE_MOUNT_POINT,
+                                           brandiso.FILE_CHECKSUMS_NAME))
+
+    try:
+        if key and _isCheckedMedia(key):
+            log.info("media %s has already been checked" % key)
+            retval = True
+        elif userchoices.getMediaCheckFiles():
+            # Checking the files on the mounted media only reads the data
+            # that is actually used, which is a lot quicker than the whole
+            # image.
+            if not isInstallMediaMounted():
+                runtimeActionMountMedia(uiDelegate)
+            if hasFileChecksums():
+                log.info("checking the files on the media against %s" %
+                         brandiso.FILE_CHECKSUMS_NAME)
+                retval = verifyFiles()
+            else:
+                log.info("no %s on the media, checking the whole image" %
+                         brandiso.FILE_CHECKSUMS_NAME)
+                retval = verifyUnmounted()
+        elif isInstallMediaMounted():
+            retval = verifyUnmounted()
+        else:
+            retval = verify()
+    except brandiso.CheckCancelled, e:
+        log.info("media check cancelled -- %s" % str(e))
+        return None
 
     if not retval:
         uiDelegate.mountMediaCheckFailed()
         sys.exit(ExitCodes.IMMEDIATELY_REBOOT)
     else:
         uiDelegate.mountMediaCheckSuccess()
+        if key and not _isCheckedMedia(key):
+            _addCheckedMedia(key)
 
     MEDIA_CHECKED = True
 
     return retval
-
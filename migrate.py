@@ -20,77 +20,32 @@
 
 import re
 import os
-import glob
 import stat
 import util
 import string
 import shutil
 import consts
+import workerpool
+import task_progress
 
 import migration
+import migrateplan
 
 from log import log
+from migrateplan import PATHS_TO_MIGRATE_PRE_PACKAGES, PATHS_TO_MIGRATE
+from migrateplan import MigrationEntry
 
-# TODO: Any required files need to be added to the precheck.
-
-PATHS_TO_MIGRATE_PRE_PACKAGES = [
-    "/etc/vmware",
+CMDS_TO_RUN = [
+    "/usr/sbin/tzdata-update",
     ]
 
-# Names of files and directories to copy from the old installation to the new.
-PATHS_TO_MIGRATE = [
-    "/etc/logrotate.conf",
-
-    "/etc/localtime",
-    "/etc/ntp.conf",
-    
-    "/etc/syslog.conf",
-
-    "/etc/sysconfig/ntpd",
-    "/etc/sysconfig/xinetd",
-    "/etc/sysconfig/console",
-    "/etc/sysconfig/i18n",
-    "/etc/sysconfig/clock",
-    "/etc/sysconfig/crond",
-    "/etc/sysconfig/syslog",
-    "/etc/sysconfig/keyboard",
-    "/etc/sysconfig/mouse",
-
-    "/etc/ssh",
-
-    "/etc/nsswitch.conf",
-    "/etc/yp.conf",
-    "/etc/krb.conf",
-    "/etc/krb.realms",
-    "/etc/krb5.conf",
-    "/etc/login.defs",
-
-    "/etc/pam.d/*",
-
-    "/etc/hosts.allow",
-    "/etc/hosts.deny",
-
-    "/etc/ldap.conf",
-    "/etc/openldap",
+MIGRATE_WORKERS = 4
 
-    "/etc/sudoers",
+# The files are handed to the workers in batches since most of them are
+# small and copying one takes about as long as queueing it.
+MIGRATE_BATCH_SIZE = 32
 
-    "/etc/snmp",
-
-    "/usr/local/etc",    # ntp stores a bunch of stuff in here.
-
-    "/etc/rc.d/rc*.d/*",
-    "/etc/xinetd.conf",
-
-    "/etc/motd",
-    # SW iSCSI Configuration
-    "/etc/initiatorname.vmkiscsi",
-    "/etc/vmkiscsi.conf",
-    ]
-
-CMDS_TO_RUN = [
-    "/usr/sbin/tzdata-update",
-    ]
+MIGRATE_TASK = 'migrate'
 
 class NamedList(list):
     '''Extension of the list type that lets you reference indexes by name,
@@ -192,22 +147,34 @@ class TextConfigFile:
     def _addDefaultFields(self, fields):
         return fields
 
-def cloneFile(src, dst):
-    '''Clone a file, including its owner ids.'''
-    log.debug("cloning file %s -> %s" % (src, dst))
-    dirs = os.path.dirname(dst)
-    if not os.path.exists(dirs):
+def _makeParentDirs(path):
+    dirs = os.path.dirname(path)
+    if os.path.exists(dirs):
+        return
+    try:
         os.makedirs(dirs)
+    except OSError:
+        # Another worker might have beaten us to it.
+        if not os.path.isdir(dirs):
+            raise
+
+def cloneFile(src, dst, st=None):
+    '''Clone a file, including its owner ids.  The stat of src can be passed
+    in if the caller already has it.'''
+    log.debug("cloning file %s -> %s" % (src, dst))
+    _makeParentDirs(dst)
     preserveFile(dst)
     shutil.copy2(src, dst)
-    st = os.stat(src)
+    if st is None:
+        st = os.stat(src)
     os.chown(dst, st[stat.ST_UID], st[stat.ST_GID])
 
-def cloneDir(src, dst):
+def cloneDir(src, dst, st=None):
     log.debug("cloning dir %s -> %s" % (src, dst))
     if not os.path.exists(dst):
         os.makedirs(dst)
-    st = os.stat(src)
+    if st is None:
+        st = os.stat(src)
     shutil.copystat(src, dst)
     os.chown(dst, st[stat.ST_UID], st[stat.ST_GID])
 
@@ -239,107 +206,111 @@ def clonePath(src, dst):
     else:
         cloneFile(src, dst)
 
-def resolveLink(prefix, path):
-    '''Resolve a sym link in the ESX3 file system.'''
-    count = 0
-    while os.path.islink(path):
-        # We have to resolve links ourselves instead of using os.path.realpath
-        # because we need to prefix '/mnt/sysimage/esx3-installation' onto any
-        # absolute paths.
-        linkPath = os.readlink(path)
-        if not os.path.isabs(linkPath):
-            path = os.path.join(os.path.dirname(path), linkPath)
-        else:
-            # Absolute links should be made relative to the esx3 mount in the
-            # installer.
-            path = os.path.join(prefix, linkPath.lstrip('/'))
-        path = os.path.normpath(path)
-        if not os.path.lexists(path):
-            log.warn("link destination does not exist -- %s" % path)
-            return None
-        count += 1
-        if count > 10:
-            log.warn("sym link loop")
-            return None
-    return path
-        
-def expandGlobPath(path):
-    '''Expand a given path into a list of files to be migrated.
+def getOldRoot():
+    '''Return where the old installation is mounted, without a trailing
+    slash so the absolute paths to migrate can be appended to it.'''
+    return consts.HOST_ROOT + consts.ESX3_INSTALLATION.lstrip('/')
 
-    The path can be a shell glob that specifies either files or directories.
-    For a file, if there is a custom handler in migration.MIGRATION_HANDLERS,
-    it will be called to scan the file and perform any migration work.  If
-    the migration handler discovers any other files referenced they will be
-    added to the list returned by this function.
+class MigrationPlan(migrateplan.MigrationPlan):
+    '''A migrateplan.MigrationPlan from the old installation to the new one
+    that uses the handlers in migration.MIGRATION_HANDLERS and can be
+    executed.'''
 
-    If the path is a directory, its contents will be walked and added to the
-    list of files returned.
-    '''
-    retval = []
-
-    prefix = consts.HOST_ROOT + consts.ESX3_INSTALLATION.lstrip('/')
-    oldPathGlob = prefix + path
-    paths = glob.glob(oldPathGlob)
-    for oldPath in paths:
-        strippedPath = oldPath[len(prefix):]
-        newPath = os.path.join(consts.HOST_ROOT, strippedPath.lstrip('/'))
-        
-        if path in migration.MIGRATION_HANDLERS:
-            log.debug("custom migration handler -- %s" % path)
-            handler = migration.MIGRATION_HANDLERS[path]
-            accum = []
-            # If the oldPath is a link, we need to resolve it so that the
-            # custom handler can open the file up.
-            actualOldPath = resolveLink(consts.HOST_ROOT +
-                                        consts.ESX3_INSTALLATION.lstrip('/'),
-                                        oldPath)
-            if not actualOldPath:
-                log.warn("  skipping unresolved sym link -- %s" % oldPath)
-                continue
-            doClone = handler(actualOldPath, newPath, accum)
+    def __init__(self, dryRun=False):
+        migrateplan.MigrationPlan.__init__(self, getOldRoot(),
+                                           consts.HOST_ROOT,
+                                           migration.MIGRATION_HANDLERS,
+                                           dryRun)
 
-            # Need to recursively expand paths returned by the migration
-            # handler in case they need processing as well.  For example, if
-            # a config file includes another config file, the second file will
-            # need to be run through the custom migration handler as well.
-            for extraPath in accum:
-                retval.extend(expandGlobPath(extraPath))
+    def debug(self, msg):
+        log.debug(msg)
 
-            if not doClone:
-                log.debug("custom handler migrated file -- %s" % path)
-                continue
-        
-        retval.append(path)
-        if os.path.isdir(oldPath):
-            for name in os.listdir(oldPath):
-                subdir = oldPath[
-                    len(consts.HOST_ROOT + consts.ESX3_INSTALLATION.lstrip('/')):]
-                retval.extend(expandGlobPath(os.path.join(subdir, name)))
-    
-    return retval
+    def info(self, msg):
+        log.info(msg)
 
-def migratePath(path):
-    '''Attempt to migrate a file from the ESX v3 installation to the new one.'''
+    def warn(self, msg):
+        log.warn(msg)
 
-    allPaths = expandGlobPath(path)
-    if not allPaths:
-        log.info("not migrating globbed path -- %s" % path)
-    
-    for expandedPath in allPaths:
-        oldPath = consts.HOST_ROOT + consts.ESX3_INSTALLATION + expandedPath
-        newPath = consts.HOST_ROOT + expandedPath
-        
-        if not os.path.exists(oldPath) and not os.path.islink(oldPath):
-            log.info("not migrating expanded path '%s' from '%s'" % (
-                expandedPath, path))
-            continue
-
-        if os.path.isdir(oldPath):
-            # The expandGlobPath has already walked down the tree, so we just
-            # want to clone the directory's permissions and what not.
-            cloneDir(oldPath, newPath)
+    def execute(self, numWorkers=MIGRATE_WORKERS):
+        '''Copy everything in the plan to the new installation.
+
+        The directories are created first, in order, then the files and links
+        are copied by a pool of workers.  Progress is reported on the
+        MIGRATE_TASK in bytes, plus one for each file or link so that empty
+        ones count too.  If any of the copies failed, the first error is
+        raised after the rest have finished.  A dry run can't be executed.
+        '''
+        assert not self.dryRun, "cannot execute a dry run"
+
+        others = []
+        for entry in self.entries:
+            if entry.kind == MigrationEntry.DIR:
+                cloneDir(entry.oldPath, entry.newPath, entry.st)
+            else:
+                others.append(entry)
+
+        if not others:
+            return
+
+        batches = [others[index:index + MIGRATE_BATCH_SIZE]
+                   for index in range(0, len(others), MIGRATE_BATCH_SIZE)]
+
+        task_progress.taskStarted(MIGRATE_TASK, _batchWork(others))
+        try:
+            if len(batches) == 1:
+                # Not worth starting any threads.
+                _copyBatch(others)
+                task_progress.taskProgress(MIGRATE_TASK, _batchWork(others))
+                return
+
+            pool = workerpool.WorkerPool(min(numWorkers, len(batches)),
+                                         'migrate')
+            try:
+                jobs = [pool.submit(_copyBatch, batch) for batch in batches]
+                for batch, job in zip(batches, jobs):
+                    job.wait()
+                    task_progress.taskProgress(MIGRATE_TASK, _batchWork(batch))
+            finally:
+                pool.shutdown(wait=False)
+
+            for job in jobs:
+                job.result()
+        finally:
+            task_progress.taskFinish(MIGRATE_TASK)
+
+
+def _batchWork(batch):
+    return sum([entry.size + 1 for entry in batch])
+
+def _copyBatch(batch):
+    '''Copy a batch of files and links.  This is run in a worker thread.'''
+    for entry in batch:
+        if entry.kind == MigrationEntry.LINK:
+            cloneLink(entry.oldPath, entry.newPath)
         else:
-            clonePath(oldPath, newPath)
+            cloneFile(entry.oldPath, entry.newPath, entry.st)
+
+def planMigration(paths, dryRun=False):
+    '''Return the MigrationPlan for the given globs.  The custom handlers
+    are run, unless this is a dry run.'''
+    plan = MigrationPlan(dryRun)
+    for path in paths:
+        if not plan.addPath(path):
+            log.info("not migrating globbed path -- %s" % path)
+
+    return plan
+
+def migratePaths(paths):
+    '''Migrate the files matched by the given globs from the ESX v3
+    installation to the new one.'''
+    plan = planMigration(paths)
+    log.info("migrating %d paths, %d bytes" % (len(plan.entries),
+                                               plan.totalSize))
+    plan.execute()
+
+def migratePath(path):
+    '''Attempt to migrate a file from the ESX v3 installation to the new one.'''
+    migratePaths([path])
 
 def preserveFile(path):
     '''Preserve a file in the new installation and return its name or None if
@@ -352,12 +323,10 @@ def preserveFile(path):
     return retval
 
 def hostActionPrePackages(_context):
-    for path in PATHS_TO_MIGRATE_PRE_PACKAGES:
-        migratePath(path)
+    migratePaths(PATHS_TO_MIGRATE_PRE_PACKAGES)
 
 def hostAction(_context):
-    for path in PATHS_TO_MIGRATE:
-        migratePath(path)
+    migratePaths(PATHS_TO_MIGRATE)
 
     for cmd in CMDS_TO_RUN:
         util.execCommand(cmd, root=consts.HOST_ROOT)
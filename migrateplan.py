@@ -0,0 +1,313 @@
+###############################################################################
+# Copyright (c) 2008-2009 VMware, Inc.
+#
+# This file is part of Weasel.
+#
+# Weasel is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation version 2 and no later version.
+#
+# Weasel is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# version 2 for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin St, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+'''
+migrateplan
+
+Work out which files migrating the configuration of an ESX v3 installation
+will copy, and how big they are, before anything is copied.
+
+The installer builds on this in migrate.MigrationPlan.  The precheck script
+also uses it, on the old host, to find out how much space the migrated
+configuration needs.  So this module does not depend on the rest of the
+installer and it has to stick to what the python 2.2 on ESX v3 can do.
+'''
+
+import os
+import sys
+import glob
+import stat
+
+PATHS_TO_MIGRATE_PRE_PACKAGES = [
+    "/etc/vmware",
+    ]
+
+# Names of files and directories to copy from the old installation to the new.
+PATHS_TO_MIGRATE = [
+    "/etc/logrotate.conf",
+
+    "/etc/localtime",
+    "/etc/ntp.conf",
+
+    "/etc/syslog.conf",
+
+    "/etc/sysconfig/ntpd",
+    "/etc/sysconfig/xinetd",
+    "/etc/sysconfig/console",
+    "/etc/sysconfig/i18n",
+    "/etc/sysconfig/clock",
+    "/etc/sysconfig/crond",
+    "/etc/sysconfig/syslog",
+    "/etc/sysconfig/keyboard",
+    "/etc/sysconfig/mouse",
+
+    "/etc/ssh",
+
+    "/etc/nsswitch.conf",
+    "/etc/yp.conf",
+    "/etc/krb.conf",
+    "/etc/krb.realms",
+    "/etc/krb5.conf",
+    "/etc/login.defs",
+
+    "/etc/pam.d/*",
+
+    "/etc/hosts.allow",
+    "/etc/hosts.deny",
+
+    "/etc/ldap.conf",
+    "/etc/openldap",
+
+    "/etc/sudoers",
+
+    "/etc/snmp",
+
+    "/usr/local/etc",    # ntp stores a bunch of stuff in here.
+
+    "/etc/rc.d/rc*.d/*",
+    "/etc/xinetd.conf",
+
+    "/etc/motd",
+    # SW iSCSI Configuration
+    "/etc/initiatorname.vmkiscsi",
+    "/etc/vmkiscsi.conf",
+    ]
+
+MAX_LINK_DEPTH = 10
+
+def _lexists(path):
+    if hasattr(os.path, 'lexists'):
+        return os.path.lexists(path)
+
+    # python 2.2
+    try:
+        os.lstat(path)
+    except OSError:
+        return False
+    return True
+
+def _handlerName(handler):
+    return getattr(handler, '__name__', str(handler))
+
+
+class MigrationEntry(object):
+    '''A file, directory or link in the old installation that is going to be
+    copied into the new one.
+
+    The path is relative to the root of the installation, like
+    "/etc/ssh/sshd_config".  If the file is run through a custom handler,
+    handler is the name of the handler.  For a link, linkTarget is where it
+    points.
+    '''
+
+    DIR = 'dir'
+    FILE = 'file'
+    LINK = 'link'
+
+    def __init__(self, path, kind, oldPath, newPath, st=None):
+        self.path = path
+        self.kind = kind
+        self.oldPath = oldPath
+        self.newPath = newPath
+        self.st = st
+        self.handler = None
+        self.linkTarget = None
+
+    def _getSize(self):
+        if self.kind != self.FILE:
+            return 0
+        return self.st[stat.ST_SIZE]
+    size = property(_getSize)
+
+    def __repr__(self):
+        return "<MigrationEntry %s %s>" % (self.kind, self.path)
+
+
+class MigrationPlan(object):
+    '''The files, directories and links that migrating a set of paths will
+    copy.
+
+    The paths can be shell globs for either files or directories.  For a
+    file, if there is a custom handler in the handlers dictionary, it is
+    called to scan the file and perform any migration work.  If the handler
+    discovers any other files referenced, they are added to the plan as well.
+    Directories are walked and their contents added to the plan.
+
+    A path that is matched more than once, by overlapping globs or by a
+    handler naming a file that was already found, is only planned once.
+
+    In a dry run the handlers are not called.  The files they would have
+    been given are planned as if they were going to be copied, so the total
+    size is an upper bound.  Any other files that the handlers would have
+    found are missed.
+    '''
+
+    def __init__(self, oldRoot='', newRoot='/', handlers=None, dryRun=False):
+        self.oldRoot = oldRoot
+        self.newRoot = newRoot
+        if handlers is None:
+            handlers = {}
+        self.handlers = handlers
+        self.dryRun = dryRun
+
+        self.entries = []
+
+        # The (path, handler name) of every file given to a custom handler.
+        self.handled = []
+
+        self._seen = {}
+
+    def _getTotalSize(self):
+        retval = 0
+        for entry in self.entries:
+            retval += entry.size
+        return retval
+    totalSize = property(_getTotalSize)
+
+    def debug(self, msg):
+        pass
+
+    def info(self, msg):
+        pass
+
+    def warn(self, msg):
+        sys.stderr.write("warn: %s\n" % msg)
+
+    def getManifest(self):
+        '''Return a (path, kind, size, handler, linkTarget) tuple for each
+        entry in the plan.'''
+        retval = []
+        for entry in self.entries:
+            retval.append((entry.path, entry.kind, entry.size, entry.handler,
+                           entry.linkTarget))
+        return retval
+
+    def addPath(self, path):
+        '''Add the paths matched by the given glob to the plan.  Returns the
+        number of paths in the old installation that matched.'''
+        oldPaths = glob.glob(self.oldRoot + path)
+        for oldPath in oldPaths:
+            self._addMatch(path, oldPath[len(self.oldRoot):], oldPath)
+
+        return len(oldPaths)
+
+    def resolveLink(self, path):
+        '''Resolve a sym link in the old file system.'''
+        count = 0
+        while os.path.islink(path):
+            # We have to resolve links ourselves instead of using
+            # os.path.realpath because we need to prefix the old root onto
+            # any absolute paths.
+            linkPath = os.readlink(path)
+            if not os.path.isabs(linkPath):
+                path = os.path.join(os.path.dirname(path), linkPath)
+            else:
+                path = os.path.join(self.oldRoot, linkPath.lstrip('/'))
+            path = os.path.normpath(path)
+            if not _lexists(path):
+                self.warn("link destination does not exist -- %s" % path)
+                return None
+            count += 1
+            if count > MAX_LINK_DEPTH:
+                self.warn("sym link loop")
+                return None
+        return path
+
+    def _addMatch(self, pattern, path, oldPath):
+        if path in self._seen:
+            return
+        self._seen[path] = True
+
+        handler = self.handlers.get(pattern)
+        if handler:
+            self.debug("custom migration handler -- %s" % pattern)
+            # If the oldPath is a link, we need to resolve it so that the
+            # custom handler can open the file up.
+            actualOldPath = self.resolveLink(oldPath)
+            if not actualOldPath:
+                self.warn("  skipping unresolved sym link -- %s" % oldPath)
+                return
+            self.handled.append((path, _handlerName(handler)))
+
+            if self.dryRun:
+                entry = self._makeEntry(path, actualOldPath)
+                if entry:
+                    entry.handler = _handlerName(handler)
+                    self.entries.append(entry)
+                return
+
+            accum = []
+            newPath = os.path.join(self.newRoot, path.lstrip('/'))
+            doClone = handler(actualOldPath, newPath, accum)
+
+            # The paths returned by the migration handler might need
+            # processing as well.  For example, if a config file includes
+            # another config file, the second file will need to be run
+            # through the custom migration handler too.
+            for extraPath in accum:
+                self.addPath(extraPath)
+
+            if not doClone:
+                self.debug("custom handler migrated file -- %s" % pattern)
+                return
+
+        entry = self._makeEntry(path, oldPath)
+        if not entry:
+            return
+
+        entry.handler = handler and _handlerName(handler)
+        self.entries.append(entry)
+        if entry.kind == MigrationEntry.DIR:
+            for name in os.listdir(oldPath):
+                childPath = os.path.join(path, name)
+                self._addMatch(childPath, childPath,
+                               os.path.join(oldPath, name))
+
+    def _makeEntry(self, path, oldPath):
+        '''Stat the path once and remember what kind of thing it is.'''
+        newPath = os.path.join(self.newRoot, path.lstrip('/'))
+        try:
+            if os.path.islink(oldPath):
+                entry = MigrationEntry(path, MigrationEntry.LINK,
+                                       oldPath, newPath)
+                entry.linkTarget = os.readlink(oldPath)
+                return entry
+            st = os.stat(oldPath)
+        except OSError, e:
+            self.info("not migrating path '%s' -- %s" % (path, str(e)))
+            return None
+
+        mode = st[stat.ST_MODE]
+        if stat.S_ISDIR(mode):
+            kind = MigrationEntry.DIR
+        elif stat.S_ISREG(mode):
+            kind = MigrationEntry.FILE
+        else:
+            self.info("not migrating special file -- %s" % path)
+            return None
+
+        return MigrationEntry(path, kind, oldPath, newPath, st)
+
+
+def estimateMigration(paths, oldRoot='', handlers=None):
+    '''Return a dry run MigrationPlan for the given paths.'''
+    plan = MigrationPlan(oldRoot, handlers=handlers, dryRun=True)
+    for path in paths:
+        plan.addPath(path)
+    return plan
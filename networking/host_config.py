@@ -49,6 +49,7 @@ serves.  That means HTTP and FTP.
 
 import vmkctl
 import urllib2
+import keepalive
 from log import log
 from networking_base import wrapHostCtlExceptions
 
@@ -168,6 +169,7 @@ class HostConfig(object):
         # null handler turns proxy off
         self._noProxyHandler = urllib2.ProxyHandler({})
         self._proxyHandler = None
+        self._openerInstalled = False
         self._desiredGateway = None
         self._vmkctlKnowsDesiredGateway = True
 
@@ -342,8 +344,7 @@ class HostConfig(object):
         if not val:
             if self._useProxy:
                 log.debug('Turning off installer proxy server support')
-                opener = urllib2.build_opener(self._noProxyHandler)
-                urllib2.install_opener(opener)
+                self._installOpener(self._noProxyHandler)
                 self._useProxy = False
             # elif self._useProxy was already False, just return
             return
@@ -351,12 +352,26 @@ class HostConfig(object):
         if not self._proxyHandler:
             raise ValueError('Can not turn on proxy before it has been set up')
         log.debug('Turning on installer proxy server support')
-        opener = urllib2.build_opener(self._proxyHandler)
-        urllib2.install_opener(opener)
+        self._installOpener(self._proxyHandler)
         self._useProxy = True
         
     useProxy = property(_getUseProxy, _setUseProxy)
 
+    def _installOpener(self, proxyHandler):
+        opener = urllib2.build_opener(proxyHandler, keepalive.getHandler())
+        urllib2.install_opener(opener)
+        self._openerInstalled = True
+
+    def ensureOpenerInstalled(self):
+        '''Make sure urllib2 is using the keep-alive handler, even if the
+        proxy settings have never been touched.'''
+        if self._openerInstalled:
+            return
+        if self._useProxy:
+            self._installOpener(self._proxyHandler)
+        else:
+            self._installOpener(self._noProxyHandler)
+
     def activateGatewayRouting(self, vswifName='vswif0'):
         self._setConsoleGateway(self.gateway, vswifName, setConfFileOnly=False)
 
@@ -0,0 +1,163 @@
+#! /usr/bin/env python
+
+###############################################################################
+# Copyright (c) 2008-2009 VMware, Inc.
+#
+# This file is part of Weasel.
+#
+# Weasel is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation version 2 and no later version.
+#
+# Weasel is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# version 2 for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin St, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+networking/keepalive.py module
+
+A urllib2 handler that keeps HTTP connections open between requests so that
+fetching hundreds of RPMs (and their header fragments) from the same depot
+does not pay for a new TCP connection every time.
+
+Connections are only handed back to the pool once their response has been
+read to the end, and at most MAX_IDLE_PER_HOST idle connections are kept for
+any one host.  The handler replaces urllib2.HTTPHandler, so it also works
+through a proxy (the "host" is the proxy in that case).
+"""
+
+import socket
+import httplib
+import urllib2
+import threading
+from log import log
+
+MAX_IDLE_PER_HOST = 4
+
+class ConnectionPool(object):
+    '''Idle httplib connections, keyed by host:port.'''
+    def __init__(self, maxIdlePerHost=MAX_IDLE_PER_HOST):
+        self.maxIdlePerHost = maxIdlePerHost
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, host):
+        '''Return an idle connection to host or None if there are none.'''
+        self._lock.acquire()
+        try:
+            conns = self._idle.get(host)
+            if conns:
+                return conns.pop()
+            return None
+        finally:
+            self._lock.release()
+
+    def put(self, host, conn):
+        self._lock.acquire()
+        try:
+            conns = self._idle.setdefault(host, [])
+            if len(conns) < self.maxIdlePerHost:
+                conns.append(conn)
+                return
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def closeAll(self):
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = {}
+        finally:
+            self._lock.release()
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+class _ResponseFile(socket._fileobject):
+    '''The file object handed back to urllib2 callers.  Closing it decides
+    whether the underlying connection can be reused.'''
+    def __init__(self, response, onClose):
+        socket._fileobject.__init__(self, response)
+        self._onClose = onClose
+
+    def close(self):
+        try:
+            socket._fileobject.close(self)
+        finally:
+            if self._onClose:
+                self._onClose()
+                self._onClose = None
+
+
+class KeepAliveHandler(urllib2.HTTPHandler):
+    def __init__(self, pool=None):
+        urllib2.HTTPHandler.__init__(self)
+        if pool is None:
+            pool = ConnectionPool()
+        self.pool = pool
+
+    def _request(self, conn, req):
+        headers = dict(req.headers)
+        headers.update(getattr(req, 'unredirected_hdrs', {}))
+        headers['Connection'] = 'keep-alive'
+        conn.request(req.get_method(), req.get_selector(), req.get_data(),
+                     headers)
+        return conn.getresponse()
+
+    def http_open(self, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        conn = self.pool.get(host)
+        reused = conn is not None
+        if not reused:
+            conn = httplib.HTTPConnection(host)
+
+        try:
+            response = self._request(conn, req)
+        except (socket.error, httplib.HTTPException), ex:
+            conn.close()
+            if not reused:
+                raise urllib2.URLError(ex)
+            # The server most likely timed out the idle connection.
+            log.debug('kept-alive connection to %s went stale (%s)' %
+                      (host, str(ex)))
+            conn = httplib.HTTPConnection(host)
+            try:
+                response = self._request(conn, req)
+            except (socket.error, httplib.HTTPException), ex:
+                conn.close()
+                raise urllib2.URLError(ex)
+
+        def release():
+            if response.isclosed() and not response.will_close:
+                self.pool.put(host, conn)
+            else:
+                conn.close()
+
+        # Same trick urllib2.AbstractHTTPHandler.do_open() uses to get a
+        # buffered file object out of the HTTPResponse.
+        response.recv = response.read
+        fp = _ResponseFile(response, release)
+        resp = urllib2.addinfourl(fp, response.msg, req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+        return resp
+
+
+_handler = None
+def getHandler():
+    '''factory function'''
+    global _handler
+    if not _handler:
+        _handler = KeepAliveHandler()
+    return _handler
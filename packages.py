@@ -40,10 +40,14 @@ import consts
 import systemsettings
 import userchoices
 from remote_files import downloadLocally, isURL, URLify, getCacher
+from remote_files import ContentStore, isDirectReadable, getDirectPath
 from remote_files import HTTPError, URLError, RemoteFileError
+from remote_files import prepareRemoteAccess
 from log import log
 from util import SIZE_MB
 from exception import InstallationError
+from workerpool import WorkerPool, parallelMap
+import depotindex
 
 import workarounds
 
@@ -53,6 +57,9 @@ DB_PATH = os.path.join(consts.HOST_ROOT, "var/lib/rpm")
 
 REQUIREMENT_OPTIONS = ("required", "recommended", "optional")
 
+# Number of header fragments to download at the same time.
+HEADER_FETCH_WORKERS = 8
+
 # Whiteout list for erasing dependencies to break dependency loops.  The format
 # is:
 #
@@ -154,12 +161,34 @@ class PackageData(object):
        Accessible attributes:
            .fileDict : dictionary of unpacked directory sizes
            .headerSizes : dictionary of begin/end/header sizes for each pkg
+           .digests : dictionary of "algorithm:hexdigest" for each pkg, only
+                      filled in by newer depots
     '''
     def __init__(self, baseLocation):
         self.headerDict = {}
-        fileName = self._getLocalPath(baseLocation)
-
-        self.getHeaderData(fileName)
+        self.digests = {}
+        self.baseLocation = baseLocation
+        self._fileDict = None
+        self._packageDataFile = None
+        self._headerIndex = None
+        self._headerIndexChecked = False
+
+        # Depots built by older versions of createinstdepot.py only have the
+        # pickle.
+        try:
+            fileName = self._getLocalPath(baseLocation,
+                                          depotindex.PACKAGE_DATA_NAME,
+                                          maxAttempts=1)
+            self.getPackageData(fileName)
+        except (ValueError, IOError, depotindex.DepotIndexError), ex:
+            log.info('Falling back to packageData.pkl (%s)' % str(ex))
+            fileName = self._getLocalPath(baseLocation)
+            self.getHeaderData(fileName)
+
+    def getPackageData(self, fileName):
+        self._packageDataFile = depotindex.PackageDataFile(fileName)
+        self.headerDict = self._packageDataFile.headerSizes
+        self.digests = self._packageDataFile.digests
 
     def getHeaderData(self, fileName):
         f = open(fileName, 'r')
@@ -167,23 +196,63 @@ class PackageData(object):
         f.close()
 
         self.headerDict = rpmDict['headerSizes']
-        self.fileDict = rpmDict['fileSizes']
+        self._fileDict = rpmDict['fileSizes']
+
+    def _getFileDict(self):
+        # Only the partitioning code needs this, so don't read it in until
+        # it is asked for.
+        if self._fileDict is None:
+            self._fileDict = dict(self._packageDataFile.fileSizes.iteritems())
+        return self._fileDict
+    fileDict = property(_getFileDict)
+
+    def getHeader(self, basename):
+        '''Return the RPM header for the given package from the depot's
+        header index, or None if the depot does not have one or the package
+        is not in it.'''
+        index = self._getHeaderIndex()
+        if not index:
+            return None
+        blob = index.read(basename)
+        if blob is None:
+            return None
+        return rpm.headerLoad(blob)
+
+    def _getHeaderIndex(self):
+        # Only fetched the first time a header is needed, partitioning uses
+        # this class for the directory sizes and has no use for it.
+        if self._headerIndexChecked:
+            return self._headerIndex
+        self._headerIndexChecked = True
 
-    def _getLocalPath(self, baseLocation):
+        try:
+            fileName = self._getLocalPath(self.baseLocation,
+                                          depotindex.HEADER_INDEX_NAME,
+                                          maxAttempts=1)
+            self._headerIndex = depotindex.HeaderIndex(fileName)
+            log.info('Using the header index for %d packages' %
+                     len(self._headerIndex))
+        except (ValueError, IOError, depotindex.DepotIndexError), ex:
+            log.info('No usable header index in %s (%s), reading the headers '
+                     'from the packages' % (self.baseLocation, str(ex)))
+        return self._headerIndex
+
+    def _getLocalPath(self, baseLocation, fileName='packageData.pkl',
+                      maxAttempts=None):
         baseLocation = URLify(baseLocation)
 
-        placesToTry = [urljoin(baseLocation, 'packageData.pkl')]
+        placesToTry = [urljoin(baseLocation, fileName)]
 
         for place in placesToTry:
             log.debug('Looking for %s' % place)
             try:
-                filename = downloadLocally(place)
+                filename = downloadLocally(place, maxAttempts=maxAttempts)
                 return filename
             except (HTTPError, URLError, IOError, RemoteFileError):
                 continue
 
-        raise ValueError('Could not find packageData.pkl file under %s'
-                         % baseLocation)
+        raise ValueError('Could not find %s file under %s'
+                         % (fileName, baseLocation))
 
 # -----------------------------------------------------------------------------
 class PackagesXML(object):
@@ -337,6 +406,7 @@ class Packages:
         self.ts = None
         self.totalSize = 0
         self.packages = []
+        self.packageData = None
         self.currentHeader = ""
         self.uiHook = None
 
@@ -350,6 +420,8 @@ class Packages:
         if not weaselConfig:
             weaselConfig = systemsettings.WeaselConfig()
         self.packageGroups = weaselConfig.packageGroups
+        self.prefetchDepth = weaselConfig.prefetchDepth
+        self.prefetchBudget = weaselConfig.prefetchBudgetMB * SIZE_MB
 
     def initializeDB(self):
         # create the dir
@@ -361,7 +433,7 @@ class Packages:
         packagesXML = getPackagesXML(self.packageGroups)
 
         packageData = PackageData(packagesXML.fullInstallDepot)
-        
+        self.packageData = packageData
 
         for basename, requirement in packagesXML.rpmBasenames:
             #TODO: know which sep to use here, os.path.sep or '/'
@@ -393,7 +465,8 @@ class Packages:
                                   hdrStart,
                                   hdrEnd,
                                   pkgSize,
-                                  pkgName)
+                                  pkgName,
+                                  packageData.digests.get(basename))
                 self.packages.append(package)
             except KeyError:
                 msg = ('Encountered an error while creating the packages list.'
@@ -442,9 +515,36 @@ class Packages:
 
         return stillUnresolved
         
+    def loadHeaders(self, numWorkers=HEADER_FETCH_WORKERS):
+        '''Get the headers for all of the packages at once instead of one at a
+        time when Package.header is first touched.  The depot's header index
+        is used if it has one, otherwise the header fragments are fetched
+        from the packages in parallel.  The workers only download, the
+        network is set up beforehand and the headers are parsed here.'''
+        needed = [pkg for pkg in self.packages if not pkg.hasHeader()]
+        if needed and self.packageData:
+            for pkg in needed:
+                header = self.packageData.getHeader(pkg.basename)
+                if header:
+                    pkg.setHeader(header)
+            needed = [pkg for pkg in needed if not pkg.hasHeader()]
+        if not needed:
+            return
+
+        log.info("Fetching %d package headers" % len(needed))
+        prepareRemoteAccess([pkg.fullSrcPath for pkg in needed])
+        parallelMap(Package.fetchHeaderFragment, needed, numWorkers,
+                    'headers')
+
+        # rpmlib is not thread-safe, so parse the headers in this thread.
+        for pkg in needed:
+            pkg.parseHeaderFragment()
+
     def installPackages(self):
         #self.ts.setProbFilter(rpm.RPMPROB_FILTER_DISKSPACE)
 
+        self.loadHeaders()
+
         # CPD - magic setColor(3) method which fixes all of your RPM woes.
         #       this actually tells rpmlib to allow both i386 and x86_64
         #       rpms.
@@ -467,8 +567,6 @@ class Packages:
             else:
                 log.info("skipping optional package %s" % package.name)
 
-        cb = InstallCallback(self.totalSize, len(self.packages), self.uiHook)
-
         while True:
             unsatisfiedDeps = self.ts.check(dependencyCheckCallback)
             if not unsatisfiedDeps:
@@ -492,13 +590,42 @@ class Packages:
 
         log.info(buf)
 
+        directRead = userchoices.getDirectRead()
+        installOrder = self._getInstallOrder()
+        if directRead:
+            # Packages that are read in place don't need to be fetched.
+            installOrder = [pkg for pkg in installOrder
+                            if not pkg.isDirectReadable()]
+
+        prefetcher = None
+        if self.prefetchDepth > 0 and installOrder:
+            prefetcher = PackagePrefetcher(installOrder,
+                                           self.prefetchDepth,
+                                           self.prefetchBudget)
+        cb = InstallCallback(self.totalSize, len(self.packages), self.uiHook,
+                             prefetcher=prefetcher, directRead=directRead)
+
         if self.uiHook:
             self.uiHook.pushStatusGroup(self.totalSize)
-        self.ts.run(cb.runCallback, 0)
+        try:
+            self.ts.run(cb.runCallback, 0)
+        finally:
+            if prefetcher:
+                prefetcher.shutdown()
         self.checkForProblems()
         if self.uiHook:
             self.uiHook.popStatusGroup()
 
+    def _getInstallOrder(self):
+        '''Return the Package objects in the order rpmlib will open them,
+        which is only known after ts.order() has been called.'''
+        retval = []
+        for rpmPkg in self.ts:
+            callbackArgs = rpmPkg.Key()
+            if callbackArgs and isinstance(callbackArgs[0], Package):
+                retval.append(callbackArgs[0])
+        return retval
+
     def checkForProblems(self):
         # XXX Do more than just logging here.
         problems = self.ts.problems()
@@ -508,15 +635,107 @@ class Packages:
                 log.error(' %s' % prob)
 
 
+# -----------------------------------------------------------------------------
+class PackagePrefetcher:
+    '''Downloads the packages that rpmlib is going to ask for next while it is
+    busy unpacking the current one.
+
+    At most 'depth' packages are downloaded at a time and the packages that
+    are sitting in the cache, but have not been released yet, are kept under
+    'budget' bytes so that a small /mnt/sysimage does not fill up.  The
+    package that rpmlib needs next is always allowed, even if it is bigger
+    than the budget.
+
+    Only the download happens in the background, InstallCallback still does
+    all of the progress reporting from the main thread.  The network and NFS
+    mount are set up here, before the workers start, so the workers only
+    read.  If that fails nothing is prefetched and fetch() downloads each
+    package in the foreground, where the error is handled as usual.
+    '''
+
+    def __init__(self, packages, depth=4, budget=400 * SIZE_MB):
+        self.depth = depth
+        self.budget = budget
+        self.pending = list(packages)
+        self.jobs = {}
+        self.outstanding = 0
+        try:
+            prepareRemoteAccess([pkg.fullSrcPath for pkg in self.pending])
+        except Exception, e:
+            log.warn("not prefetching packages, the remote media could not "
+                     "be set up (%s)" % str(e))
+            self.pending = []
+        self.pool = WorkerPool(depth, 'prefetch')
+        self._fill()
+
+    def _fill(self):
+        while self.pending and len(self.jobs) < self.depth:
+            package = self.pending[0]
+            if self.jobs and self.outstanding + package.pkgSize > self.budget:
+                break
+            self.pending.pop(0)
+            self.outstanding += package.pkgSize
+            self.jobs[package] = self.pool.submit(package.ensureFileDownloaded)
+
+    def fetch(self, package):
+        '''Wait for the given package to be completely downloaded.'''
+        job = self.jobs.get(package)
+        if job is None:
+            # rpmlib asked for something out of order, just get it directly.
+            if package in self.pending:
+                self.pending.remove(package)
+                self.outstanding += package.pkgSize
+            self.jobs[package] = None
+            package.ensureFileDownloaded()
+            return
+
+        try:
+            job.result()
+        except (RemoteFileError, EnvironmentError), e:
+            # try again in the foreground so any errors get handled the
+            # same way as when there is no prefetching
+            log.warn("background download of %s failed (%s), retrying" %
+                     (package.fullSrcPath, str(e)))
+            package.ensureFileDownloaded()
+
+    def release(self, package):
+        '''Called after the package has been installed and its file deleted
+        so that more packages can be downloaded.'''
+        if package in self.jobs:
+            del self.jobs[package]
+            self.outstanding -= package.pkgSize
+        self._fill()
+
+    def shutdown(self):
+        '''Stop prefetching.  The downloads that haven't started are
+        cancelled and the ones in progress are waited for, so nothing is
+        still writing into the cache when it is cleaned up.  Whatever was
+        downloaded for packages that were never installed is deleted.'''
+        self.pending = []
+        for job in self.jobs.values():
+            if job:
+                job.cancel()
+        self.pool.shutdown(wait=True)
+
+        for package in self.jobs.keys():
+            package.discardDownload()
+        self.jobs = {}
+        self.outstanding = 0
+
+
 # -----------------------------------------------------------------------------
 class InstallCallback:
-    def __init__(self, totalSize, totalCount, uiHook=None, scale=0.8):
+    def __init__(self, totalSize, totalCount, uiHook=None, scale=0.8,
+                 prefetcher=None, directRead=False):
         self.totalSize = totalSize
         self.totalCount = totalCount
         self.uiHook = uiHook
         self.scale = scale
         self.rpmFd = None
+        self.rpmFdInPlace = False
         self.packageCounter = 0
+        self.prefetcher = prefetcher
+        self.directRead = directRead
 
 
     def runCallback(self, reason, amount, total, callbackArgs, param):
@@ -555,7 +774,16 @@ class InstallCallback:
             amount =  package.header[rpm.RPMTAG_SIZE] / SIZE_MB
             self.uiHook.pushStatus(buf, amount)
 
-        package.ensureFileDownloaded()
+        if self.directRead and package.isDirectReadable():
+            self.rpmFd = package.openInPlace()
+            if self.rpmFd is not None:
+                self.rpmFdInPlace = True
+                return self.rpmFd
+
+        if self.prefetcher:
+            self.prefetcher.fetch(package)
+        else:
+            package.ensureFileDownloaded()
         self.rpmFd = os.open(package.localLocation, os.O_RDONLY)
         return self.rpmFd
 
@@ -564,7 +792,12 @@ class InstallCallback:
 
         os.close(self.rpmFd)
         self.rpmFd = None
-        package.deleteDownloadedFile() # recover space on /mnt/sysimage
+        if self.rpmFdInPlace:
+            self.rpmFdInPlace = False
+        else:
+            package.deleteDownloadedFile() # recover space on /mnt/sysimage
+            if self.prefetcher:
+                self.prefetcher.release(package)
 
         if self.uiHook:
             self.uiHook.popStatus()
@@ -644,7 +877,7 @@ class Package(object):
 
     def __init__(self, fullSrcPath, requirement,
                  headerStartByte=0, headerEndByte=0, pkgSize=0,
-                 name=''):
+                 name='', digest=None):
 
         # we want to download even the CD-ROM media to /mnt/sysimage/tmp so 
         # that we can avoid hassles with ILO/DRAC
@@ -652,6 +885,7 @@ class Package(object):
         self.requirement = requirement
         self.pkgSize = pkgSize
         self.name = name
+        self.digest = digest
         self._headerLength = headerStartByte + headerEndByte
 
         # lookup the header info if we're missing the package name
@@ -699,23 +933,75 @@ class Package(object):
         return os.path.basename(self.fullSrcPath)
     basename = property(_getBasename)
 
-    def _downloadHeaderFragment(self):
+    def isDirectReadable(self):
+        return isDirectReadable(self.fullSrcPath)
+
+    def openInPlace(self):
+        '''Open the package where it is, on the CD or NFS server, instead of
+        copying it to /mnt/sysimage first.  Returns a file descriptor, or
+        None if the package can not be read in place, in which case the
+        caller should fall back to downloading it.'''
+        try:
+            path = getDirectPath(self.fullSrcPath)
+            if self.pkgSize and os.path.getsize(path) != self.pkgSize:
+                log.warn('%s is not the expected size, copying it instead' %
+                         path)
+                return None
+            fd = os.open(path, os.O_RDONLY)
+        except Exception, ex:
+            log.warn('Could not open %s in place (%s), copying it instead' %
+                     (self.fullSrcPath, str(ex)))
+            return None
+        log.debug('Reading %s in place' % path)
+        # the header fragment in the cache won't be needed anymore
+        getCacher().clobber(self.fullSrcPath)
+        return fd
+
+    def hasHeader(self):
+        return self._header is not None
+
+    def setHeader(self, header):
+        self._header = header
+
+    def fetchHeaderFragment(self):
+        '''Download just enough of the package to read the header.  This only
+        does I/O, so it is safe to call from a worker thread.'''
         self._localLocation = downloadLocally(self.fullSrcPath,
                                               self._headerLength)
-        self._header = self.readRPMHeader(self.localLocation)
+        return self._localLocation
+
+    def parseHeaderFragment(self):
+        self._header = self.readRPMHeader(self._localLocation)
+
+    def _downloadHeaderFragment(self):
+        self.fetchHeaderFragment()
+        self.parseHeaderFragment()
 
     def ensureFileDownloaded(self):
         if self._finishedDownloading:
             return True
         self._localLocation = downloadLocally(self.fullSrcPath,
-                                    integrityChecker=self.integrityChecker)
+                                    integrityChecker=self.integrityChecker,
+                                    digest=self.digest)
         self._finishedDownloading = True
         return True
 
+    def discardDownload(self):
+        '''Delete the downloaded file, or whatever part of it was downloaded
+        before the download failed or was interrupted.'''
+        if self._finishedDownloading:
+            self.deleteDownloadedFile()
+        else:
+            getCacher().clobber(self.fullSrcPath)
+            self._localLocation = None
+
     def deleteDownloadedFile(self):
-        log.debug('Deleting temporary file %s' % self._localLocation)
         self._finishedDownloading = False
-        os.remove(self._localLocation)
+        if getCacher().isPersistent(self._localLocation):
+            log.debug('Keeping cached file %s' % self._localLocation)
+        else:
+            log.debug('Deleting temporary file %s' % self._localLocation)
+            os.remove(self._localLocation)
         self._localLocation = None
 
 
@@ -732,10 +1018,27 @@ def hostActionInstallPackages(context):
             os.makedirs(cacheDir)
         cacher.setCacheLocation(cacheDir, 'orphan')
 
+    cacheChoice = userchoices.getPackageCache()
+    if cacheChoice and not cacher.getContentStore():
+        try:
+            cacher.setContentStore(
+                ContentStore(cacheChoice['packageCache']))
+        except RemoteFileError, ex:
+            log.warn('Not using the package cache: %s' % str(ex))
+
     pkg = Packages(uiHook=context.cb)
     pkg.initializeDB()
     pkg.readPackages()
 
+    store = cacher.getContentStore()
+    if store and cacheChoice.get('seedDirectory'):
+        try:
+            store.importDirectory(cacheChoice['seedDirectory'],
+                                  pkg.packageData.digests)
+        except (IOError, OSError), ex:
+            log.warn('Could not seed the package cache from %s: %s' %
+                     (cacheChoice['seedDirectory'], str(ex)))
+
     rpmLog = open("/var/log/rpm.log", 'a+')
     try:
         # rpm.setVerbosity(rpm.RPMLOG_DEBUG)
@@ -30,6 +30,8 @@ import userchoices
 import systemsettings
 import consts
 import vmkctl
+import threading
+import workerpool
 
 from copy import copy
 from log import log
@@ -47,6 +49,20 @@ METADATA = 8
 PROTECTED = 16
 
 MAX_PRIMARY_PARTITIONS = 4
+
+# New partitions start on a multiple of this many bytes, which keeps them
+# lined up with the stripes and pages of the underlying storage.  Devices
+# that report a larger or odd-sized optimal I/O size get aligned to a
+# multiple of that as well.
+PARTITION_ALIGNMENT = 1024 * 1024
+
+# Some devices report nonsense I/O sizes, an alignment that works out to more
+# than this is not believed and PARTITION_ALIGNMENT is used instead.
+MAX_PARTITION_ALIGNMENT = 16 * 1024 * 1024
+
+# The most file systems that are created at the same time, each on a
+# different disk.
+FORMAT_WORKERS = 4
 MAX_PARTITIONS = 13
 
 DEFAULT_PHYSICAL_REQUESTS = [
@@ -444,7 +460,8 @@ class PartitionRequest(Partition):
     def __init__(self, mountPoint=None, fsType=None, drive=None,
                  minimumSize=0, maximumSize=0, grow=False,
                  primaryPartition=False, badBlocks=False,
-                 consoleDevicePath="", clearContents=False):
+                 consoleDevicePath="", clearContents=False,
+                 inodeRatio=None, journalSizeMB=None):
         # XXX - don't call this or the nosetests will fail
         #assert fsType is None or isinstance(fsType, fsset.FileSystemType)
         
@@ -452,6 +469,13 @@ class PartitionRequest(Partition):
         self.fsType = fsType
         if self.mountPoint == "/":
             self.fsType.label = consts.ESX_ROOT_LABEL
+
+        # Format tuning for this mount point, passed along to the ext
+        # file systems that know what to do with it.
+        if inodeRatio and hasattr(self.fsType, 'inodeRatio'):
+            self.fsType.inodeRatio = inodeRatio
+        if journalSizeMB and hasattr(self.fsType, 'journalSizeMB'):
+            self.fsType.journalSizeMB = journalSizeMB
         
         self.apparentSize = 0
         self.minimumSize = minimumSize
@@ -598,6 +622,13 @@ class PartitionRequestSet:
         return self.device.partitions.getPartitions(showFreeSpace=True,
                                                     showUsedSpace=False)
 
+    def _addExtendedPartition(self, startSector, endSector):
+        partitionSet = self.device.partitions
+        newPartition = partitionSet.partedDisk.partition_new(EXTENDED, None,
+                           startSector, endSector)
+        newConstraint = partitionSet.partedDevice.constraint_any()
+        partitionSet.partedDisk.add_partition(newPartition, newConstraint)
+
     def _addPartition(self, partitionType, fsType, startSector, endSector,
                       partReq):
         partitionSet = self.device.partitions
@@ -611,6 +642,15 @@ class PartitionRequestSet:
         newConstraint = partitionSet.partedDevice.constraint_any()
         partitionSet.partedDisk.add_partition(newPartition, newConstraint)
 
+        # The start was aligned by _planPartitions(), a partition that parted
+        # had to move would not be aligned anymore.
+        if newPartition.geom.start != startSector:
+            raise ValueError, ("Partition %d on %s was moved from sector "
+                               "%d to %d" % (newPartition.num,
+                                             self.device.name,
+                                             startSector,
+                                             newPartition.geom.start))
+
         partReq.consoleDevicePath = joinPath(partitionSet.partedDevice.path,
                                              newPartition.num)
 
@@ -659,9 +699,209 @@ class PartitionRequestSet:
 
             totalRemainingSize -= entry.apparentSize
 
+    def _getAlignment(self):
+        '''Return the number of sectors that partition starts are aligned to
+        and the offset, in sectors, of the first aligned sector on the
+        device.'''
+        sectorSize = self.device.sectorSize
+        alignment = PARTITION_ALIGNMENT
+        offset = 0
+
+        if hasattr(self.device, 'getIOLimits'):
+            limits = self.device.getIOLimits()
+            physicalBlockSize = limits['physicalBlockSize']
+            if physicalBlockSize <= 0 or physicalBlockSize % sectorSize:
+                physicalBlockSize = sectorSize
+            alignment = util.lcm(alignment, physicalBlockSize)
+
+            # The I/O sizes have to be made of whole physical blocks, the
+            # ones that aren't are bogus and left out.
+            for name in ('minimumIOSize', 'optimalIOSize'):
+                size = limits[name]
+                if size <= 0:
+                    continue
+                if size % physicalBlockSize:
+                    log.warn("ignoring %s of %d bytes for %s, it is not a "
+                             "multiple of the %d byte physical block size" %
+                             (name, size, self.device.name,
+                              physicalBlockSize))
+                    continue
+                alignment = util.lcm(alignment, size)
+
+            if alignment > MAX_PARTITION_ALIGNMENT:
+                log.warn("ignoring the I/O limits of %s, they work out to an "
+                         "alignment of %d bytes" %
+                         (self.device.name, alignment))
+                alignment = PARTITION_ALIGNMENT
+            else:
+                offset = limits['alignmentOffset']
+
+        align = max(1, alignment / sectorSize)
+        return (align, (offset / sectorSize) % align)
+
+    def _planPartitions(self, primaryPartitions, extendedPartition):
+        '''Work out where each request goes on the device, without touching
+        the partition table.
+
+        The free space is read once.  Fixed size requests go in the smallest
+        free region they fit in and growable ones go in the largest.  Once
+        every request has a region, the space left in each region is handed
+        out to its growable requests: the ones with a maximum size get up to
+        that size first, the rest is split evenly between the ones without.
+        Partition starts are aligned to _getAlignment() sectors.
+
+        Each logical partition needs an extended boot record in front of it,
+        so one alignment unit is left free before every logical partition,
+        including the first one in a new extended partition.
+
+        Returns a list of (partitionType, startSector, endSector, request)
+        tuples in disk order.  The request is None for a new extended
+        partition.
+        '''
+        align, offset = self._getAlignment()
+        sectorSize = self.device.sectorSize
+
+        def alignUp(sector):
+            return ((sector - offset + align - 1) / align) * align + offset
+
+        # lengths are rounded to whole alignment units, so each partition
+        # that follows an aligned one is aligned as well
+        def roundUp(length):
+            return ((length + align - 1) / align) * align
+
+        def alignDown(length):
+            return (length / align) * align
+
+        regions = []
+        for space in self._findFreeSpace():
+            start = alignUp(space.startSector)
+            if space.endSector + 1 - start < align:
+                continue
+            regions.append({ 'start' : start,
+                             'end' : space.endSector,
+                             'logical' : bool(space.partitionType & LOGICAL),
+                             'extended' : False,
+                             'used' : 0L,
+                             'requests' : [] })
+
+        def available(region):
+            return alignDown(region['end'] + 1 - region['start']) - \
+                   region['used']
+
+        # Pick a region and a partition type for each request.
+        for entry in self.requests:
+            minLength = roundUp(long(util.getValueInSectorsFromMegabyes(
+                entry.minimumSize, sectorSize)))
+
+            if entry.primaryPartition or \
+                    (not extendedPartition and primaryPartitions < 2):
+                partitionType = PRIMARY
+                candidates = [region for region in regions
+                              if not region['logical'] and \
+                              not region['extended']]
+            elif extendedPartition:
+                partitionType = LOGICAL
+                candidates = [region for region in regions
+                              if region['logical'] or region['extended']]
+            else:
+                # The rest of the largest primary region becomes an extended
+                # partition to hold this and the following requests.
+                partitionType = LOGICAL
+                candidates = [region for region in regions
+                              if not region['logical']]
+                candidates.sort(lambda x, y: cmp(available(y),
+                                                 available(x)))
+                candidates = candidates[:1]
+
+            # room for the extended boot record
+            cost = minLength
+            if partitionType == LOGICAL:
+                cost += align
+
+            candidates = [region for region in candidates
+                          if available(region) >= cost]
+            if not candidates:
+                raise ValueError, ("Couldn't find a spot for the " + \
+                                   "requested partition.")
+
+            if entry.grow:
+                candidates.sort(lambda x, y: cmp(available(y),
+                                                 available(x)))
+            else:
+                candidates.sort(lambda x, y: cmp(available(x),
+                                                 available(y)))
+            region = candidates[0]
+
+            if partitionType == LOGICAL and not extendedPartition:
+                region['extended'] = True
+                extendedPartition += 1
+                primaryPartitions += 1
+            elif partitionType == PRIMARY:
+                primaryPartitions += 1
+
+            region['used'] += cost
+            region['requests'].append([entry, partitionType, minLength])
+
+        if primaryPartitions > MAX_PRIMARY_PARTITIONS:
+            raise ValueError, "Can't have more than %d primary partitions" % \
+                MAX_PRIMARY_PARTITIONS
+
+        # Hand out the rest of the space in each region and lay it out.
+        plan = []
+        for region in regions:
+            if not region['requests']:
+                continue
+
+            remaining = available(region)
+            uncapped = []
+            for planned in region['requests']:
+                entry = planned[0]
+                if not entry.grow:
+                    continue
+                if entry.maximumSize:
+                    maxLength = alignDown(long(
+                        util.getValueInSectorsFromMegabyes(entry.maximumSize,
+                                                           sectorSize)))
+                    extra = max(0, min(maxLength - planned[2], remaining))
+                    planned[2] += extra
+                    remaining -= extra
+                else:
+                    uncapped.append(planned)
+
+            for index, planned in enumerate(uncapped):
+                if index == len(uncapped) - 1:
+                    # the last one picks up what is left over from rounding
+                    extra = remaining
+                else:
+                    extra = alignDown(remaining / (len(uncapped) - index))
+                planned[2] += extra
+                remaining -= extra
+
+            start = region['start']
+            needsExtended = region['extended']
+            for entry, partitionType, length in region['requests']:
+                if partitionType == LOGICAL and needsExtended:
+                    plan.append((EXTENDED, start, region['end'], None))
+                    needsExtended = False
+                if partitionType == LOGICAL:
+                    start += align
+                end = start + length - 1
+                if uncapped and entry is region['requests'][-1][0] and \
+                        entry is uncapped[-1][0]:
+                    end = region['end']
+                plan.append((partitionType, start, end, entry))
+                start = end + 1
+
+        plan.sort(lambda x, y: cmp(x[1], y[1]) or cmp(x[0] != EXTENDED,
+                                                      y[0] != EXTENDED))
+        return plan
+
     def fitPartitionsOnDevice(self):
-        '''Try to fit partition requests on to a given disk.'''
-        growToMax = 0
+        '''Try to fit partition requests on to a given disk.
+
+        The layout for all of the requests is planned up front, see
+        _planPartitions(), and then added to the partition table in one go.
+        '''
         primaryPartitions = 0
         primaryRequests = 0
         extendedPartition = 0
@@ -685,8 +925,6 @@ class PartitionRequestSet:
 
         # look through new requests
         for entry in self.requests:
-            if entry.grow and not entry.maximumSize:
-                growToMax += 1
             if entry.primaryPartition:
                 primaryRequests += 1
 
@@ -698,98 +936,28 @@ class PartitionRequestSet:
             raise ValueError, "Can't have more than %d total partitions" % \
                 MAX_PARTITIONS
 
-        for entry in self.requests:
-            length = util.getValueInSectorsFromMegabyes(entry.minimumSize)
-            startSector = -1
-
-            log.debug("Free Space")
-            freeSpace = self._findFreeSpace()
-            log.debug(freeSpace)
-
-            if len(freeSpace) < 1 or freeSpace[0].getLength() < length:
-                raise ValueError, ("Not enough free space, cannot "
-                                   "create partition.")
-
-            # create the extended partition if we need one
-            log.debug("Primary = %d" % (primaryPartitions))
-            if not extendedPartition and not entry.primaryPartition and \
-               primaryPartitions >= 2:
-                partitionType = EXTENDED
-                extendedPartition += 1
-                primaryPartitions += 1
-
-                if len(freeSpace) == 1:
-                    startSector = freeSpace[0].startSector
-                    endSector = freeSpace[0].endSector
-
-                    self._addPartition(partitionType, None, startSector,
-                                       endSector, entry)
-
-                    # reset freespace since we added an extended partition
-                    freeSpace = self._findFreeSpace()
-
-                else:
-                    raise ValueError, "FIXME: Gaps in the freespace"
-
-            foundSpot = False
-            # look for a spot on the disk
-            for space in freeSpace:
-                if length <= space.getLength():
-                    foundSpot = True
-                    log.debug("Found a spot:  %d" % (space.startSector))
-                    startSector = space.startSector
-                    endSector = space.endSector
-
-                    if entry.primaryPartition or not extendedPartition:
-                        partitionType = PRIMARY
-                        primaryPartitions += 1
-                    else:
-                        partitionType = LOGICAL
-
-                    # fixed partition size
-                    if entry.minimumSize and not entry.grow:
-                        space.startSector = space.startSector + length
-
-                    # growable partition w/ max size
-                    elif entry.minimumSize and entry.maximumSize and entry.grow:
-                        maxLength = util.getValueInSectorsFromMegabyes(
-                                        entry.maximumSize)
-
-                        # check to see if the partition is too big
-                        if maxLength > space.getLength():
-                            length = space.getLength()
-                        else:
-                            length = maxLength
-
-                        space.startSector = space.startSector + length
-
-                    # growable partition w/ no max size
-                    else:
-                        log.debug("no max size")
-                        length = space.getLength() / growToMax
-                        space.startSector = space.startSector + length
-                        growToMax -= 1
-
-            if not foundSpot:
-                raise ValueError, ("Couldn't find a spot for the " + \
-                                   "requested partition.")
-
-            # only create the partition if we found a spot
-            if startSector != -1:
-                totalPartitions += 1
-
+        plan = self._planPartitions(primaryPartitions, extendedPartition)
+        for partitionType, startSector, endSector, entry in plan:
+            log.debug("planned partition type=%d start=%d end=%d" %
+                      (partitionType, startSector, endSector))
+            if entry is None:
+                self._addExtendedPartition(startSector, endSector)
+            else:
                 fsType = entry.fsType.partedFileSystemType
                 self._addPartition(partitionType, fsType, startSector,
-                                       startSector + length-1, entry)
-            else:
-                log.debug("Couldn't find a spot!")
+                                   endSector, entry)
 
         self.device.partitions.scanPartitionsOnDevice(requests=self)
         log.debug('partitions are: ' + str(self.device.partitions))
 
+        # The device now has partitions that are not on the disk yet, so a
+        # reprobe needs to read it again instead of reusing this DiskDev.
+        devices.invalidateDisk(self.device.name)
+
     def savePartitions(self):
         if self.device.partitions.partedDisk:
             self.device.partitions.partedDisk.commit()
+            self.device.labelWritten()
 
     def findMinimumRequestSizes(self, sizeDict):
         '''Create a dictionary which contains a list of minimum sizes for
@@ -1162,6 +1330,13 @@ def sanityCheckPartitionRequests(partRequestSetList=None, checkSizing=False):
 def hostActionClearPartitions(context):
     clearParts = userchoices.getClearPartitions()
     if 'drives' in clearParts and 'whichParts' in clearParts:
+        import datastore # Import here to avoid a loop.
+
+        # The volumes on the drives that are about to be cleared, so the
+        # rescan afterwards can wait for them to go away.
+        datastoreSet = datastore.DatastoreSet()
+        goneVolumes = []
+
         # XXX A side-effect of getting the list of vmfs volumes in DatastoreSet
         # is that any existing vmfs volumes will get put into a cache in the
         # kernel.  While in this cache, some SCSI handles are left open which
@@ -1170,6 +1345,7 @@ def hostActionClearPartitions(context):
         # See pr 237236 for more information.
         fsset.flushVmfsVolumes()
         
+        cleared = 0
         context.cb.pushStatusGroup(len(clearParts['drives']))
         for deviceName in clearParts['drives']:
             device = devices.DiskSet()[deviceName]
@@ -1185,18 +1361,98 @@ def hostActionClearPartitions(context):
                 #TODO: finish this for the other options.
                 assert False, "clearPartitions not completely implemented"
             device.partitions.partedDisk.commit() # XXX
+            device.labelWritten()
+            for entry in datastoreSet.getEntriesByDriveName(device.name):
+                goneVolumes += [entry.uuid, entry.name]
+            cleared += 1
             context.cb.popStatus()
         context.cb.popStatusGroup()
 
         # rescan the vmfs volumes in case we need to disconnect any since
         # we have a new partition table
-        fsset.rescanVmfsVolumes()
+        if cleared:
+            fsset.rescanVmfsVolumes(goneVolumes)
         
 
+class FormatScheduler(object):
+    '''Runs formats in the background, one at a time on each disk and on up
+    to FORMAT_WORKERS disks at once.
+
+    Jobs are queued per disk, the first job for a disk starts a worker that
+    keeps running that disk's jobs until its queue is empty.
+    '''
+
+    def __init__(self, numWorkers=FORMAT_WORKERS):
+        self.pool = workerpool.WorkerPool(numWorkers, 'format')
+        self.lock = threading.Lock()
+        self.queues = {}
+
+    def submit(self, diskName, func, *args):
+        '''Queue func(*args) to run after the other jobs for diskName.
+        Returns the workerpool.Job for it.'''
+        job = workerpool.Job(func, args, {})
+
+        self.lock.acquire()
+        try:
+            queue = self.queues.setdefault(diskName, [])
+            queue.append(job)
+            startWorker = (len(queue) == 1)
+        finally:
+            self.lock.release()
+
+        if startWorker:
+            self.pool.submit(self._runQueue, diskName)
+        return job
+
+    def _runQueue(self, diskName):
+        self.lock.acquire()
+        try:
+            job = self.queues[diskName][0]
+        finally:
+            self.lock.release()
+
+        while job:
+            job.run()
+
+            self.lock.acquire()
+            try:
+                queue = self.queues[diskName]
+                queue.pop(0)
+                if queue:
+                    job = queue[0]
+                else:
+                    del self.queues[diskName]
+                    job = None
+            finally:
+                self.lock.release()
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+
+def _waitForFormats(context, diskDesc, jobs):
+    '''Report the progress of the format jobs for one disk, in order, as
+    they finish.  The progress callback is only used from this thread.'''
+    context.cb.pushStatus("Formatting %s" % diskDesc)
+    context.cb.pushStatusGroup(len(jobs))
+    for path, job in jobs:
+        context.cb.pushStatus("Formatting %s" % path)
+        job.result()
+        context.cb.popStatus()
+    context.cb.popStatusGroup()
+    context.cb.popStatus()
+
 def hostActionPartitionPhysicalDevices(context):
     requestDevices = userchoices.getPhysicalPartitionRequestsDevices()
-    context.cb.pushStatusGroup(len(requestDevices))
 
+    # There's two steps for each device, partitioning it and formatting the
+    # parts.  Every device is partitioned first, on this thread, since
+    # parted, mkblkdevs and vmkctl can't run alongside the formats.  Then the
+    # formats run in the background so the disks are formatted at the same
+    # time.
+    context.cb.pushStatusGroup(len(requestDevices) * 2)
+
+    formats = []
     for deviceName in requestDevices:
         virtualDevs = \
             userchoices.getVirtualDevicesByPhysicalDeviceName(deviceName)
@@ -1204,16 +1460,16 @@ def hostActionPartitionPhysicalDevices(context):
         requests = userchoices.getPhysicalPartitionRequests(deviceName)
         context.cb.pushStatus("Partitioning %s (%s)" % (
             requests.device.name, requests.device.path))
-        
+
         requests.sort()
         requests.fitPartitionsOnDevice()
         requests.savePartitions()
 
         # TODO: check for badblocks?
-        
+
         createDeviceNodes()
 
-        context.cb.pushStatusGroup(len(requests))
+        paths = []
         for request in requests:
             if request.fsType.formattable:
                 if request.fsType.name == "vmfs3":
@@ -1225,8 +1481,8 @@ def hostActionPartitionPhysicalDevices(context):
                     # we have a virtual device, then we need to set
                     # the volume name for autopartitioning.
 
-                    # XXX - we're assuming that we only have one vmfs device
-                    # per volume right now
+                    # XXX - we're assuming that we only have one vmfs
+                    # device per volume right now
 
                     if virtualDevs and not volumeName:
                         volumeName = fsset.findVmfsVolumeName()
@@ -1237,12 +1493,29 @@ def hostActionPartitionPhysicalDevices(context):
                         virtualDevs[0]['device'].vmfsVolume = volumeName
                 else:
                     path = request.consoleDevicePath
-                
-                context.cb.pushStatus("Formatting %s" % path)
-                request.fsType.formatDevice(path)
-                context.cb.popStatus()
-        context.cb.popStatusGroup()
+
+                paths.append((path, request.fsType))
         context.cb.popStatus()
+
+        formats.append((requests.device, paths))
+
+    scheduler = FormatScheduler()
+    try:
+        pending = []
+        for device, paths in formats:
+            jobs = []
+            for path, fsType in paths:
+                jobs.append((path, scheduler.submit(device.name,
+                                                    fsType.formatDevice,
+                                                    path)))
+            pending.append(("%s (%s)" % (device.name, device.path), jobs))
+
+        for diskDesc, jobs in pending:
+            _waitForFormats(context, diskDesc, jobs)
+    finally:
+        # Let any formats that are still going finish before bailing out.
+        scheduler.shutdown()
+
     context.cb.popStatusGroup()
 
 def hostActionPartitionVirtualDevices(context):
@@ -29,6 +29,9 @@ import libxml2
 import operator
 import commands
 from grubupdate import findDeviceForPath, splitPath
+from esxconffile import getEsxConf
+from migrateplan import estimateMigration
+from migrateplan import PATHS_TO_MIGRATE_PRE_PACKAGES, PATHS_TO_MIGRATE
 
 # TODO: Fill in with real sizes
 BOOT_MIN_SIZE = 50 # MB
@@ -240,14 +243,9 @@ def _parseBlockDevices(devicesText):
 
 def _getSystemUuid():
     try:
-        esxconf = open("/etc/vmware/esx.conf")
-        try:
-            for line in esxconf:
-                m = re.match('/system/uuid = "([\w-]+)"', line)
-                if m:
-                    return m.group(1)
-        finally:
-            esxconf.close()
+        uuid = getEsxConf().get('/system/uuid')
+        if uuid and re.match(r'[\w-]+$', uuid):
+            return uuid
     except (OSError, IOError), e:
          sys.stderr.write("error: cannot open esx.conf -- %s\n" % str(e))
          
@@ -299,13 +297,19 @@ def _discountExistingPaths(paths):
     
     return retval / SIZE_MB
 
+def _getMigrationSize():
+    '''Return the size in MB of the configuration files that the upgrade will
+    migrate, rounded up.'''
+    plan = estimateMigration(PATHS_TO_MIGRATE_PRE_PACKAGES + PATHS_TO_MIGRATE)
+    return int(math.ceil(float(plan.totalSize) / SIZE_MB))
+
 def checkStagingStorage():
     st = os.statvfs("/")
 
     # f_bavail is a 64-bit number, so this should not overflow.
     found = (st.f_frsize * st.f_bavail) / SIZE_MB
     found += _discountExistingPaths(EXISTING_UPGRADE_PATHS)
-    expected = ROOT_MIN_SIZE
+    expected = ROOT_MIN_SIZE + _getMigrationSize()
 
     return Result("STAGING_STORAGE", [found], [expected],
                   comparator=operator.ge)
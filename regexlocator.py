@@ -65,4 +65,6 @@ class RegexLocator:
 
     vmdkpath = r'((?:[^/]+/)+)([^/]+\.vmdk)'
 
+    vmdkdisktype = '((thin)|(zeroedthick)|(eagerzeroedthick))'
+
     uuid = r'(\w{8}-\w{4}-\w{4}-\w{4}-\w{12})'
@@ -36,8 +36,13 @@ import socket
 import errno
 import consts
 import logging
+import threading
 import util
+import time
+import types
+from array import array
 from time import sleep
+from StringIO import StringIO
 from urllib2 import Request, urlopen, URLError, HTTPError
 import urlparse
 # !!!
@@ -54,9 +59,17 @@ from log import log
 from util import execCommand, execWithLog
 import userchoices
 import networking
+import depotindex
+import workerpool
 
 NFS_MOUNTPOINT = '/mnt/nfs'
 
+# Bounds for the amount downloadLocally() reads at a time.  It starts at the
+# top for local and NFS files and near the bottom for network downloads, and
+# then adjusts to how long each read takes.
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+
 class RemoteFileError(Exception): pass
 
 __cacher = None
@@ -68,6 +81,141 @@ def getCacher():
         __cacher = Cacher()
     return __cacher
 
+#------------------------------------------------------------------------------
+def _synchronized(method):
+    '''Decorator for Cacher methods that serializes access to the cache
+    bookkeeping so downloads can run from more than one thread.'''
+    def _wrapper(self, *args, **kwargs):
+        self._lock.acquire()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._lock.release()
+    _wrapper.__name__ = method.__name__
+    _wrapper.__doc__ = method.__doc__
+    return _wrapper
+
+#------------------------------------------------------------------------------
+class ContentStore(object):
+    '''A directory of files that are named by their digest instead of their
+    URL, so that they can be reused by later installs even if the depot has
+    moved.  The files are laid out as root/algorithm/ab/abcdef... and the
+    digests that have been fully verified are listed in root/manifest, one
+    "algorithm:hexdigest size" per line.
+    '''
+    MANIFEST_NAME = 'manifest'
+
+    def __init__(self, root):
+        if not os.path.isdir(root):
+            raise RemoteFileError('Package cache %s is not a directory' % root)
+        self.root = root
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._readManifest()
+
+    def _readManifest(self):
+        manifestPath = os.path.join(self.root, self.MANIFEST_NAME)
+        if not os.path.exists(manifestPath):
+            return
+        for line in open(manifestPath):
+            try:
+                digest, size = line.split()
+                size = long(size)
+            except ValueError:
+                log.warn('Ignoring bad line in %s: %s' %
+                         (manifestPath, line.rstrip()))
+                continue
+            path = self._getPath(digest)
+            if path and os.path.exists(path) and \
+                    os.path.getsize(path) == size:
+                self._entries[digest] = size
+        log.info('Package cache %s has %d files' %
+                 (self.root, len(self._entries)))
+
+    def _getPath(self, digest):
+        try:
+            algorithm, hexdigest = digest.split(':', 1)
+        except ValueError:
+            return None
+        return os.path.join(self.root, algorithm, hexdigest[:2], hexdigest)
+
+    def contains(self, path):
+        root = os.path.join(os.path.abspath(self.root), '')
+        return os.path.abspath(path).startswith(root)
+
+    def lookup(self, digest):
+        '''Return the path to the file with the given digest or None.'''
+        self._lock.acquire()
+        try:
+            if digest not in self._entries:
+                return None
+            path = self._getPath(digest)
+            if not os.path.exists(path):
+                del self._entries[digest]
+                return None
+            return path
+        finally:
+            self._lock.release()
+
+    def add(self, digest, srcPath):
+        '''Put a copy of srcPath, which must already have been verified
+        against digest, into the store.'''
+        path = self._getPath(digest)
+        if not path:
+            return None
+        self._lock.acquire()
+        try:
+            if digest in self._entries:
+                return path
+            try:
+                if not os.path.exists(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                tmpPath = path + '.partial'
+                try:
+                    os.link(srcPath, tmpPath)
+                except OSError:
+                    # different filesystems
+                    shutil.copyfile(srcPath, tmpPath)
+                os.rename(tmpPath, path)
+
+                size = os.path.getsize(path)
+                manifest = open(os.path.join(self.root, self.MANIFEST_NAME),
+                                'a')
+                manifest.write('%s %d\n' % (digest, size))
+                manifest.close()
+            except (IOError, OSError), ex:
+                log.warn('Could not add %s to the package cache (%s)' %
+                         (srcPath, str(ex)))
+                return None
+            self._entries[digest] = size
+            return path
+        finally:
+            self._lock.release()
+
+    def importDirectory(self, dirPath, digests):
+        '''Add the files in dirPath whose basenames are in digests (a
+        mapping of basename to digest), and whose contents match, to the
+        store.  Returns the number of files added.'''
+        count = 0
+        for basename in os.listdir(dirPath):
+            digest = digests.get(basename)
+            if not digest or self.lookup(digest):
+                continue
+            algorithm = digest.split(':', 1)[0]
+            if not depotindex.newHasher(algorithm):
+                continue
+            srcPath = os.path.join(dirPath, basename)
+            if depotindex.fileDigest(srcPath, algorithm) != digest:
+                log.warn('%s does not match the depot, not caching it' %
+                         srcPath)
+                continue
+            if self.add(digest, srcPath):
+                count += 1
+        log.info('Added %d files from %s to the package cache' %
+                 (count, dirPath))
+        return count
+
+
 #------------------------------------------------------------------------------
 class Cacher(object):
     def __init__(self):
@@ -77,10 +225,32 @@ class Cacher(object):
         self._urlToLocalLocation = {}
         self._midstreamFiles = {}
         self._completedFiles = {}
+        # ETag and Last-Modified headers of HTTP downloads, used to ask the
+        # server if a cached copy is still good instead of downloading again.
+        self._validators = {}
+        self._store = None
+        # The package prefetcher downloads different URLs from worker
+        # threads, so the dicts above need to be guarded.
+        self._lock = threading.RLock()
 
     def getCacheLocation(self):
         return self._cacheLocation
 
+    def setContentStore(self, store):
+        '''Files downloaded with a digest are also kept in store, and are
+        taken from it instead of being downloaded if they are already
+        there.'''
+        self._store = store
+
+    def getContentStore(self):
+        return self._store
+
+    def isPersistent(self, path):
+        '''Returns True if the path belongs to the content store and should
+        not be deleted after it has been used.'''
+        return bool(self._store and self._store.contains(path))
+
+    @_synchronized
     def setCacheLocation(self, dirpath, oldFileAction):
         '''Change the directory where cached files are stored.
         oldFileAction is a required string argument:
@@ -119,6 +289,7 @@ class Cacher(object):
         self._completedFiles = newCompletedFiles
         self._urlToLocalLocation = newUrlToLocalLocation
 
+    @_synchronized
     def getLocalLocation(self, url):
         if url in self._urlToLocalLocation:
             return self._urlToLocalLocation[url]
@@ -128,6 +299,7 @@ class Cacher(object):
         tmpPath = os.path.join(self._cacheLocation, basename)
         return tmpPath
 
+    @_synchronized
     def checkFileExists(self, url):
         if os.path.exists(self._urlToLocalLocation[url]):
             return True
@@ -135,23 +307,27 @@ class Cacher(object):
         self.clobber(url)
         return False
 
+    @_synchronized
     def isComplete(self, url):
         if url in self._completedFiles:
             if self.checkFileExists(url):
                 return True
         return False
 
+    @_synchronized
     def setComplete(self, url):
         self._completedFiles[url] = self.getLocalLocation(url)
         if url in self._midstreamFiles:
             del self._midstreamFiles[url]
 
+    @_synchronized
     def cachedCopy(self, url, default=None):
         if url in self._urlToLocalLocation:
             if self.checkFileExists(url):
                 return self._urlToLocalLocation[url]
         return default
 
+    @_synchronized
     def remoteClose(self, url, localFile):
         try:
             localFile.close()
@@ -166,23 +342,87 @@ class Cacher(object):
                 log.error(msg)
             del self._midstreamFiles[url]
 
-    def remoteOpen(self, url):
+    def remoteOpen(self, url, requestAmount=None):
         #TODO: resolve the confusing naming with module-level remoteOpen
         '''It is the responsibility of the caller to close localFile and
         remoteFile.  That can be achieved by calling
-        remoteClose(url, localFile)'''
-        tmpPath = self.getLocalLocation(url)
+        remoteClose(url, localFile)
 
-        if url in self._midstreamFiles:
+        If an earlier download of the url was cut short, the remote file is
+        opened where the local copy left off (when the server supports it)
+        and the local file is opened for appending.'''
+        self._lock.acquire()
+        try:
+            tmpPath = self.getLocalLocation(url)
+
+            if url in self._midstreamFiles:
+                localFile = open(tmpPath, 'ab')
+                return self._midstreamFiles[url], localFile
+
+            offset = 0
+            if url in self._urlToLocalLocation and os.path.exists(tmpPath):
+                offset = os.path.getsize(tmpPath)
+            validators = self._validators.get(url)
+            self._urlToLocalLocation[url] = tmpPath
+        finally:
+            self._lock.release()
+
+        # Don't hold the lock while connecting, the remote end may be slow.
+        try:
+            remoteFile = remoteOpen(url, offset, requestAmount,
+                                    ifRange=validators)
+        except HTTPError, ex:
+            if not (offset and ex.code == 416):
+                raise
+            # The range starts at the end of the file, so there is nothing
+            # left to download.
+            remoteFile = StringIO('')
+            resumed = True
+        else:
+            resumed = offset and _isResumed(url, remoteFile)
+
+        if resumed:
+            log.debug('Resuming download of %s at byte %d' % (url, offset))
             localFile = open(tmpPath, 'ab')
-            return self._midstreamFiles[url], localFile
+        else:
+            localFile = open(tmpPath, 'wb')
 
-        self._urlToLocalLocation[url] = tmpPath
-        localFile = open(tmpPath, 'wb')
-        remoteFile = remoteOpen(url)
-        self._midstreamFiles[url] = remoteFile
+        self._lock.acquire()
+        try:
+            self._midstreamFiles[url] = remoteFile
+            headers = _getValidators(remoteFile)
+            if headers:
+                self._validators[url] = headers
+        finally:
+            self._lock.release()
         return remoteFile, localFile
 
+    def revalidate(self, url):
+        '''Ask the server if the completed, cached copy of url is still
+        current.  Returns True if the cached copy can be used.'''
+        self._lock.acquire()
+        try:
+            if not self.isComplete(url):
+                return False
+            validators = self._validators.get(url)
+        finally:
+            self._lock.release()
+        if not validators:
+            return False
+
+        try:
+            remoteFile = remoteOpen(url, validators=validators)
+        except HTTPError, ex:
+            if ex.code == 304:
+                log.debug('Cached copy of %s is still current' % url)
+                return True
+            return False
+        except (URLError, IOError, socket.error):
+            return False
+        remoteFile.close()
+        return False
+
+    @_synchronized
     def clobber(self, url):
         log.debug('Cacher is clobbering %s' % url)
         if url in self._urlToLocalLocation:
@@ -200,6 +440,10 @@ class Cacher(object):
             del self._completedFiles[url]
         except KeyError:
             pass
+        try:
+            del self._validators[url]
+        except KeyError:
+            pass
         try:
             self._midstreamFiles[url].close()
             del self._midstreamFiles[url]
@@ -414,10 +658,16 @@ def isURL(candidate):
 
 
 #------------------------------------------------------------------------------
-def openFileURL(url):
+def _isMediaURL(url):
+    return url.startswith('file://') and \
+           url[7:].startswith(consts.MEDIA_DEVICE_MOUNT_POINT)
+
+def _fileURLToPath(url):
     filePath = url[7:]
 
-    if filePath.startswith(consts.MEDIA_DEVICE_MOUNT_POINT):
+    # Mounting can prompt for the media or even exit, so workers rely on
+    # prepareRemoteAccess() to have done it.
+    if _isMediaURL(url) and not workerpool.isWorkerThread():
         import media # Import here to avoid a loop.
         media.runtimeActionMountMedia()
     
@@ -425,6 +675,11 @@ def openFileURL(url):
         log.warn('Do not support hosts specified in file:// URLs')
         log.warn('Assuming the user meant to put in a third /')
         filePath = '/' + filePath
+    return filePath
+
+#------------------------------------------------------------------------------
+def openFileURL(url):
+    filePath = _fileURLToPath(url)
     try:
         return open(filePath)
     except IOError, ex:
@@ -432,6 +687,29 @@ def openFileURL(url):
                   % (filePath, url, str(ex)))
         raise
 
+#------------------------------------------------------------------------------
+def _isResumed(url, remoteFile):
+    '''Returns True if remoteFile starts at the offset that was asked for
+    by remoteOpen().'''
+    if url.startswith('file://') or url.startswith('nfs://'):
+        return True
+    if url.startswith('http://') or url.startswith('https://'):
+        # Servers that don't do ranges just send the whole file.
+        return getattr(remoteFile, 'code', None) == 206
+    return False
+
+#------------------------------------------------------------------------------
+def _getValidators(remoteFile):
+    '''Get the ETag and Last-Modified headers from an HTTP response.'''
+    if not hasattr(remoteFile, 'info'):
+        return None
+    info = remoteFile.info()
+    etag = info.getheader('ETag')
+    lastModified = info.getheader('Last-Modified')
+    if not (etag or lastModified):
+        return None
+    return (etag, lastModified)
+
 #------------------------------------------------------------------------------
 def checkNetworkUp():
     if networking.connected():
@@ -453,6 +731,7 @@ def checkNetworkUp():
 _activeProxySettings = {}
 def checkProxySetUp():
     global _activeProxySettings
+    networking.config.ensureOpenerInstalled()
     proxyChoices = userchoices.getMediaProxy()
     if proxyChoices == _activeProxySettings:
         #if the proxy is already set as specified, or is not set, do nothing
@@ -471,18 +750,69 @@ def checkProxySetUp():
         
 
 #------------------------------------------------------------------------------
-def openHTTPURL(url):
-    if '*' in url:
-        log.error('WILDCARDS NOT ALLOWED FOR HTTP MEDIA. FIXME')
-        log.error('WILDCARD URL: %s' % url)
+def prepareRemoteAccess(urls):
+    '''Mount the install media, bring up the network, install the proxy and
+    mount the NFS export that the given URLs need.  All of that changes
+    global state, so it has to be done from the main thread before the URLs
+    are handed to a WorkerPool.  openFileURL(), openHTTPURL() and
+    openNFSURL() leave it alone when they are called from a worker.'''
+    for url in urls:
+        if _isMediaURL(url):
+            import media # Import here to avoid a loop.
+            media.runtimeActionMountMedia()
+            break
+
+    networkURLs = [url for url in urls
+                   if url.split('://')[0] in ('http', 'https', 'ftp', 'nfs')]
+    if not networkURLs:
         return
+
     try:
         checkNetworkUp()
     except Exception, ex:
-        log.error('A network connection could not be made to fetch %s' % url)
+        log.error('A network connection could not be made to fetch %s' %
+                  networkURLs[0])
         raise
 
-    checkProxySetUp()
+    mounter = None
+    proxyChecked = False
+    for url in networkURLs:
+        if url.startswith('nfs://'):
+            if mounter is None:
+                mounter = getNFSMounter()
+            # mounts the export if it is not already
+            mounter.getLocalLocation(url)
+        elif not proxyChecked:
+            checkProxySetUp()
+            proxyChecked = True
+
+#------------------------------------------------------------------------------
+def openHTTPURL(url, offset=0, length=None, ifRange=None, validators=None):
+    '''Open an http, https or ftp URL.
+    offset, length - Ask for just part of the file with a Range header.
+                     Servers are free to ignore it and send the whole file.
+    ifRange        - (etag, lastModified) of the partial copy that the
+                     range is meant to complete.  If the file has changed,
+                     the server sends all of it.
+    validators     - (etag, lastModified) of a cached copy.  If the file has
+                     not changed, an HTTPError with code 304 is raised.
+
+    In a worker thread the network and proxy are expected to have been set up
+    by prepareRemoteAccess().
+    '''
+    if '*' in url:
+        log.error('WILDCARDS NOT ALLOWED FOR HTTP MEDIA. FIXME')
+        log.error('WILDCARD URL: %s' % url)
+        return
+    if not workerpool.isWorkerThread():
+        try:
+            checkNetworkUp()
+        except Exception, ex:
+            log.error('A network connection could not be made to fetch %s' %
+                      url)
+            raise
+
+        checkProxySetUp()
 
     httpErrorMsg = ('The remote server responded with an HTTP Error (%s) while'
                     ' requesting %s.')
@@ -494,12 +824,35 @@ def openHTTPURL(url):
     cookedUrl = networking.utils.cookPasswordInFileResourceURL(url)
     log.info('Connecting to the remote file %s' % cookedUrl)
     req = Request(url)
+    if url.startswith('http'):
+        if length:
+            req.add_header('Range',
+                           'bytes=%d-%d' % (offset, offset + length - 1))
+        elif offset:
+            req.add_header('Range', 'bytes=%d-' % offset)
+        if ifRange and (offset or length):
+            req.add_header('If-Range', ifRange[0] or ifRange[1])
+        if validators:
+            etag, lastModified = validators
+            if etag:
+                req.add_header('If-None-Match', etag)
+            if lastModified:
+                req.add_header('If-Modified-Since', lastModified)
+
     for attempt in range(1, 4): #must not be empty or attempt will be undefined
         if attempt > 1:
             log.info('Making another attempt (%d)' % attempt)
         try:
             return urlopen(req)
         except HTTPError, ex:
+            if ex.code in (304, 416):
+                # Not modified / range not satisfiable, the caller handles
+                # these.
+                raise
+            if ex.code == 404:
+                # Trying again won't make the file appear.
+                log.info(httpErrorMsg % (str(ex), url))
+                raise
             msg = httpErrorMsg % (str(ex), url)
             if ex.geturl() != url:
                 msg += ' (Redirected to %s)' % ex.geturl()
@@ -514,11 +867,14 @@ def openHTTPURL(url):
 
 #------------------------------------------------------------------------------
 def openNFSURL(url):
-    try:
-        checkNetworkUp()
-    except Exception, ex:
-        log.error('A network connection could not be made to fetch %s' % url)
-        raise
+    if not workerpool.isWorkerThread():
+        # workers rely on prepareRemoteAccess() to have done this
+        try:
+            checkNetworkUp()
+        except Exception, ex:
+            log.error('A network connection could not be made to fetch %s' %
+                      url)
+            raise
     try:
         mounter = getNFSMounter()
         localLocation = mounter.getLocalLocation(url)
@@ -529,10 +885,29 @@ def openNFSURL(url):
         raise
 
 
+#------------------------------------------------------------------------------
+def isDirectReadable(url):
+    '''Returns True if the URL refers to something on a local or NFS mounted
+    filesystem that could be read in place.'''
+    return url.startswith('file://') or url.startswith('nfs://')
+
+#------------------------------------------------------------------------------
+def getDirectPath(url):
+    '''Return a local path that the file at url can be read from without
+    copying it first.  NFS sources are mounted if they are not already.
+    Raises RemoteFileError for other kinds of URLs.'''
+    if url.startswith('file://'):
+        return _fileURLToPath(url)
+    elif url.startswith('nfs://'):
+        checkNetworkUp()
+        return getNFSMounter().getLocalLocation(url)
+    raise RemoteFileError('%s can not be read in place' % url)
+
+
 #------------------------------------------------------------------------------
 #TODO: change the name to retrieveFile
 def downloadLocally(url, requestAmount=None, clobberCache=False,
-                    integrityChecker=None, maxAttempts=None):
+                    integrityChecker=None, maxAttempts=None, digest=None):
     '''Downloads a file and returns the path to the local copy
     Arguments:
     requestAmount    - specifies how much more to download, in bytes. This
@@ -547,9 +922,27 @@ def downloadLocally(url, requestAmount=None, clobberCache=False,
     maxAttempts      - How many times to attempt to download the file. If left
                        as None, this function will try to choose a good value
                        based on the type of URL.
+    digest           - "algorithm:hexdigest" of the complete file.  The file
+                       is checked against it as it is downloaded, and it is
+                       used to find the file in the Cacher's content store.
     '''
     cacher = getCacher()
-    if clobberCache:
+    store = cacher.getContentStore()
+    if digest and not requestAmount:
+        if store:
+            storePath = store.lookup(digest)
+            if storePath:
+                log.debug('Using %s from the package cache' % url)
+                # drop any header fragment we already have
+                cacher.clobber(url)
+                return storePath
+        if not depotindex.newHasher(digest.split(':', 1)[0]):
+            log.debug('Cannot check digest %s, no hash available' % digest)
+            digest = None
+    else:
+        digest = None
+
+    if clobberCache and not cacher.revalidate(url):
         cacher.clobber(url)
     if cacher.cachedCopy(url):
         if cacher.isComplete(url):
@@ -557,9 +950,12 @@ def downloadLocally(url, requestAmount=None, clobberCache=False,
 
     tmpPath = cacher.getLocalLocation(url)
 
-    chunkSize = 100*1024 #100 kilobytes
+    if url.startswith('file://') or url.startswith('nfs://'):
+        chunkSize = MAX_CHUNK_SIZE
+    else:
+        chunkSize = 2 * MIN_CHUNK_SIZE
     if requestAmount:
-        if os.path.exists(tmpPath):
+        if cacher.cachedCopy(url):
             amountDownloaded = os.path.getsize(tmpPath)
         else:
             amountDownloaded = 0
@@ -580,23 +976,61 @@ def downloadLocally(url, requestAmount=None, clobberCache=False,
         if attempt > 1:
             sleep(2)
         try:
-            remoteFile, localFile = cacher.remoteOpen(url)
+            remoteFile, localFile = cacher.remoteOpen(url, requestAmount)
         except (HTTPError, URLError), ex:
             log.warn('Connection / HTTP error while downloading.')
             log.warn('Exception: %s' % str(ex))
             continue
+        if requestAmount:
+            # the server may not have let us pick up where we left off
+            amountDownloaded = os.path.getsize(tmpPath)
+        hasher = None
+        if digest:
+            hasher = _startDigest(digest, tmpPath)
+        remaining = _getRemainingSize(remoteFile)
+        # Local and NFS files are read straight into one reusable buffer
+        # rather than into a new string for every chunk.
+        useReadinto = isinstance(remoteFile, types.FileType)
+        buf = None
         try:
             log.debug('Downloading file %s (attempt %d)' % (url, attempt))
             while True:
-                chunk = remoteFile.read(chunkSize)
+                readSize = chunkSize
+                if requestAmount:
+                    readSize = min(readSize, targetAmount - amountDownloaded)
+                if remaining is not None:
+                    if remaining == 0:
+                        raise SocketEmpty()
+                    readSize = min(readSize, remaining)
+
+                started = time.time()
+                if useReadinto:
+                    if buf is None or len(buf) != readSize:
+                        buf = array('c', '\0' * readSize)
+                    count = remoteFile.readinto(buf)
+                    chunk = buffer(buf, 0, count)
+                else:
+                    chunk = remoteFile.read(readSize)
+                    count = len(chunk)
                 localFile.write(chunk)
-                if len(chunk) < chunkSize:
-                    # either the download is done, or there was a short read
+                if hasher:
+                    hasher.update(chunk)
+
+                if remaining is not None:
+                    remaining -= count
+                if count < readSize:
+                    if remaining:
+                        # the connection was dropped, the next attempt will
+                        # pick up from here
+                        raise IOError('connection closed with %d bytes left'
+                                      % remaining)
+                    # the download is done
                     raise SocketEmpty()
                 if requestAmount:
-                    amountDownloaded += len(chunk)
+                    amountDownloaded += count
                     if amountDownloaded >= targetAmount:
                         raise IntentionalShortRead()
+                chunkSize = _adjustChunkSize(chunkSize, time.time() - started)
         except SocketEmpty:
             cacher.remoteClose(url, localFile)
             remoteFile.close()
@@ -604,6 +1038,16 @@ def downloadLocally(url, requestAmount=None, clobberCache=False,
                 log.warn('Apparent short read of file %s' % url)
                 cacher.clobber(url)
                 continue # try another attempt
+            if hasher:
+                actual = '%s:%s' % (digest.split(':', 1)[0],
+                                    hasher.hexdigest())
+                if actual != digest:
+                    log.warn('Digest mismatch for %s (expected %s, got %s)'
+                             % (url, digest, actual))
+                    cacher.clobber(url)
+                    continue # try another attempt
+                if store:
+                    store.add(digest, tmpPath)
             cacher.setComplete(url)
             break # successful download - no more attempts needed
         except IntentionalShortRead:
@@ -624,20 +1068,72 @@ def downloadLocally(url, requestAmount=None, clobberCache=False,
 
 
 #------------------------------------------------------------------------------
-def remoteOpen(url):
+def _getRemainingSize(remoteFile):
+    '''Return how many bytes are left to read from remoteFile, going by the
+    Content-Length for HTTP and the file size for local and NFS files, or
+    None if that can't be known (ftp, chunked responses).'''
+    if isinstance(remoteFile, types.FileType):
+        try:
+            return os.fstat(remoteFile.fileno()).st_size - remoteFile.tell()
+        except (IOError, OSError):
+            return None
+    if not hasattr(remoteFile, 'info'):
+        return None
+    try:
+        return long(remoteFile.info().getheader('Content-Length'))
+    except (TypeError, ValueError):
+        return None
+
+#------------------------------------------------------------------------------
+def _adjustChunkSize(chunkSize, elapsed):
+    '''Grow the chunk size while reads are quick and shrink it when they are
+    slow, so a slow link doesn't stall on one huge read.'''
+    if elapsed < 0.2 and chunkSize < MAX_CHUNK_SIZE:
+        return chunkSize * 2
+    if elapsed > 2.0 and chunkSize > MIN_CHUNK_SIZE:
+        return chunkSize / 2
+    return chunkSize
+
+#------------------------------------------------------------------------------
+def _startDigest(digest, tmpPath):
+    '''Return a hash object for checking a download against digest, fed with
+    whatever part of the file has already been downloaded.'''
+    hasher = depotindex.newHasher(digest.split(':', 1)[0])
+    if os.path.exists(tmpPath):
+        partial = open(tmpPath, 'rb')
+        try:
+            while True:
+                data = partial.read(1024 * 1024)
+                if not data:
+                    break
+                hasher.update(data)
+        finally:
+            partial.close()
+    return hasher
+
+
+#------------------------------------------------------------------------------
+def remoteOpen(url, offset=0, length=None, ifRange=None, validators=None):
     '''Treat this like you would a call to open().  The return value is an
     open file-like object.  It is the caller's responsibility to close().
+
+    The optional arguments are passed on to openHTTPURL().  For file:// and
+    nfs:// URLs the file is just positioned at offset.
     '''
     if url.startswith('file://'):
-        return openFileURL(url)
+        fp = openFileURL(url)
+        fp.seek(offset)
+        return fp
     elif url.startswith('http://'):
-        return openHTTPURL(url)
+        return openHTTPURL(url, offset, length, ifRange, validators)
     elif url.startswith('https://'):
-        return openHTTPURL(url)
+        return openHTTPURL(url, offset, length, ifRange, validators)
     elif url.startswith('ftp://'):
         return openHTTPURL(url)
     elif url.startswith('nfs://'):
-        return openNFSURL(url)
+        fp = openNFSURL(url)
+        fp.seek(offset)
+        return fp
     else:
         msg = ('URL scheme not supported for URL %s. Supported URL schemes'
                ' are file://, http://, https://, ftp://, nfs://.' % url)
@@ -1170,6 +1170,12 @@ class GrammarDefinition:
                                      detail=GrammarDetail.OPTIONAL,
                                      valueRegex=RegexLocator.vmdkpath,
                                   ),
+                     '--disktype' : dict(
+                                     detail=GrammarDetail.OPTIONAL,
+                                     valueRegex=RegexLocator.vmdkdisktype,
+                                     regexMsg='virtualdisk --disktype must be "thin", "zeroedthick" or "eagerzeroedthick".',
+                                     onRegexMismatch='error',
+                                  ),
                   },
          'hangingArg' : {
                            'name' : dict(
@@ -114,16 +114,7 @@ class ScriptedInstallPreparser:
       self.disks = DiskSet(forceReprobe=True)
       # diskAliases contains a mapping from aliases (vml, sdX, vmhbaX:Y:Z) to
       # the canonical disk name.
-      self.diskAliases = {}
-      for disk in self.disks.values():
-         self.diskAliases[disk.name] = disk.name
-         if disk.path:
-            self.diskAliases[disk.path] = disk.name
-         if disk.consoleDevicePath:
-            self.diskAliases[disk.consoleDevicePath] = disk.name
-            m = re.match(r'/dev/(.+)', disk.consoleDevicePath)
-            if m:
-               self.diskAliases[m.group(1)] = disk.name
+      self.diskAliases = self.disks.getDiskAliases()
 
    def parseAndValidate(self):
       '''Combines the preParse() and overall validation into a single method.
@@ -1784,7 +1775,8 @@ class ScriptedInstallPreparser:
                            vmfsVolume=vmfsVolume,
                            imagePath=imagePath,
                            imageName=imageName,
-                           physicalDeviceName=onDisk)
+                           physicalDeviceName=onDisk,
+                           diskType=branch.get('--disktype'))
       self.vmdkDeviceName = name
       self.vmdkDevice = vdd
       
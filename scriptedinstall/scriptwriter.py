@@ -444,6 +444,11 @@ def _genVirtualDisk():
                 "%s/%s" % (vdev.imagePath, vdev.imageName))
         flags += " --onvmfs='%s'" % shquote(vdev.vmfsVolume)
 
+        # Leave it out if the type was not picked so the new install also
+        # chooses based on the kind of storage.
+        if vdev.diskType:
+            flags += " --disktype=%s" % vdev.diskType
+
         retval += "virtualdisk '%s'%s\n" % (shquote(vdev.name), flags)
 
     return retval
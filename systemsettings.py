@@ -31,6 +31,12 @@ from consts import HOST_ROOT
 
 DEFAULT_LANG = "en_US.UTF-8"
 
+# Number of packages to download ahead of rpmlib and the amount of space (in
+# MB) they are allowed to take up in /mnt/sysimage/tmp.  See
+# packages.PackagePrefetcher.
+DEFAULT_PREFETCH_DEPTH = 4
+DEFAULT_PREFETCH_BUDGET_MB = 400
+
 # XML Helper functions
 # ----------------------------------------------------------------------------
 def fetchTextFromNode(node):
@@ -71,9 +77,23 @@ class WeaselConfig(SystemSettings):
             for depot in node.getElementsByTagName("depot"):
                 for group in depot.getElementsByTagName("package_group"):
                     self.packageGroups.append(fetchTextFromNode(group))
+            for prefetch in node.getElementsByTagName("prefetch"):
+                depth = fetchTextFromFirstElementByTagName(prefetch, "depth")
+                budget = fetchTextFromFirstElementByTagName(prefetch,
+                                                            "budget_mb")
+                try:
+                    if depth.strip():
+                        self.prefetchDepth = int(depth)
+                    if budget.strip():
+                        self.prefetchBudgetMB = int(budget)
+                except ValueError:
+                    log.warn("invalid prefetch settings in %s, using the "
+                             "defaults" % fname)
 
     def __init__(self):
         self.packageGroups = []
+        self.prefetchDepth = DEFAULT_PREFETCH_DEPTH
+        self.prefetchBudgetMB = DEFAULT_PREFETCH_BUDGET_MB
         self.parseConfigFile()
 
 
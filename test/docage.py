@@ -140,6 +140,15 @@ def setup():
     remote_files.__nfsMounter = None
     remote_files.NFSMounter._nfsUp = False
 
+    import esxconffile
+    esxconffile.clearCache()
+
+    import discovery
+    discovery.clearCache()
+
+    import devices
+    devices.invalidateDisk()
+
     import customdrivers
     reload(customdrivers)
 
@@ -650,7 +650,7 @@ os.statvfs = chroot_statvfs
 
 oldWalk = os.walk
 
-def chroot_walk(top, topdown=True, onerror=None):
+def chroot_walk(top, topdown=True, onerror=None, *args):
     if FAUXROOT:
         # XXX only does one level, which is enough for scanning /dev for uuids
         retval = []
@@ -660,7 +660,7 @@ def chroot_walk(top, topdown=True, onerror=None):
                  for path in paths if not os.path.isdir(path)]
         return [(top, dirs, files)]
     
-    return oldWalk(top, topdown, onerror)
+    return oldWalk(top, topdown, onerror, *args)
 
 os.walk = chroot_walk
 
@@ -780,7 +780,8 @@ def chroot_execWithCapture(command, argv,
                            catchfdList=None, closefd=-1,
                            returnStatus=False,
                            timeoutInSecs=0,
-                           raiseException=False):
+                           raiseException=False,
+                           outputCallback=None):
     global FAUXROOT
     
     SYSTEM_LOG.append(argv)
@@ -802,6 +803,9 @@ def chroot_execWithCapture(command, argv,
         if root != '/':
             FAUXROOT.pop()
 
+        if output and outputCallback:
+            outputCallback(output)
+
         if status and raiseException:
             raise util.ExecError(
                 command,
@@ -821,7 +825,8 @@ def chroot_execWithCapture(command, argv,
                                   closefd=closefd,
                                   returnStatus=returnStatus,
                                   timeoutInSecs=timeoutInSecs,
-                                  raiseException=raiseException)
+                                  raiseException=raiseException,
+                                  outputCallback=outputCallback)
 
 util.execWithCapture = chroot_execWithCapture
 util._util.execWithCapture = chroot_execWithCapture
@@ -980,7 +985,7 @@ tempfile.mkdtemp = chroot_mkdtemp
 
 oldRmtree = shutil.rmtree
 
-def chroot_rmtree(path):
+def chroot_rmtree(path, *args):
     global FAUXROOT
     
     path = os.path.normpath(path)
@@ -994,7 +999,8 @@ def chroot_rmtree(path):
             pass
 
     else:
-        return oldRmtree(prepend_root(path))
+        # rmtree recurses through shutil.rmtree, so pass its extra args on
+        return oldRmtree(prepend_root(path), *args)
 
 shutil.rmtree = chroot_rmtree
 
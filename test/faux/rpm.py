@@ -55,10 +55,10 @@ def rpm_open(filename, flags, mode = 0777):
     XXX This should be replaced with something more sensible...
     '''
     
-    filename = os.path.basename(filename)
+    basename = os.path.basename(filename)
     
-    if filename in RPM_FILES:
-        return RPM_FILES[filename]
+    if basename in RPM_FILES:
+        return RPM_FILES[basename]
 
     return old_os_open(filename, flags, mode)
 
@@ -130,6 +130,9 @@ class RpmPackage:
     def A(self):
         return "x86_64" # XXX return a more realistic value
 
+    def Key(self):
+        return self.cbArgs
+
 class TransactionSet:
 
     def __init__(self, root):
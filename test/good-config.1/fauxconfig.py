@@ -638,11 +638,11 @@ fauxroot.PROC_FILES = {
 # to simulate a bad burn, change BRANDISO_WRITTEN_DIGEST to something else
 BRANDISO_WRITTEN_DIGEST = 'g\xa0\xe0\xd93\xff\xd1\xd7\xd8\x94a\x1a\xb1\xec\xd8m'
 oldextractISOChecksums = brandiso.extract_iso_checksums
-def extractISOChecksums(filename):
+def extractISOChecksums(filename, checkpoint=None):
     img = StringIO('this is some fake file contents')
     checksumSize = 16
     fauxroot.longRunningFunction(1, 'brandiso.calc_md5', 10)
-    digest = brandiso.calc_md5(img, 0, checksumSize)
+    digest = brandiso.calc_md5(img, 0, checksumSize, checkpoint=checkpoint)
     return (BRANDISO_WRITTEN_DIGEST, digest, 'SOME_ID')
 brandiso.extract_iso_checksums = extractISOChecksums
 
@@ -663,7 +663,7 @@ def usrSbinVmkfstools(argv):
     '''Mock vmkfstools that creates fake vmfs volumes for the mock vsd.'''
     global VMFS_DEVICE
 
-    opts, args = getopt.getopt(argv[1:], 'c:C:b:S:VP')
+    opts, args = getopt.getopt(argv[1:], 'c:C:b:S:d:VP')
     size = 0
     volumeName = None
     blockSize = 1048576
@@ -835,7 +835,7 @@ PARTITION_CONTENTS["/dev/sr0"] = PARTITION_CONTENTS["/dev/cdrom"]
 
 
 def binMount(argv):
-    (opts, args) = getopt.getopt(argv[1:], "t:o:")
+    (opts, args) = getopt.getopt(argv[1:], "rt:o:")
 
     devPath = os.path.normpath(args[0])
     if len(args) == 2 and devPath in PARTITION_CONTENTS:
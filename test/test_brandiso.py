@@ -0,0 +1,254 @@
+
+###############################################################################
+# Copyright (c) 2008-2009 VMware, Inc.
+#
+# This file is part of Weasel.
+#
+# Weasel is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation version 2 and no later version.
+#
+# Weasel is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# version 2 for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin St, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os
+import sys
+import struct
+import shutil
+import tempfile
+import subprocess
+
+TEST_DIR = os.path.dirname(__file__)
+BRANDISO = os.path.join(TEST_DIR, os.path.pardir, 'brandiso.py')
+
+sys.path.append(os.path.join(TEST_DIR, os.path.pardir))
+
+import brandiso
+
+IMAGE_SECTORS = 64
+
+tmpDir = None
+
+def setup():
+    global tmpDir
+    tmpDir = tempfile.mkdtemp()
+
+def teardown():
+    shutil.rmtree(tmpDir)
+
+def _primaryDescriptor():
+    sec = ['\0'] * brandiso.SECTOR_SIZE
+    def put(name, value):
+        offset, size, _fn = brandiso.fields[name]
+        sec[offset:offset + size] = list(value.ljust(size)[:size])
+    put('type', chr(1))
+    put('std id', 'CD001')
+    put('std ver', chr(1))
+    put('vol id', '')
+    put('lsb vol size', struct.pack('<I', IMAGE_SECTORS))
+    put('msb vol size', struct.pack('>I', IMAGE_SECTORS))
+    put('lsb sec size', struct.pack('<H', brandiso.SECTOR_SIZE))
+    put('msb sec size', struct.pack('>H', brandiso.SECTOR_SIZE))
+    put('app use', '\0' * 512)
+    return ''.join(sec)
+
+def _makeImage(name='test.iso'):
+    '''Write a small image with a primary volume descriptor and some
+    non-zero data, and return its path.'''
+    terminator = chr(255) + '\0' * (brandiso.SECTOR_SIZE - 1)
+    data = ''.join([chr(index % 251) for index in range(
+        (IMAGE_SECTORS - 18) * brandiso.SECTOR_SIZE)])
+    path = os.path.join(tmpDir, name)
+    out = open(path, 'wb')
+    out.write('\x42' * 16 * brandiso.SECTOR_SIZE)
+    out.write(_primaryDescriptor())
+    out.write(terminator)
+    out.write(data)
+    out.close()
+    return path
+
+def _checksumOffset():
+    chsumOff, _size, _fn = brandiso.fields[brandiso.CHECKSUM_FIELD]
+    return 16 * brandiso.SECTOR_SIZE + chsumOff + brandiso.CHECKSUM_OFFSET
+
+def _expectedMd5(path):
+    import hashlib
+    contents = open(path, 'rb').read()
+    zpos = _checksumOffset()
+    contents = (contents[:zpos] + '\0' * brandiso.CHECKSUM_SIZE +
+                contents[zpos + brandiso.CHECKSUM_SIZE:])
+    return hashlib.md5(contents).digest()
+
+def _calcMd5(path, **kwargs):
+    img = open(path, 'rb')
+    try:
+        return brandiso.calc_md5(img, _checksumOffset(),
+                                 brandiso.CHECKSUM_SIZE, **kwargs)
+    finally:
+        img.close()
+
+def testCalcMd5():
+    path = _makeImage()
+    # put something in the hole, it should be hashed as zeros
+    img = open(path, 'r+b')
+    img.seek(_checksumOffset())
+    img.write('\xff' * brandiso.CHECKSUM_SIZE)
+    img.close()
+
+    expected = _expectedMd5(path)
+    assert _calcMd5(path, readAhead=False) == expected
+    assert _calcMd5(path) == expected
+
+    oldBlockSize = brandiso.READ_AHEAD_BLOCK_SIZE
+    brandiso.READ_AHEAD_BLOCK_SIZE = 4096
+    try:
+        # lots of small blocks through the reader thread
+        assert _calcMd5(path) == expected
+    finally:
+        brandiso.READ_AHEAD_BLOCK_SIZE = oldBlockSize
+
+class CancelAt(brandiso.Checkpoint):
+    '''A checkpoint that cancels itself once the hash reaches an offset.'''
+
+    def __init__(self, cancelAt):
+        brandiso.Checkpoint.__init__(self)
+        self.cancelAt = cancelAt
+
+    def _getCancelled(self):
+        return self._cancelled or self.offset >= self.cancelAt
+
+    def _setCancelled(self, value):
+        self._cancelled = value
+        if not value:
+            # calc_md5 clears it after a cancel
+            self.cancelAt = sys.maxint
+
+    cancelled = property(_getCancelled, _setCancelled)
+
+def testCheckpointResume():
+    path = _makeImage()
+
+    oldBlockSize = brandiso.READ_AHEAD_BLOCK_SIZE
+    brandiso.READ_AHEAD_BLOCK_SIZE = 8192
+    try:
+        checkpoint = CancelAt(8192 * 3)
+        try:
+            _calcMd5(path, checkpoint=checkpoint)
+            assert False, "the check should have been cancelled"
+        except brandiso.CheckCancelled:
+            pass
+        assert checkpoint.offset == 8192 * 3
+
+        assert _calcMd5(path, checkpoint=checkpoint) == _expectedMd5(path)
+        assert checkpoint.offset == IMAGE_SECTORS * brandiso.SECTOR_SIZE
+    finally:
+        brandiso.READ_AHEAD_BLOCK_SIZE = oldBlockSize
+
+def testReadAheadError():
+    def blocks():
+        yield 'a'
+        yield 'b'
+        raise IOError("read error")
+
+    readAhead = brandiso.ReadAhead(blocks())
+    got = []
+    try:
+        for block in readAhead:
+            got.append(block)
+        assert False, "the error should have been re-raised"
+    except IOError:
+        pass
+    readAhead.close()
+    assert got == ['a', 'b']
+
+def testReadAheadClose():
+    def blocks():
+        while True:
+            yield 'x'
+
+    readAhead = brandiso.ReadAhead(blocks(), depth=1)
+    assert readAhead.next() == 'x'
+    # the reader is stopped even though it has more to read
+    readAhead.close()
+    assert not readAhead.thread.isAlive()
+
+def _extractISOChecksums(path):
+    # the tests that load fauxconfig replace extract_iso_checksums
+    fauxconfig = sys.modules.get('fauxconfig')
+    if fauxconfig:
+        return fauxconfig.oldextractISOChecksums(path)
+    return brandiso.extract_iso_checksums(path)
+
+def testBrandAndVerify():
+    path = _makeImage('brand.iso')
+    brandiso.brand_iso(path, 'My ISO v1.0')
+
+    written, actual, idStr = _extractISOChecksums(path)
+    assert written == actual
+    assert idStr.strip() == 'My ISO v1.0'
+    assert brandiso.read_iso_brand(path) == (written, idStr)
+
+    # change a byte of the data
+    img = open(path, 'r+b')
+    img.seek(-100, brandiso.SEEK_END)
+    img.write('\0' if img.read(1) != '\0' else '\1')
+    img.close()
+
+    written, actual, _idStr = _extractISOChecksums(path)
+    assert written != actual
+
+def _makeTree(name):
+    root = os.path.join(tmpDir, name)
+    os.makedirs(os.path.join(root, 'VMware', 'RPMS'))
+    for relpath, contents in [('isolinux.cfg', 'default menu'),
+                              ('VMware/RPMS/a.rpm', 'a' * 5000),
+                              ('VMware/RPMS/b.rpm', 'b' * 7000)]:
+        out = open(os.path.join(root, relpath), 'wb')
+        out.write(contents)
+        out.close()
+    return root
+
+def testFileChecksums():
+    root = _makeTree('media')
+    brandiso.write_file_checksums(root)
+
+    lines = open(os.path.join(root, brandiso.FILE_CHECKSUMS_NAME)).readlines()
+    assert [line.split(None, 1)[1].strip() for line in lines] == \
+           ['isolinux.cfg', 'VMware/RPMS/a.rpm', 'VMware/RPMS/b.rpm']
+    assert brandiso.verify_file_checksums(root) == []
+
+    out = open(os.path.join(root, 'VMware/RPMS/b.rpm'), 'ab')
+    out.write('corrupt')
+    out.close()
+    os.remove(os.path.join(root, 'isolinux.cfg'))
+
+    assert brandiso.verify_file_checksums(root, numThreads=2) == \
+           ['VMware/RPMS/b.rpm', 'isolinux.cfg']
+
+def _run(*args):
+    proc = subprocess.Popen([sys.executable, BRANDISO] + list(args),
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = proc.communicate()[0]
+    return proc.returncode, output
+
+def testCommandLine():
+    path = _makeImage('cmdline.iso')
+    assert _run('-b', 'Cmd ISO', path)[0] == 0
+    assert _run('-c', path) == (0, 'Cmd ISO: OK\n')
+
+    root = _makeTree('cmdline')
+    assert _run('-s', root)[0] == 0
+    assert os.path.exists(os.path.join(root, brandiso.FILE_CHECKSUMS_NAME))
+    assert _run('-S', root) == (0, '%s: OK\n' % root)
+
+    out = open(os.path.join(root, 'VMware/RPMS/a.rpm'), 'ab')
+    out.write('corrupt')
+    out.close()
+    assert _run('-S', root) == (1, 'VMware/RPMS/a.rpm: FAILED\n')
@@ -0,0 +1,124 @@
+
+###############################################################################
+# Copyright (c) 2008-2009 VMware, Inc.
+#
+# This file is part of Weasel.
+#
+# Weasel is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation version 2 and no later version.
+#
+# Weasel is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# version 2 for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin St, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os
+import sys
+import struct
+import shutil
+import tempfile
+
+TEST_DIR = os.path.dirname(__file__)
+
+sys.path.append(os.path.join(TEST_DIR, os.path.pardir))
+
+import depotindex
+
+tmpDir = None
+
+def setup():
+    global tmpDir
+    tmpDir = tempfile.mkdtemp()
+
+def teardown():
+    shutil.rmtree(tmpDir)
+
+def testHeaderIndexRoundTrip():
+    path = os.path.join(tmpDir, depotindex.HEADER_INDEX_NAME)
+    blobs = {'b.rpm': 'header b' * 100, 'a.rpm': 'header a', 'c.rpm': ''}
+    depotindex.writeHeaderIndex(path, blobs)
+
+    index = depotindex.HeaderIndex(path)
+    try:
+        assert len(index) == 3
+        for name, blob in blobs.items():
+            assert name in index
+            assert index.read(name) == blob
+        assert index.read('missing.rpm') is None
+    finally:
+        index.close()
+
+def testHeaderIndexBadVersion():
+    path = os.path.join(tmpDir, 'bad-version.idx')
+    out = open(path, 'wb')
+    out.write(depotindex.HEADER_INDEX_MAGIC)
+    out.write(struct.pack('>II', depotindex.HEADER_INDEX_VERSION + 1, 0))
+    out.close()
+    try:
+        depotindex.HeaderIndex(path)
+        assert False, "newer versions should be rejected"
+    except depotindex.DepotIndexError:
+        pass
+
+def testHeaderIndexTruncated():
+    path = os.path.join(tmpDir, 'truncated.idx')
+    depotindex.writeHeaderIndex(path, {'a.rpm': 'header a'})
+    contents = open(path, 'rb').read()
+    open(path, 'wb').write(contents[:20])
+    try:
+        depotindex.HeaderIndex(path)
+        assert False, "truncated index should be rejected"
+    except depotindex.DepotIndexError:
+        pass
+
+def testPackageDataRoundTrip():
+    path = os.path.join(tmpDir, depotindex.PACKAGE_DATA_NAME)
+    headerSizes = {
+        'foo-1.0-1.i386.rpm': ('foo', 12345, 1000, 5000),
+        'bar-2.0-1.x86_64.rpm': ('bar', 2 ** 33, 96, 200),
+        }
+    fileSizes = {'/': 4096, '/usr/lib': 10 * 1024 * 1024, '/var/log': 0}
+    digests = {'foo-1.0-1.i386.rpm': 'md5:d41d8cd98f00b204e9800998ecf8427e'}
+    depotindex.writePackageData(path, headerSizes, fileSizes, digests)
+
+    data = depotindex.PackageDataFile(path)
+    try:
+        for key, value in headerSizes.items():
+            assert key in data.headerSizes
+            assert data.headerSizes[key] == value
+        try:
+            data.headerSizes['missing.rpm']
+            assert False, "KeyError expected"
+        except KeyError:
+            pass
+        assert data.fileSizes.get('/usr') is None
+        assert dict(data.fileSizes.iteritems()) == fileSizes
+        assert data.fileSizes.keys() == sorted(fileSizes.keys())
+        assert len(data.headerSizes) == 2
+        assert data.digests.items() == digests.items()
+    finally:
+        data.close()
+
+def testPackageDataTruncated():
+    path = os.path.join(tmpDir, 'truncated.dat')
+    depotindex.writePackageData(path, {'a.rpm': ('a', 1, 2, 3)}, {'/': 1})
+    contents = open(path, 'rb').read()
+    open(path, 'wb').write(contents[:-1])
+    try:
+        depotindex.PackageDataFile(path)
+        assert False, "truncated file should be rejected"
+    except depotindex.DepotIndexError:
+        pass
+
+def testFileDigest():
+    path = os.path.join(tmpDir, 'digest-me')
+    open(path, 'wb').write('')
+    assert depotindex.fileDigest(path) == \
+           'md5:d41d8cd98f00b204e9800998ecf8427e'
+    assert depotindex.newHasher('no-such-hash') is None
@@ -0,0 +1,340 @@
+###############################################################################
+# Copyright (c) 2008-2009 VMware, Inc.
+#
+# This file is part of Weasel.
+#
+# Weasel is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation version 2 and no later version.
+#
+# Weasel is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# version 2 for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin St, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os
+import sys
+import time
+import threading
+
+from nose.tools import with_setup
+
+TEST_DIR = os.path.dirname(__file__)
+sys.path.append(os.path.join(TEST_DIR, os.path.pardir))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'faux'))
+import fauxroot
+import parted
+
+sys.path.append(os.path.join(os.path.dirname(__file__), 'good-config.1'))
+import fauxconfig
+sys.path.pop()
+
+import vmkctl
+import devices
+
+def setup_disks():
+    fauxroot.FAUXROOT = [os.path.join(TEST_DIR, "good-config.1")]
+    devices.DiskSet(forceReprobe=True)
+
+def teardown_disks():
+    fauxroot.FAUXROOT = None
+
+class CallRecorder:
+    '''Wraps a function and remembers the first argument of each call and
+    the thread it was made on.'''
+
+    def __init__(self, func):
+        self.func = func
+        self.calls = []
+
+    def __call__(self, *args):
+        self.calls.append((args[0], threading.currentThread().getName()))
+        return self.func(*args)
+
+def _lunOrder():
+    '''The console paths of the luns vmkctl reports, in its order.'''
+    retval = []
+    for entry in vmkctl.StorageInfoImpl().GetDiskLuns():
+        path, _warning = devices.DiskSet()._getConsoleDevicePath(entry)
+        if path:
+            retval.append(path)
+    return retval
+
+@with_setup(setup_disks, teardown_disks)
+def testProbeOrderAndThreads():
+    # The first luns are the slowest to read, so the workers finish out of
+    # order.
+    lunOrder = _lunOrder()
+    delays = {}
+    for index, path in enumerate(lunOrder):
+        delays[path] = 0.01 * (len(lunOrder) - index)
+
+    def slowIdentity(consoleDevicePath):
+        time.sleep(delays[consoleDevicePath])
+        return oldIdentity(consoleDevicePath)
+
+    devices.DiskSet().invalidate()
+    oldIdentity = devices.readLunIdentity
+    oldGet = parted.PedDevice.get
+    devices.readLunIdentity = CallRecorder(slowIdentity)
+    parted.PedDevice.get = staticmethod(CallRecorder(oldGet))
+    try:
+        recorder = parted.PedDevice.get
+        identityRecorder = devices.readLunIdentity
+        diskSet = devices.DiskSet(forceReprobe=True)
+    finally:
+        devices.readLunIdentity = oldIdentity
+        parted.PedDevice.get = staticmethod(oldGet)
+
+    mainThread = threading.currentThread().getName()
+
+    # The workers are only handed the device paths.
+    readPaths = [path for path, _thread in identityRecorder.calls]
+    readPaths.sort()
+    expected = list(lunOrder)
+    expected.sort()
+    assert readPaths == expected
+    assert mainThread not in [thread for _path, thread in
+                              identityRecorder.calls]
+
+    # libparted is only called from the main thread, in lun order.
+    assert [path for path, _thread in recorder.calls] == lunOrder
+    assert [thread for _path, thread in recorder.calls] == \
+           [mainThread] * len(lunOrder)
+
+    # Each lun got its own identity even though the reads finished in
+    # reverse order.
+    assert diskSet.inventory
+    for name, (generation, disk) in diskSet.inventory.items():
+        assert disk is diskSet[name]
+        assert generation[0] == disk.consoleDevicePath
+
+@with_setup(setup_disks, teardown_disks)
+def testProbeFailsPartway():
+    lunOrder = _lunOrder()
+    badPath = lunOrder[1]
+
+    def failingGet(path):
+        if path == badPath:
+            raise parted.error, "Error: could not open %s" % path
+        return oldGet(path)
+
+    devices.DiskSet().invalidate()
+    oldGet = parted.PedDevice.get
+    parted.PedDevice.get = staticmethod(failingGet)
+    try:
+        diskSet = devices.DiskSet(forceReprobe=True)
+    finally:
+        parted.PedDevice.get = staticmethod(oldGet)
+
+    paths = [disk.consoleDevicePath for disk in diskSet.values()]
+    assert badPath not in paths
+    assert lunOrder[0] in paths
+    assert lunOrder[2] in paths
+
+@with_setup(setup_disks, teardown_disks)
+def testUnreadableLunIsProbed():
+    lunOrder = _lunOrder()
+    badPath = lunOrder[0]
+
+    def failingIdentity(consoleDevicePath):
+        if consoleDevicePath == badPath:
+            return None
+        return oldIdentity(consoleDevicePath)
+
+    oldIdentity = devices.readLunIdentity
+    devices.readLunIdentity = failingIdentity
+    try:
+        diskSet = devices.DiskSet(forceReprobe=True)
+    finally:
+        devices.readLunIdentity = oldIdentity
+
+    # Without a generation the lun is still used, it just is not cached.
+    disk = diskSet.getDiskByPath(badPath)
+    assert disk
+    assert disk.name not in diskSet.inventory
+
+@with_setup(setup_disks, teardown_disks)
+def testUnchangedLunIsReused():
+    disk = devices.DiskSet()['vml.0000']
+    assert devices.DiskSet(forceReprobe=True)['vml.0000'] is disk
+
+@with_setup(setup_disks, teardown_disks)
+def testLabelChangeIsNoticed():
+    disk = devices.DiskSet()['vml.0000']
+    other = devices.DiskSet()['vml.0001']
+
+    # Something like a %pre script rewrites the label behind our back.
+    oldRead = devices.readLabelSector
+    def changedLabel(path, size=512):
+        label = oldRead(path, size)
+        if path == disk.consoleDevicePath:
+            return '\xff' + label[1:]
+        return label
+
+    devices.readLabelSector = CallRecorder(changedLabel)
+    try:
+        recorder = devices.readLabelSector
+        diskSet = devices.DiskSet(forceReprobe=True)
+    finally:
+        devices.readLabelSector = oldRead
+
+    # Every label is read again, and only the changed disk is replaced.
+    assert disk.consoleDevicePath in [path for path, _thread in recorder.calls]
+    assert diskSet['vml.0000'] is not disk
+    assert diskSet['vml.0001'] is other
+
+def _checkReprobedAfter(invalidateFunc):
+    disk = devices.DiskSet()['vml.0000']
+    other = devices.DiskSet()['vml.0001']
+    invalidateFunc(disk)
+
+    diskSet = devices.DiskSet(forceReprobe=True)
+    assert diskSet['vml.0000'] is not disk
+    assert diskSet['vml.0001'] is other
+
+@with_setup(setup_disks, teardown_disks)
+def testInvalidate():
+    _checkReprobedAfter(lambda disk: devices.DiskSet().invalidate(disk.name))
+
+@with_setup(setup_disks, teardown_disks)
+def testInvalidateDisk():
+    _checkReprobedAfter(lambda disk: devices.invalidateDisk(disk.name))
+
+@with_setup(setup_disks, teardown_disks)
+def testLabelWritten():
+    _checkReprobedAfter(lambda disk: disk.labelWritten())
+
+@with_setup(setup_disks, teardown_disks)
+def testInvalidateAll():
+    disk = devices.DiskSet()['vml.0000']
+    devices.invalidateDisk()
+    assert devices.DiskSet(forceReprobe=True)['vml.0000'] is not disk
+
+@with_setup(setup_disks, teardown_disks)
+def testPartitionsReadOnFirstUse():
+    devices.invalidateDisk()
+
+    oldReadPartitions = devices.DiskDev._readPartitions
+    reads = []
+    def countingRead(disk):
+        reads.append((disk.name, threading.currentThread().getName()))
+        return oldReadPartitions(disk)
+
+    devices.DiskDev._readPartitions = countingRead
+    try:
+        diskSet = devices.DiskSet(forceReprobe=True)
+        assert reads == []
+
+        disk = diskSet['vml.0000']
+        partitions = disk.partitions
+        assert disk.partitions is partitions
+        assert [name for name, _thread in reads] == ['vml.0000']
+
+        # The rest are read by a scan, on the main thread, and a disk that
+        # was already read is not read again.
+        diskSet.scanPartitions()
+        names = diskSet.keys()
+        names.remove('vml.0000')
+        assert [name for name, _thread in reads] == ['vml.0000'] + names
+        assert [thread for _name, thread in reads] == \
+               [threading.currentThread().getName()] * len(reads)
+
+        diskSet.scanPartitions()
+        assert len(reads) == len(names) + 1
+    finally:
+        devices.DiskDev._readPartitions = oldReadPartitions
+
+@with_setup(setup_disks, teardown_disks)
+def testScanPrefetchesLabels():
+    devices.invalidateDisk()
+    diskSet = devices.DiskSet(forceReprobe=True)
+    for disk in diskSet.values():
+        disk._labelSector = None
+
+    oldPrefetch = devices.prefetchLabelSector
+    devices.prefetchLabelSector = CallRecorder(oldPrefetch)
+    try:
+        recorder = devices.prefetchLabelSector
+        diskSet.scanPartitions()
+    finally:
+        devices.prefetchLabelSector = oldPrefetch
+
+    # The workers only get the device paths, and the labels they read are
+    # kept on the disks.
+    paths = [path for path, _thread in recorder.calls]
+    paths.sort()
+    expected = [disk.consoleDevicePath for disk in diskSet.values()]
+    expected.sort()
+    assert paths == expected
+    assert diskSet['vml.0000']._labelSector is not None
+
+@with_setup(setup_disks, teardown_disks)
+def testFindDiskByAlias():
+    diskSet = devices.DiskSet()
+    disk = diskSet['vml.0000']
+
+    for alias in ['vml.0000',
+                  '/vmfs/devices/disks/vml.0000',
+                  '/dev/sda',
+                  'sda',
+                  'vmhba32:0:0:0']:
+        assert diskSet.findDisk(alias) is disk, alias
+
+    assert diskSet.getDiskAliases()['vmhba32:0:0:0'] == 'vml.0000'
+
+@with_setup(setup_disks, teardown_disks)
+def testFindDiskNotFound():
+    diskSet = devices.DiskSet()
+
+    assert diskSet.findDisk('vml.9999') is None
+    assert diskSet.findDisk('/dev/sdzz') is None
+    assert diskSet.findDisk('vmhba99:0:0:0') is None
+    assert diskSet.findPartition('/dev/sdzz1') is None
+    assert diskSet.findPartition('/dev/sda') is None
+    assert diskSet.findPartition('/dev/sda99') is None
+    assert diskSet.findPartitionByUuid('00000000-0000-0000-0000') is None
+
+@with_setup(setup_disks, teardown_disks)
+def testGetDiskByPath():
+    diskSet = devices.DiskSet()
+    disk = diskSet['vml.0000']
+
+    assert diskSet.getDiskByPath('/dev/sda') is disk
+    assert diskSet.getDiskByPath('/vmfs/devices/disks/vml.0000',
+                                 console=False) is disk
+
+    # Only the kind of path that was asked for matches.
+    assert diskSet.getDiskByPath('/vmfs/devices/disks/vml.0000') is None
+    assert diskSet.getDiskByPath('/dev/sda', console=False) is None
+    assert diskSet.getDiskByPath('sda') is None
+
+@with_setup(setup_disks, teardown_disks)
+def testFindPartition():
+    diskSet = devices.DiskSet()
+    disk = diskSet['vml.0000']
+
+    for path in ['/dev/sda1', 'sda1']:
+        found = diskSet.findPartition(path)
+        assert found, path
+        assert found[0] is disk
+        assert found[1].consoleDevicePath == '/dev/sda1'
+
+@with_setup(setup_disks, teardown_disks)
+def testFindPartitionByUuid():
+    diskSet = devices.DiskSet()
+    uuid = fauxroot.PART_UUID_CONFIG['/dev/sda1']
+
+    found = diskSet.findPartitionByUuid(uuid)
+    assert found
+    assert found[0] is diskSet['vml.0000']
+    assert found[1].consoleDevicePath == '/dev/sda1'
+    assert diskSet.uuidAliases[uuid] == '/dev/sda1'
+
+    # The second lookup comes from the alias.
+    assert diskSet.findPartitionByUuid(uuid)[1] is found[1]
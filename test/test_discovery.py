@@ -0,0 +1,154 @@
+###############################################################################
+# Copyright (c) 2008-2009 VMware, Inc.
+#
+# This file is part of Weasel.
+#
+# Weasel is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation version 2 and no later version.
+#
+# Weasel is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# version 2 for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin St, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os
+import sys
+import threading
+
+from nose.tools import with_setup
+
+TEST_DIR = os.path.dirname(__file__)
+sys.path.append(os.path.join(TEST_DIR, os.path.pardir))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'faux'))
+import fauxroot
+
+sys.path.append(os.path.join(os.path.dirname(__file__), 'good-config.1'))
+import fauxconfig
+sys.path.pop()
+
+import devices
+import discovery
+
+def setup_disks():
+    fauxroot.FAUXROOT = [os.path.join(TEST_DIR, "good-config.1")]
+    discovery.clearCache()
+    devices.DiskSet(forceReprobe=True)
+    del fauxroot.SYSTEM_LOG[:]
+
+def teardown_disks():
+    fauxroot.FAUXROOT = None
+
+def mountLog():
+    return [cmd for cmd in fauxroot.SYSTEM_LOG
+            if cmd[0] in ('/usr/bin/mount', '/usr/bin/umount')]
+
+@with_setup(setup_disks, teardown_disks)
+def testFindsEsx():
+    report = discovery.getReport('vml.0000')
+
+    assert report.complete
+    assert report.foundEsx
+    assert report.esxVersion == '4'
+    assert report.datastores == ['Storage 1']
+    assert mountLog() == [
+        ['/usr/bin/mount', '-r', '/dev/sda1', '/mnt/discovery/vml.0000'],
+        ['/usr/bin/umount', '/mnt/discovery/vml.0000'],
+        ]
+
+@with_setup(setup_disks, teardown_disks)
+def testNoBootPartition():
+    report = discovery.getReport('vml.0001')
+
+    assert report.complete
+    assert not report.foundEsx
+    assert mountLog() == []
+
+@with_setup(setup_disks, teardown_disks)
+def testCachedUntilDiskChanges():
+    first = discovery.getReport('vml.0000')
+    assert discovery.getReport('vml.0000') is first
+    assert len(mountLog()) == 2
+
+    devices.DiskSet().invalidate('vml.0000')
+    assert discovery.getReport('vml.0000') is not first
+    assert len(mountLog()) == 4
+
+@with_setup(setup_disks, teardown_disks)
+def testDiscoverAllDisks():
+    names = devices.DiskSet().keys()
+    reports = discovery.discoverDisks()
+
+    assert [report.diskName for report in reports] == names
+    found = [report.diskName for report in reports if report.foundEsx]
+    found.sort()
+    assert found == ['vml.0000', 'vml.0006']
+
+    # Each disk gets its own mount point, the order depends on the workers.
+    mounts = [cmd[-1] for cmd in mountLog() if cmd[0] == '/usr/bin/mount']
+    umounts = [cmd[-1] for cmd in mountLog() if cmd[0] == '/usr/bin/umount']
+    mounts.sort()
+    umounts.sort()
+    assert mounts == umounts
+    assert len(mounts) == len(dict.fromkeys(mounts))
+
+@with_setup(setup_disks, teardown_disks)
+def testTimeout():
+    release = threading.Event()
+    calls = []
+
+    def slowInspect(diskName, consoleDevicePath, fsType):
+        calls.append(diskName)
+        release.wait()
+        report = discovery.ExistingEsxReport(diskName)
+        report.foundEsx = True
+        return report
+
+    oldInspect = discovery._inspectPartition
+    discovery._inspectPartition = slowInspect
+    try:
+        report = discovery.getReport('vml.0000', timeout=0.05)
+        assert report.timedOut
+        assert not report.foundEsx
+
+        # The job that is still running is waited on again, the partition
+        # is not mounted a second time.
+        release.set()
+        report = discovery.getReport('vml.0000', timeout=5)
+        assert report.complete
+        assert report.foundEsx
+        assert calls == ['vml.0000']
+    finally:
+        discovery._inspectPartition = oldInspect
+        release.set()
+
+@with_setup(setup_disks, teardown_disks)
+def testDatastoresWhenInspectionFails():
+    def brokenInspect(diskName, consoleDevicePath, fsType):
+        raise Exception("mount failed")
+
+    oldInspect = discovery._inspectPartition
+    discovery._inspectPartition = brokenInspect
+    try:
+        report = discovery.getReport('vml.0000')
+    finally:
+        discovery._inspectPartition = oldInspect
+
+    assert not report.complete
+    assert report.error == "mount failed"
+    assert report.datastores == ['Storage 1']
+
+@with_setup(setup_disks, teardown_disks)
+def testPrefetchReports():
+    discovery.prefetchReports()
+    mounts = len(mountLog())
+    assert mounts > 0
+
+    for diskName in devices.DiskSet().keys():
+        discovery.getReport(diskName)
+    assert len(mountLog()) == mounts
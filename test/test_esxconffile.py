@@ -0,0 +1,78 @@
+
+###############################################################################
+# Copyright (c) 2008-2009 VMware, Inc.
+#
+# This file is part of Weasel.
+#
+# Weasel is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation version 2 and no later version.
+#
+# Weasel is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# version 2 for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin St, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os
+import sys
+import doctest
+import shutil
+import tempfile
+
+TEST_DIR = os.path.dirname(__file__)
+
+sys.path.append(os.path.join(TEST_DIR, os.path.pardir))
+
+import esxconffile
+
+TMP_DIR = None
+
+def setup():
+    global TMP_DIR
+    TMP_DIR = tempfile.mkdtemp(prefix='test_esxconffile')
+
+def teardown():
+    shutil.rmtree(TMP_DIR)
+    esxconffile.clearCache()
+
+def _writeConf(contents, mtime):
+    path = os.path.join(TMP_DIR, 'esx.conf')
+    fileobj = open(path, 'w')
+    fileobj.write(contents)
+    fileobj.close()
+    os.utime(path, (mtime, mtime))
+    return path
+
+def testDoctests():
+    failures, _total = doctest.testmod(esxconffile)
+    assert failures == 0
+
+def testCache():
+    path = _writeConf('/system/uuid = "1234"\n', 1000)
+    first = esxconffile.getEsxConf(path)
+    assert first['/system/uuid'] == '1234'
+    assert esxconffile.getEsxConf(path) is first
+
+    path = _writeConf('/system/uuid = "5678"\n', 2000)
+    second = esxconffile.getEsxConf(path)
+    assert second is not first
+    assert second['/system/uuid'] == '5678'
+    assert second.digest != first.digest
+
+    assert esxconffile.getEsxConf(path, refresh=True) is not second
+
+def testQuotedValues():
+    conf = esxconffile.EsxConf(data=
+        '/a = "plain"\n'
+        '/b = "with \\"quotes\\""\n'
+        '/a = "ignored"\n'
+        'not a setting\n')
+
+    assert conf['/a'] == 'plain'
+    assert conf['/b'] == 'with "quotes"'
+    assert len(conf) == 2
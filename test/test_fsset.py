@@ -0,0 +1,184 @@
+
+###############################################################################
+# Copyright (c) 2008-2009 VMware, Inc.
+#
+# This file is part of Weasel.
+#
+# Weasel is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation version 2 and no later version.
+#
+# Weasel is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# version 2 for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin St, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os
+import sys
+import time
+
+TEST_DIR = os.path.dirname(__file__)
+sys.path.append(os.path.join(TEST_DIR, os.path.pardir))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'faux'))
+import fauxroot
+
+sys.path.append(os.path.join(os.path.dirname(__file__), 'good-config.1'))
+import fauxconfig
+sys.path.pop()
+
+import fsset
+import util
+from exception import InstallationError
+
+class FakeClock:
+    '''Stands in for time.time() and time.sleep() so the polling can be
+    checked without waiting.'''
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.sleeps.append(secs)
+        self.now += secs
+
+def _wait(entriesFunc, timeout=fsset.VMFS_SETTLE_TIMEOUT, **kwargs):
+    clock = FakeClock()
+
+    oldEntries = fsset.getVmfsVolumeEntries
+    oldTime, oldSleep = time.time, time.sleep
+    fsset.getVmfsVolumeEntries = entriesFunc
+    time.time, time.sleep = clock.time, clock.sleep
+    try:
+        result = fsset.waitForVmfsVolumes(timeout=timeout, **kwargs)
+    finally:
+        fsset.getVmfsVolumeEntries = oldEntries
+        time.time, time.sleep = oldTime, oldSleep
+
+    return result, clock
+
+def _polls(entryLists):
+    '''Return a function that gives each list in turn, then the last one.'''
+    polls = list(entryLists)
+    def fakeEntries():
+        if len(polls) > 1:
+            return polls.pop(0)
+        return polls[0]
+    return fakeEntries
+
+def testVmfsSettledImmediately():
+    vols = [('4a1c', None), ('datastore1', '4a1c')]
+    result, clock = _wait(_polls([vols]))
+
+    # a rescan that doesn't show any changes yet still gets the minimum
+    assert result == vols
+    assert clock.sleeps == [0.25, 0.5, 1.0, 2.0], clock.sleeps
+    assert clock.now >= fsset.VMFS_SETTLE_MINIMUM
+
+def testVmfsSettleBackoff():
+    vols = [('4a1c', None), ('datastore1', '4a1c')]
+    result, clock = _wait(_polls([vols[:1], vols[:1] + [('x', None)],
+                                  vols, vols]), minimum=0)
+
+    assert result == vols
+    assert clock.sleeps == [0.25, 0.5, 1.0], clock.sleeps
+
+def testVmfsGoneVolumes():
+    vols = [('4a1c', None), ('datastore1', '4a1c')]
+    # the cleared volume hangs around, unchanged, for a while
+    result, clock = _wait(_polls([vols] * 6 + [[]]),
+                          goneVolumes=['4a1c', 'datastore1'])
+
+    assert result == []
+    assert clock.sleeps == [0.25, 0.5, 1.0, 2.0, 2.0, 2.0, 2.0], clock.sleeps
+
+def testVmfsNewVolumes():
+    vols = [('4a1c', None), ('datastore1', '4a1c')]
+    result, clock = _wait(_polls([[]] * 5 + [vols[:1], vols]),
+                          newVolumes=['datastore1'], minimum=0)
+
+    assert result == vols
+    assert len(clock.sleeps) == 7, clock.sleeps
+
+def testVmfsGoneVolumesTimeout():
+    vols = [('4a1c', None), ('datastore1', '4a1c')]
+    result, clock = _wait(_polls([vols]), 10.0, goneVolumes=['datastore1'])
+
+    assert result == vols
+    assert clock.now == 10.0, clock.now
+
+def testVmfsSettleTimeout():
+    counter = [0]
+    def changing():
+        counter[0] += 1
+        return [(str(counter[0]), None)]
+
+    _result, clock = _wait(changing, 5.0)
+
+    assert clock.now == 5.0, clock.now
+    assert max(clock.sleeps) <= fsset.VMFS_SETTLE_MAX_POLL
+
+class FakeExec:
+    '''Stands in for util.execWithLog, records the commands and fails the
+    ones run with the given programs.'''
+
+    def __init__(self, failing=()):
+        self.failing = failing
+        self.commands = []
+
+    def __call__(self, command, argv, **kwargs):
+        self.commands.append(argv)
+        if command in self.failing:
+            raise util.ExecError(" ".join(argv), "failed\n", 1)
+        return 0
+
+def _format(fakeExec, **kwargs):
+    oldExec = util.execWithLog
+    util.execWithLog = fakeExec
+    try:
+        fsset.ext3FileSystem(**kwargs).formatDevice('/dev/sda1')
+    finally:
+        util.execWithLog = oldExec
+
+def testExt3FormatArgs():
+    fs = fsset.ext3FileSystem(label='esx-root', inodeRatio=4096,
+                              journalSizeMB=32)
+    assert fs.getJournalledFormatArgs('/dev/sda1') == \
+           ['/usr/sbin/mke2fs', '-j', '-L', 'esx-root', '-i', '4096',
+            '-J', 'size=32', '/dev/sda1']
+
+def testExt3Format():
+    fakeExec = FakeExec()
+    _format(fakeExec, label='esx-root')
+    assert fakeExec.commands == [
+        ['/usr/sbin/mke2fs', '-j', '-L', 'esx-root', '/dev/sda1'],
+        ['/usr/sbin/tune2fs', '-c0', '-i0', '/dev/sda1']]
+
+def testExt3FormatFallback():
+    # any failure of the single pass falls back to adding the journal after
+    fakeExec = FakeExec(['/usr/sbin/mke2fs'])
+    _format(fakeExec, label='esx-root', journalSizeMB=32)
+    assert fakeExec.commands == [
+        ['/usr/sbin/mke2fs', '-j', '-L', 'esx-root', '-J', 'size=32',
+         '/dev/sda1'],
+        ['/usr/sbin/mkfs.ext2', '-L', 'esx-root', '/dev/sda1'],
+        ['/usr/sbin/tune2fs', '-j', '-J', 'size=32', '/dev/sda1'],
+        ['/usr/sbin/tune2fs', '-c0', '-i0', '/dev/sda1']]
+
+def testExt3FormatFails():
+    fakeExec = FakeExec(['/usr/sbin/mke2fs', '/usr/sbin/mkfs.ext2'])
+    try:
+        _format(fakeExec)
+        assert False, "the format should have failed"
+    except InstallationError:
+        pass
+    assert [argv[0] for argv in fakeExec.commands] == \
+           ['/usr/sbin/mke2fs', '/usr/sbin/mkfs.ext2']
@@ -87,6 +87,12 @@ def test_gui():
 
         import media
         reload(media)
+
+        import esxconffile
+        esxconffile.clearCache()
+
+        import discovery
+        discovery.clearCache()
         
         import gui
         reload(gui)
@@ -0,0 +1,96 @@
+
+###############################################################################
+# Copyright (c) 2008-2009 VMware, Inc.
+#
+# This file is part of Weasel.
+#
+# Weasel is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation version 2 and no later version.
+#
+# Weasel is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# version 2 for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin St, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+
+TEST_DIR = os.path.dirname(__file__)
+
+sys.path.append(os.path.join(TEST_DIR, os.path.pardir))
+
+import initrd
+
+TMP_DIR = None
+
+def setup():
+    global TMP_DIR
+    TMP_DIR = tempfile.mkdtemp(prefix='test_initrd')
+
+def teardown():
+    shutil.rmtree(TMP_DIR)
+
+def _writeInitrd(name, archives, compress=True):
+    '''Write the archives, each a list of (name, data) pairs, one after
+    another like grubupdate.appendConfToInitrd does.'''
+    path = os.path.join(TMP_DIR, name)
+    open(path, 'wb').close()
+    for files in archives:
+        data = initrd.makeNewcArchive(files)
+        if compress:
+            fileobj = gzip.GzipFile(path, 'ab')
+        else:
+            fileobj = open(path, 'ab')
+        fileobj.write(data)
+        fileobj.close()
+    return path
+
+def testReadMember():
+    path = _writeInitrd('simple.img', [
+        [('init', '#! /bin/sh\n'),
+         ('etc/vmware/esx.conf', '/boot/cosvmdk = "/vmfs/x.vmdk"\n')]])
+
+    assert initrd.readMember(path, '/etc/vmware/esx.conf') == \
+        '/boot/cosvmdk = "/vmfs/x.vmdk"\n'
+    assert initrd.readMember(path, 'init') == '#! /bin/sh\n'
+    assert initrd.readMember(path, 'etc/hosts') is None
+
+def testUncompressed():
+    path = _writeInitrd('raw.img', [[('./etc/hosts', 'localhost\n')]],
+                        compress=False)
+
+    assert initrd.readMember(path, 'etc/hosts') == 'localhost\n'
+
+def testConcatenated():
+    path = _writeInitrd('appended.img', [
+        [('etc/vmware/esx.conf', 'original\n'), ('etc/odd', 'x' * 5)],
+        [('etc/hosts', '127.0.0.1 localhost\n'),
+         ('etc/vmware/esx.conf', 'appended\n')]])
+
+    assert initrd.readMember(path, 'etc/hosts') == '127.0.0.1 localhost\n'
+    assert initrd.readMember(path, 'etc/vmware/esx.conf') == 'original\n'
+    assert initrd.readMember(path, 'etc/vmware/esx.conf',
+                             last=True) == 'appended\n'
+
+def testStopsAtFirstMatch():
+    path = _writeInitrd('junk.img', [[('etc/hosts', 'localhost\n')]],
+                        compress=False)
+    fileobj = open(path, 'ab')
+    fileobj.write('this is not a cpio archive')
+    fileobj.close()
+
+    assert initrd.readMember(path, 'etc/hosts') == 'localhost\n'
+    try:
+        initrd.readMember(path, 'etc/missing')
+        assert False, "read through a corrupt archive"
+    except initrd.InitrdError:
+        pass
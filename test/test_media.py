@@ -0,0 +1,303 @@
+
+###############################################################################
+# Copyright (c) 2008-2009 VMware, Inc.
+#
+# This file is part of Weasel.
+#
+# Weasel is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation version 2 and no later version.
+#
+# Weasel is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# version 2 for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin St, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os
+import sys
+import shutil
+import tempfile
+
+from nose.tools import with_setup
+
+TEST_DIR = os.path.dirname(__file__)
+sys.path.append(os.path.join(TEST_DIR, os.path.pardir))
+sys.path.insert(0, os.path.join(TEST_DIR, 'faux'))
+import fauxroot
+
+sys.path.append(os.path.join(TEST_DIR, 'good-config.1'))
+import fauxconfig
+sys.path.pop()
+
+import brandiso
+import media
+import task_progress
+import userchoices
+
+from test_brandiso import IMAGE_SECTORS
+
+tmpDir = None
+
+class FakeDelegate:
+    def __init__(self):
+        self.results = []
+
+    def mountMediaCheckSuccess(self):
+        self.results.append('success')
+
+    def mountMediaCheckFailed(self):
+        self.results.append('failed')
+
+class CancelListener:
+    '''Cancels the media check once the hash gets past an offset.'''
+
+    def __init__(self, cancelAt):
+        self.cancelAt = cancelAt
+        self.amount = 0
+
+    def notifyTaskStarted(self, taskTitle):
+        self.amount = 0
+
+    def notifyTaskProgress(self, taskTitle, amountCompleted):
+        self.amount += amountCompleted
+        if self.amount >= self.cancelAt:
+            media.cancelMediaCheck()
+            self.cancelAt = sys.maxint
+
+    def notifyTaskFinish(self, taskTitle):
+        pass
+
+class CallRecorder:
+    '''Wraps calc_md5 and remembers the offset each call started from.'''
+
+    def __init__(self, func):
+        self.func = func
+        self.starts = []
+
+    def __call__(self, *args, **kwargs):
+        checkpoint = kwargs.get('checkpoint')
+        self.starts.append(checkpoint and checkpoint.offset)
+        return self.func(*args, **kwargs)
+
+def setup_media():
+    global tmpDir
+    tmpDir = tempfile.mkdtemp()
+
+    import test_brandiso
+    test_brandiso.tmpDir = tmpDir
+
+    # check real images instead of the fake one
+    brandiso.extract_iso_checksums = fauxconfig.oldextractISOChecksums
+
+    media.MEDIA_CHECKED = False
+    media.MEDIA_CHECKPOINT = None
+    media.MEDIA_CHECKPOINT_KEY = None
+    media.MEDIA_DEVICE_MOUNT_POINT = os.path.join(tmpDir, 'mnt')
+    os.makedirs(media.MEDIA_DEVICE_MOUNT_POINT)
+    userchoices.setMediaCheck(True)
+    userchoices.setMediaCheckState(os.path.join(tmpDir, 'state',
+                                                'mediacheck'))
+
+def teardown_media():
+    brandiso.extract_iso_checksums = fauxconfig.extractISOChecksums
+    media.MEDIA_DEVICE_MOUNT_POINT = oldMountPoint
+    userchoices.setMediaCheck(False)
+    userchoices.setMediaCheckFiles(False)
+    userchoices.clearMediaCheckState()
+    userchoices.setMediaDescriptor(None)
+    shutil.rmtree(tmpDir)
+
+oldMountPoint = media.MEDIA_DEVICE_MOUNT_POINT
+
+def _brandedImage(name='test.iso', idStr='Test ISO'):
+    from test_brandiso import _makeImage
+
+    path = _makeImage(name)
+    brandiso.brand_iso(path, idStr)
+    userchoices.setMediaDescriptor(media.MediaDescriptor(isoPath=path,
+                                                         partPath=path))
+    return path
+
+def _check():
+    delegate = FakeDelegate()
+    try:
+        retval = media.runtimeActionMediaCheck(delegate)
+    except SystemExit:
+        retval = 'exit'
+    return retval, delegate.results
+
+def _stateLines():
+    return open(media._getMediaCheckStatePath()).read().splitlines()
+
+def _corrupt(path):
+    img = open(path, 'r+b')
+    img.seek(-100, brandiso.SEEK_END)
+    img.write('\0' if img.read(1) != '\0' else '\1')
+    img.close()
+
+def testStatePath():
+    userchoices.clearMediaCheckState()
+    assert media._getMediaCheckStatePath() == media.MEDIA_CHECK_STATE_PATH
+    userchoices.setMediaCheckState('/mnt/usb/mediacheck')
+    assert media._getMediaCheckStatePath() == '/mnt/usb/mediacheck'
+    userchoices.clearMediaCheckState()
+
+@with_setup(setup_media, teardown_media)
+def testPassedMediaIsSkipped():
+    _brandedImage()
+    assert _check() == (True, ['success'])
+
+    written, idStr = brandiso.read_iso_brand(
+        userchoices.getMediaDescriptor().partPath)
+    key = "%s %s" % (brandiso.pretty(written), idStr.strip())
+    assert _stateLines() == [key]
+
+    # the next boot does not read the image again
+    media.MEDIA_CHECKED = False
+    oldCalc = brandiso.calc_md5
+    brandiso.calc_md5 = CallRecorder(oldCalc)
+    try:
+        assert _check() == (True, ['success'])
+        assert brandiso.calc_md5.starts == []
+    finally:
+        brandiso.calc_md5 = oldCalc
+    assert _stateLines() == [key]
+
+@with_setup(setup_media, teardown_media)
+def testFailedMediaIsNotRecorded():
+    path = _brandedImage()
+    _corrupt(path)
+
+    assert _check() == ('exit', ['failed'])
+    assert not media.MEDIA_CHECKED
+    assert not os.path.exists(media._getMediaCheckStatePath())
+
+@with_setup(setup_media, teardown_media)
+def testCancelledCheckResumes():
+    _brandedImage()
+
+    oldBlockSize = brandiso.READ_AHEAD_BLOCK_SIZE
+    brandiso.READ_AHEAD_BLOCK_SIZE = 8192
+    oldCalc = brandiso.calc_md5
+    brandiso.calc_md5 = CallRecorder(oldCalc)
+    listener = CancelListener(8192 * 2)
+    task_progress.addNotificationListener(listener)
+    try:
+        assert _check() == (None, [])
+        assert not media.MEDIA_CHECKED
+        checkpoint = media.MEDIA_CHECKPOINT
+        assert checkpoint.offset == 8192 * 2
+
+        assert _check() == (True, ['success'])
+        assert media.MEDIA_CHECKED
+        assert media.MEDIA_CHECKPOINT is checkpoint
+        assert brandiso.calc_md5.starts == [0, 8192 * 2]
+        assert checkpoint.offset == IMAGE_SECTORS * brandiso.SECTOR_SIZE
+    finally:
+        task_progress.removeNotificationListener(listener)
+        brandiso.calc_md5 = oldCalc
+        brandiso.READ_AHEAD_BLOCK_SIZE = oldBlockSize
+
+@with_setup(setup_media, teardown_media)
+def testCheckpointIsPerImage():
+    _brandedImage('first.iso', 'First ISO')
+    first = media._getCheckpoint('first')
+    first.offset = 1234
+    assert media._getCheckpoint('first') is first
+
+    # a different image starts over
+    second = media._getCheckpoint('second')
+    assert second is not first
+    assert second.offset == 0
+
+    # and so does one without a brand
+    assert media._getCheckpoint(None) is not second
+
+@with_setup(setup_media, teardown_media)
+def testCancelWithoutCheck():
+    # nothing has been checked yet
+    media.cancelMediaCheck()
+    assert media.MEDIA_CHECKPOINT is None
+
+@with_setup(setup_media, teardown_media)
+def testCorruptStateFileIsIgnored():
+    _brandedImage()
+
+    statePath = media._getMediaCheckStatePath()
+    os.makedirs(os.path.dirname(statePath))
+    stateFile = open(statePath, 'wb')
+    stateFile.write('\0\xff\xfe garbage\nnot a checksum')
+    stateFile.close()
+
+    assert _check() == (True, ['success'])
+    assert media.MEDIA_CHECKED
+    lines = _stateLines()
+    assert len(lines) == 3
+
+    # and the image is found the next time
+    media.MEDIA_CHECKED = False
+    assert media._isCheckedMedia(lines[-1])
+
+@with_setup(setup_media, teardown_media)
+def testUnwritableStateFile():
+    _brandedImage()
+    # a directory can't be read or written as the state file
+    os.makedirs(media._getMediaCheckStatePath())
+
+    assert _check() == (True, ['success'])
+    assert media.MEDIA_CHECKED
+
+def _mountedMedia():
+    open(os.path.join(media.MEDIA_DEVICE_MOUNT_POINT, 'packages.xml'),
+         'w').close()
+    out = open(os.path.join(media.MEDIA_DEVICE_MOUNT_POINT, 'a.rpm'), 'w')
+    out.write('a' * 5000)
+    out.close()
+    userchoices.setMediaCheckFiles(True)
+
+@with_setup(setup_media, teardown_media)
+def testMediaCheckFiles():
+    path = _brandedImage()
+    _mountedMedia()
+    brandiso.write_file_checksums(media.MEDIA_DEVICE_MOUNT_POINT)
+    # the image is not read, only the files
+    _corrupt(path)
+
+    assert _check() == (True, ['success'])
+    assert media.MEDIA_CHECKED
+    assert len(_stateLines()) == 1
+
+@with_setup(setup_media, teardown_media)
+def testMediaCheckFilesMismatch():
+    _brandedImage()
+    _mountedMedia()
+    brandiso.write_file_checksums(media.MEDIA_DEVICE_MOUNT_POINT)
+    out = open(os.path.join(media.MEDIA_DEVICE_MOUNT_POINT, 'a.rpm'), 'a')
+    out.write('corrupt')
+    out.close()
+
+    assert _check() == ('exit', ['failed'])
+    assert not os.path.exists(media._getMediaCheckStatePath())
+
+@with_setup(setup_media, teardown_media)
+def testMediaCheckFilesWithoutChecksums():
+    _brandedImage()
+    _mountedMedia()
+
+    calls = []
+    oldUnmount = media.runtimeActionUnmountMedia
+    oldMount = media.runtimeActionMountMedia
+    media.runtimeActionUnmountMedia = lambda: calls.append('unmount')
+    media.runtimeActionMountMedia = lambda *args: calls.append('mount')
+    try:
+        # falls back to checking the whole image
+        assert _check() == (True, ['success'])
+    finally:
+        media.runtimeActionUnmountMedia = oldUnmount
+        media.runtimeActionMountMedia = oldMount
+    assert calls == ['unmount', 'mount']
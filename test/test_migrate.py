@@ -0,0 +1,153 @@
+###############################################################################
+# Copyright (c) 2008-2009 VMware, Inc.
+#
+# This file is part of Weasel.
+#
+# Weasel is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation version 2 and no later version.
+#
+# Weasel is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# version 2 for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin St, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os
+import sys
+
+from nose.tools import with_setup
+
+TEST_DIR = os.path.dirname(__file__)
+sys.path.append(os.path.join(TEST_DIR, os.path.pardir))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'faux'))
+import fauxroot
+
+sys.path.append(os.path.join(os.path.dirname(__file__), 'good-config.1'))
+import fauxconfig
+sys.path.pop()
+
+import consts
+import migrate
+import migration
+
+OLD_ROOT = consts.HOST_ROOT + consts.ESX3_INSTALLATION.lstrip('/')
+
+def writeFile(path, contents):
+    fp = open(path, 'w')
+    fp.write(contents)
+    fp.close()
+
+def readFile(path):
+    return open(path).read()
+
+def setup_tree():
+    fauxroot.resetLogs()
+    fauxroot.FAUXROOT = [os.path.join(TEST_DIR, "good-config.1")]
+
+    os.makedirs(OLD_ROOT + "/etc/mtest")
+    os.makedirs(OLD_ROOT + "/etc/mtest/sub")
+    for index in range(5):
+        writeFile(OLD_ROOT + "/etc/mtest/file%d" % index, "x" * index)
+    writeFile(OLD_ROOT + "/etc/mtest/sub/nested", "nested\n")
+    writeFile(OLD_ROOT + "/etc/mtest.conf", "include /etc/mtest-extra\n")
+    writeFile(OLD_ROOT + "/etc/mtest-extra", "extra\n")
+
+def teardown_tree():
+    fauxroot.FAUXROOT = None
+
+def planPaths(plan):
+    retval = [(entry.kind, entry.path) for entry in plan.entries]
+    retval.sort()
+    return retval
+
+@with_setup(setup_tree, teardown_tree)
+def testPlanOverlappingGlobs():
+    plan = migrate.MigrationPlan()
+    assert plan.addPath("/etc/mtest") == 1
+    assert plan.addPath("/etc/mtest/file*") == 5
+    assert plan.addPath("/etc/mtest-missing") == 0
+
+    assert planPaths(plan) == [
+        ('dir', '/etc/mtest'),
+        ('dir', '/etc/mtest/sub'),
+        ('file', '/etc/mtest/file0'),
+        ('file', '/etc/mtest/file1'),
+        ('file', '/etc/mtest/file2'),
+        ('file', '/etc/mtest/file3'),
+        ('file', '/etc/mtest/file4'),
+        ('file', '/etc/mtest/sub/nested'),
+        ]
+    assert plan.totalSize == 0 + 1 + 2 + 3 + 4 + len("nested\n")
+
+    # Directories come before anything inside of them.
+    paths = [entry.path for entry in plan.entries]
+    assert paths.index('/etc/mtest') < paths.index('/etc/mtest/sub')
+    assert paths.index('/etc/mtest/sub') < paths.index('/etc/mtest/sub/nested')
+
+@with_setup(setup_tree, teardown_tree)
+def testExecuteInBatches():
+    newRoot = consts.HOST_ROOT
+    writeFile(newRoot + "etc/mtest/file0", "from the new install\n")
+
+    oldBatchSize = migrate.MIGRATE_BATCH_SIZE
+    migrate.MIGRATE_BATCH_SIZE = 2
+    try:
+        migrate.migratePaths(["/etc/mtest"])
+    finally:
+        migrate.MIGRATE_BATCH_SIZE = oldBatchSize
+
+    for index in range(5):
+        assert readFile(newRoot + "etc/mtest/file%d" % index) == "x" * index
+    assert readFile(newRoot + "etc/mtest/sub/nested") == "nested\n"
+    assert readFile(newRoot + "etc/mtest/file0.esx4") == \
+           "from the new install\n"
+
+@with_setup(setup_tree, teardown_tree)
+def testHandlerAddsPaths():
+    calls = []
+    def handler(oldPath, newPath, accum):
+        calls.append(newPath)
+        accum.append("/etc/mtest-extra")
+        writeFile(newPath, "handled\n")
+        return False
+
+    migration.MIGRATION_HANDLERS["/etc/mtest.conf"] = handler
+    try:
+        plan = migrate.MigrationPlan()
+        plan.addPath("/etc/mtest.conf")
+        plan.addPath("/etc/mtest.conf")
+        plan.addPath("/etc/mtest-extra")
+        plan.execute()
+    finally:
+        del migration.MIGRATION_HANDLERS["/etc/mtest.conf"]
+
+    assert calls == [consts.HOST_ROOT + "etc/mtest.conf"]
+    assert planPaths(plan) == [('file', '/etc/mtest-extra')]
+    assert readFile(consts.HOST_ROOT + "etc/mtest.conf") == "handled\n"
+    assert readFile(consts.HOST_ROOT + "etc/mtest-extra") == "extra\n"
+
+@with_setup(setup_tree, teardown_tree)
+def testDryRun():
+    calls = []
+    def handler(oldPath, newPath, accum):
+        calls.append(newPath)
+        return False
+
+    migration.MIGRATION_HANDLERS["/etc/mtest.conf"] = handler
+    try:
+        plan = migrate.planMigration(["/etc/mtest.conf", "/etc/mtest/file*"],
+                                     dryRun=True)
+    finally:
+        del migration.MIGRATION_HANDLERS["/etc/mtest.conf"]
+
+    assert calls == []
+    assert plan.handled == [("/etc/mtest.conf", "handler")]
+    assert ("/etc/mtest.conf", "file", len("include /etc/mtest-extra\n"),
+            "handler", None) in plan.getManifest()
+    assert plan.totalSize == len("include /etc/mtest-extra\n") + 1 + 2 + 3 + 4
+    assert not os.path.exists(consts.HOST_ROOT + "etc/mtest.conf")
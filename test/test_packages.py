@@ -0,0 +1,544 @@
+
+###############################################################################
+# Copyright (c) 2008-2009 VMware, Inc.
+#
+# This file is part of Weasel.
+#
+# Weasel is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation version 2 and no later version.
+#
+# Weasel is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# version 2 for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin St, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os
+import sys
+import threading
+
+TEST_DIR = os.path.dirname(__file__)
+DEFAULT_CONFIG_NAME = "good-config.1"
+
+sys.path.append(os.path.join(TEST_DIR, os.path.pardir))
+sys.path.insert(0, os.path.join(TEST_DIR, 'faux'))
+
+import fauxroot
+
+sys.path.append(os.path.join(TEST_DIR, DEFAULT_CONFIG_NAME))
+import fauxconfig
+sys.path.pop()
+
+import packages
+from remote_files import RemoteFileError
+
+class FakePackage:
+    '''Stands in for packages.Package in the prefetcher.  The downloads block
+    until the test lets them finish.'''
+
+    def __init__(self, name, pkgSize=1, failures=0):
+        self.fullSrcPath = 'http://some.server/VMware/RPMS/%s.rpm' % name
+        self.pkgSize = pkgSize
+        self.failures = failures
+        self.started = threading.Event()
+        self.finish = threading.Event()
+        self.downloads = []
+        self.discarded = False
+
+    def ensureFileDownloaded(self):
+        self.downloads.append(threading.currentThread().getName())
+        self.started.set()
+        self.finish.wait(5)
+        if self.failures:
+            self.failures -= 1
+            raise RemoteFileError("download failed")
+        return True
+
+    def discardDownload(self):
+        self.discarded = True
+
+    def __repr__(self):
+        return os.path.basename(self.fullSrcPath)
+
+setupCalls = []
+def recordSetup(urls):
+    setupCalls.append((list(urls), threading.currentThread().getName()))
+
+def failSetup(urls):
+    raise RemoteFileError("network is down")
+
+oldPrepare = packages.prepareRemoteAccess
+def setup():
+    packages.prepareRemoteAccess = recordSetup
+
+def teardown():
+    packages.prepareRemoteAccess = oldPrepare
+
+def _queued(prefetcher):
+    names = [repr(pkg) for pkg in prefetcher.jobs.keys()]
+    names.sort()
+    return names
+
+def _finishAll(pkgs):
+    for pkg in pkgs:
+        pkg.finish.set()
+
+def _stop(prefetcher, pkgs):
+    '''Let the downloads finish and wait for the workers to exit.'''
+    _finishAll(pkgs)
+    threads = list(prefetcher.pool._threads)
+    prefetcher.shutdown()
+    for thread in threads:
+        thread.join(5)
+
+def testSetupBeforeWorkers():
+    del setupCalls[:]
+    pkgs = [FakePackage('a'), FakePackage('b')]
+    _finishAll(pkgs)
+    prefetcher = packages.PackagePrefetcher(pkgs, depth=2)
+    try:
+        for pkg in pkgs:
+            prefetcher.fetch(pkg)
+    finally:
+        _stop(prefetcher, pkgs)
+
+    assert setupCalls == [([pkg.fullSrcPath for pkg in pkgs],
+                           threading.currentThread().getName())]
+    for pkg in pkgs:
+        assert pkg.downloads[0].startswith('prefetch-')
+
+def testDepthLimit():
+    pkgs = [FakePackage(name) for name in 'abcde']
+    prefetcher = packages.PackagePrefetcher(pkgs, depth=2)
+    try:
+        assert _queued(prefetcher) == ['a.rpm', 'b.rpm']
+        assert prefetcher.pending == pkgs[2:]
+    finally:
+        _stop(prefetcher, pkgs)
+
+def testBudgetLimit():
+    pkgs = [FakePackage('a', 30), FakePackage('b', 30), FakePackage('c', 30)]
+    prefetcher = packages.PackagePrefetcher(pkgs, depth=3, budget=70)
+    try:
+        assert _queued(prefetcher) == ['a.rpm', 'b.rpm']
+        assert prefetcher.outstanding == 60
+    finally:
+        _stop(prefetcher, pkgs)
+
+def testBigPackageAlwaysAllowed():
+    pkgs = [FakePackage('a', 100), FakePackage('b', 1)]
+    prefetcher = packages.PackagePrefetcher(pkgs, depth=2, budget=10)
+    try:
+        # the first package is bigger than the budget but rpmlib needs it
+        assert _queued(prefetcher) == ['a.rpm']
+    finally:
+        _stop(prefetcher, pkgs)
+
+def testRelease():
+    pkgs = [FakePackage('a', 30), FakePackage('b', 30), FakePackage('c', 30)]
+    prefetcher = packages.PackagePrefetcher(pkgs, depth=2, budget=60)
+    try:
+        assert _queued(prefetcher) == ['a.rpm', 'b.rpm']
+
+        pkgs[0].finish.set()
+        prefetcher.fetch(pkgs[0])
+        # still counted against the budget until it is released
+        assert _queued(prefetcher) == ['a.rpm', 'b.rpm']
+
+        prefetcher.release(pkgs[0])
+        assert _queued(prefetcher) == ['b.rpm', 'c.rpm']
+        assert prefetcher.outstanding == 60
+        assert prefetcher.pending == []
+    finally:
+        _stop(prefetcher, pkgs)
+
+def testFailedFetchIsRetried():
+    pkg = FakePackage('a', failures=1)
+    pkg.finish.set()
+    prefetcher = packages.PackagePrefetcher([pkg], depth=1)
+    try:
+        prefetcher.fetch(pkg)
+    finally:
+        _stop(prefetcher, [pkg])
+
+    # the background download failed, so it was tried again in the
+    # foreground
+    assert len(pkg.downloads) == 2
+    assert pkg.downloads[0].startswith('prefetch-')
+    assert pkg.downloads[1] == threading.currentThread().getName()
+
+def testOutOfOrderFetch():
+    pkgs = [FakePackage(name) for name in 'abc']
+    prefetcher = packages.PackagePrefetcher(pkgs, depth=1)
+    try:
+        pkgs[2].finish.set()
+        prefetcher.fetch(pkgs[2])
+        assert pkgs[2].downloads == [threading.currentThread().getName()]
+        assert pkgs[2] not in prefetcher.pending
+    finally:
+        _stop(prefetcher, pkgs)
+
+def testSetupFailure():
+    pkgs = [FakePackage('a'), FakePackage('b')]
+    _finishAll(pkgs)
+    packages.prepareRemoteAccess = failSetup
+    try:
+        prefetcher = packages.PackagePrefetcher(pkgs, depth=2)
+    finally:
+        packages.prepareRemoteAccess = recordSetup
+    try:
+        # nothing is prefetched, each package is downloaded when asked for
+        assert prefetcher.jobs == {}
+        prefetcher.fetch(pkgs[0])
+        assert pkgs[0].downloads == [threading.currentThread().getName()]
+        assert pkgs[1].downloads == []
+    finally:
+        _stop(prefetcher, pkgs)
+
+def testShutdown():
+    pkgs = [FakePackage(name) for name in 'abc']
+    prefetcher = packages.PackagePrefetcher(pkgs, depth=2)
+    pkgs[0].started.wait(5)
+    pkgs[1].started.wait(5)
+
+    stopper = threading.Thread(target=prefetcher.shutdown)
+    stopper.start()
+    # the downloads that are running are waited for
+    stopper.join(0.2)
+    assert stopper.isAlive()
+    assert not pkgs[0].discarded
+
+    _finishAll(pkgs)
+    stopper.join(5)
+    assert not stopper.isAlive()
+    assert prefetcher.pending == []
+    assert prefetcher.jobs == {}
+    assert [pkg.discarded for pkg in pkgs] == [True, True, False]
+    assert pkgs[2].downloads == []
+
+    # nothing else is started after a release
+    prefetcher.release(pkgs[0])
+    assert prefetcher.jobs == {}
+
+def testShutdownCancelsQueued():
+    import workerpool
+
+    # one worker for two jobs, so the second one is still queued
+    oldPool = packages.WorkerPool
+    packages.WorkerPool = lambda depth, name: workerpool.WorkerPool(1, name)
+    try:
+        pkgs = [FakePackage('a'), FakePackage('b')]
+        prefetcher = packages.PackagePrefetcher(pkgs, depth=2)
+    finally:
+        packages.WorkerPool = oldPool
+    pkgs[0].started.wait(5)
+    queued = prefetcher.jobs[pkgs[1]]
+
+    stopper = threading.Thread(target=prefetcher.shutdown)
+    stopper.start()
+    # cancelled while the worker is still busy with the first package
+    assert queued.wait(5)
+    pkgs[0].finish.set()
+    stopper.join(5)
+
+    assert queued.cancelled
+    assert pkgs[1].downloads == []
+    # the queued package may have a header fragment that has to go too
+    assert pkgs[0].discarded and pkgs[1].discarded
+
+# -----------------------------------------------------------------------------
+class HeaderPackage(packages.Package):
+    '''A real Package whose header is "parsed" without rpmlib.'''
+
+    parsed = []
+
+    @staticmethod
+    def readRPMHeader(fileName):
+        HeaderPackage.parsed.append((fileName,
+                                     threading.currentThread().getName()))
+        return {'name' : os.path.basename(fileName)}
+
+class FakePackageData:
+    def __init__(self, headers):
+        self.headers = headers
+        self.asked = []
+
+    def getHeader(self, basename):
+        self.asked.append(basename)
+        return self.headers.get(basename)
+
+class FakeWeaselConfig:
+    packageGroups = None
+    prefetchDepth = 0
+    prefetchBudgetMB = 0
+
+downloads = []
+def recordDownload(url, requestAmount=None, **kwargs):
+    downloads.append((url, requestAmount, threading.currentThread().getName()))
+    return '/tmp/%s' % os.path.basename(url)
+
+def _headerPackages(names):
+    pkgs = packages.Packages(initTS=False, weaselConfig=FakeWeaselConfig())
+    for name in names:
+        pkgs.packages.append(HeaderPackage(
+            'http://some.server/VMware/RPMS/%s.rpm' % name, 'required',
+            100, 400, 1000, name))
+    return pkgs
+
+def _setupHeaders():
+    del setupCalls[:]
+    del downloads[:]
+    del HeaderPackage.parsed[:]
+    packages.downloadLocally = recordDownload
+
+oldDownloadLocally = packages.downloadLocally
+def _teardownHeaders():
+    packages.downloadLocally = oldDownloadLocally
+
+def testLoadHeadersFromIndex():
+    _setupHeaders()
+    try:
+        pkgs = _headerPackages(['a', 'b'])
+        pkgs.packageData = FakePackageData({'a.rpm' : {'name' : 'a'},
+                                            'b.rpm' : {'name' : 'b'}})
+        pkgs.loadHeaders()
+    finally:
+        _teardownHeaders()
+
+    assert [pkg.header['name'] for pkg in pkgs.packages] == ['a', 'b']
+    assert pkgs.packageData.asked == ['a.rpm', 'b.rpm']
+    # nothing is downloaded, so the network is not needed
+    assert downloads == []
+    assert setupCalls == []
+
+def testLoadHeadersFallback():
+    mainThread = threading.currentThread().getName()
+    _setupHeaders()
+    try:
+        pkgs = _headerPackages(['a', 'b', 'c'])
+        # 'b' is missing from the header index
+        pkgs.packageData = FakePackageData({'a.rpm' : {'name' : 'a'},
+                                            'c.rpm' : {'name' : 'c'}})
+        pkgs.loadHeaders(numWorkers=2)
+    finally:
+        _teardownHeaders()
+
+    assert [pkg.header['name'] for pkg in pkgs.packages] == ['a', 'b.rpm', 'c']
+    assert setupCalls == [(['http://some.server/VMware/RPMS/b.rpm'],
+                           mainThread)]
+    assert len(downloads) == 1
+    url, requestAmount, thread = downloads[0]
+    assert url == 'http://some.server/VMware/RPMS/b.rpm'
+    assert requestAmount == 500
+    assert thread.startswith('headers-')
+    # rpmlib is only used on the main thread
+    assert HeaderPackage.parsed == [('/tmp/b.rpm', mainThread)]
+
+def testLoadHeadersWithoutIndex():
+    mainThread = threading.currentThread().getName()
+    _setupHeaders()
+    try:
+        pkgs = _headerPackages(['a', 'b', 'c', 'd'])
+        pkgs.loadHeaders(numWorkers=2)
+    finally:
+        _teardownHeaders()
+
+    names = [pkg.header['name'] for pkg in pkgs.packages]
+    assert names == ['a.rpm', 'b.rpm', 'c.rpm', 'd.rpm']
+    assert len(setupCalls) == 1
+    assert len(downloads) == 4
+    for _url, _requestAmount, thread in downloads:
+        assert thread.startswith('headers-')
+    assert [path for path, _thread in HeaderPackage.parsed] == \
+           ['/tmp/a.rpm', '/tmp/b.rpm', '/tmp/c.rpm', '/tmp/d.rpm']
+    assert [thread for _path, thread in HeaderPackage.parsed] == \
+           [mainThread] * 4
+
+def testLoadHeadersFromMedia():
+    import media
+    import remote_files
+
+    mainThread = threading.currentThread().getName()
+    mounts = []
+    def recordMount(*args):
+        mounts.append(threading.currentThread().getName())
+
+    def mediaDownload(url, requestAmount=None, **kwargs):
+        # downloadLocally opens file:// URLs like this
+        try:
+            remote_files.openFileURL(url).close()
+        except IOError:
+            pass
+        return recordDownload(url, requestAmount, **kwargs)
+
+    _setupHeaders()
+    oldMount = media.runtimeActionMountMedia
+    media.runtimeActionMountMedia = recordMount
+    packages.prepareRemoteAccess = oldPrepare
+    packages.downloadLocally = mediaDownload
+    try:
+        pkgs = packages.Packages(initTS=False, weaselConfig=FakeWeaselConfig())
+        for name in 'abcd':
+            pkgs.packages.append(HeaderPackage(
+                'file:///mnt/source/VMware/RPMS/%s.rpm' % name, 'required',
+                100, 400, 1000, name))
+        pkgs.loadHeaders(numWorkers=2)
+    finally:
+        _teardownHeaders()
+        packages.prepareRemoteAccess = recordSetup
+        media.runtimeActionMountMedia = oldMount
+
+    # the media is mounted once, before the workers start, and never by them
+    assert mounts == [mainThread]
+    assert len(downloads) == 4
+    for _url, _requestAmount, thread in downloads:
+        assert thread.startswith('headers-')
+
+# -----------------------------------------------------------------------------
+# Reading packages in place
+# -----------------------------------------------------------------------------
+import shutil
+import tempfile
+import remote_files
+
+tmpDir = None
+
+class FakeNFSMounter:
+    '''Maps nfs://server/export/... onto tmpDir.'''
+    def getLocalLocation(self, url):
+        return os.path.join(tmpDir, os.path.basename(url))
+
+def _setupInPlace():
+    global tmpDir
+    tmpDir = tempfile.mkdtemp()
+    del downloads[:]
+    packages.downloadLocally = recordDownload
+
+def _teardownInPlace():
+    packages.downloadLocally = oldDownloadLocally
+    shutil.rmtree(tmpDir)
+
+def _writePackage(name, contents='rpm' * 100):
+    path = os.path.join(tmpDir, name)
+    out = open(path, 'wb')
+    out.write(contents)
+    out.close()
+    return path
+
+def _newPackage(url, pkgSize=300):
+    return packages.Package(url, 'required', 100, 400, pkgSize,
+                            os.path.basename(url))
+
+def _readFd(fd):
+    data = os.read(fd, 4096)
+    os.close(fd)
+    return data
+
+def testIsDirectReadable():
+    assert remote_files.isDirectReadable('file:///mnt/source/a.rpm')
+    assert remote_files.isDirectReadable('nfs://server/export/a.rpm')
+    assert not remote_files.isDirectReadable('http://server/a.rpm')
+    assert not remote_files.isDirectReadable('https://server/a.rpm')
+    assert not remote_files.isDirectReadable('ftp://server/a.rpm')
+
+def testGetDirectPath():
+    assert remote_files.getDirectPath('file:///tmp/a.rpm') == '/tmp/a.rpm'
+    try:
+        remote_files.getDirectPath('http://server/a.rpm')
+        assert False, "http can not be read in place"
+    except RemoteFileError:
+        pass
+
+def testOpenInPlace():
+    _setupInPlace()
+    try:
+        path = _writePackage('local.rpm')
+        fd = _newPackage('file://' + path).openInPlace()
+        assert fd is not None
+        assert _readFd(fd) == 'rpm' * 100
+
+        # A file that is not the size the depot says it is gets copied, so
+        # the usual integrity check happens.
+        assert _newPackage('file://' + path, 299).openInPlace() is None
+        assert _newPackage('file://' + path + '.missing').openInPlace() is None
+    finally:
+        _teardownInPlace()
+
+def testOpenInPlaceNFS():
+    _setupInPlace()
+    oldMounter = remote_files.getNFSMounter
+    oldNetwork = remote_files.checkNetworkUp
+    remote_files.getNFSMounter = FakeNFSMounter
+    remote_files.checkNetworkUp = lambda: True
+    try:
+        _writePackage('nfs.rpm')
+        fd = _newPackage('nfs://server/export/nfs.rpm').openInPlace()
+        assert fd is not None
+        assert _readFd(fd) == 'rpm' * 100
+    finally:
+        remote_files.getNFSMounter = oldMounter
+        remote_files.checkNetworkUp = oldNetwork
+        _teardownInPlace()
+
+def _installOne(package, directRead):
+    cb = packages.InstallCallback(1, 1, directRead=directRead)
+    fd = cb.cbInstallOpenFile((package,))
+    data = os.read(fd, 4096)
+    inPlace = cb.rpmFdInPlace
+    cb.cbInstallCloseFile((package,))
+    return data, inPlace
+
+def testInstallCallbackDirectRead():
+    _setupInPlace()
+    try:
+        path = _writePackage('direct.rpm')
+        data, inPlace = _installOne(_newPackage('file://' + path), True)
+        assert data == 'rpm' * 100
+        assert inPlace
+        assert downloads == []
+        # the package is not deleted after it has been installed
+        assert os.path.exists(path)
+    finally:
+        _teardownInPlace()
+
+def _downloadToTmpDir(url, requestAmount=None, **kwargs):
+    downloads.append((url, requestAmount, threading.currentThread().getName()))
+    return _writePackage('downloaded-' + os.path.basename(url))
+
+def testInstallCallbackDownloads():
+    _setupInPlace()
+    packages.downloadLocally = _downloadToTmpDir
+    try:
+        # Without directRead local files are still copied, and HTTP is always
+        # downloaded.
+        path = _writePackage('copied.rpm')
+        for url, directRead in [('file://' + path, False),
+                                ('http://some.server/remote.rpm', True)]:
+            del downloads[:]
+            data, inPlace = _installOne(_newPackage(url), directRead)
+            assert data == 'rpm' * 100
+            assert not inPlace
+            assert [download[0] for download in downloads] == [url]
+            # the downloaded copy is cleaned up
+            assert not os.path.exists(
+                os.path.join(tmpDir, 'downloaded-' + os.path.basename(url)))
+    finally:
+        _teardownInPlace()
+
+def testInstallCallbackFallsBack():
+    _setupInPlace()
+    packages.downloadLocally = _downloadToTmpDir
+    try:
+        # The file on the media is the wrong size, so it is downloaded.
+        path = _writePackage('short.rpm', 'rpm')
+        data, inPlace = _installOne(_newPackage('file://' + path), True)
+        assert data == 'rpm' * 100
+        assert not inPlace
+        assert [download[0] for download in downloads] == ['file://' + path]
+    finally:
+        _teardownInPlace()
@@ -21,6 +21,8 @@
 
 import os
 import sys
+import time
+import threading
 
 from nose.tools import raises, with_setup
 
@@ -145,6 +147,9 @@ def setupDoubleDiskPartitions():
 
     fauxroot.FAUXROOT = ["good-config.1"]
 
+# The alignment unit that is left free before each logical partition.
+EBR_SECTORS = partition.PARTITION_ALIGNMENT / 512
+
 def expectedParts(*args):
     '''Generate a list of expected partitions for the test_config function.
 
@@ -152,6 +157,9 @@ def expectedParts(*args):
     type, and size in MB.  The return value is a list of tuples containing:
     (partition number, partition type, fs type, start sector, end sector).
 
+    Each logical partition is preceded by the free MB that is left for its
+    extended boot record.
+
     >>> expectedParts((parted.PRIMARY, 'ext3', 250),
     ...               (parted.PRIMARY, 'ext3', 100))
     [(1, 0, 'ext3', 0, 511999), (2, 0, 'ext3', 512000, 716799)]
@@ -160,6 +168,14 @@ def expectedParts(*args):
     startSector = 0
     
     for ptype, fstype, size in args:
+        if ptype == parted.LOGICAL:
+            # The mock parted ends a gap on the next partition's first sector.
+            retval.append((-1,
+                           parted.LOGICAL | parted.FREESPACE,
+                           '',
+                           startSector,
+                           startSector + EBR_SECTORS))
+            startSector += EBR_SECTORS
         endSector = startSector + size * 1024 * 1024 / 512 - 1
         if ptype & parted.FREESPACE:
             partNumber = -1
@@ -286,7 +302,7 @@ def test_configs():
         (parted.PRIMARY, 'ext3', 250),
         (parted.PRIMARY, 'ext3', 254),
         (parted.EXTENDED, '', 20 * 1024 - 250 - 254),
-        (parted.LOGICAL, 'ext3', 20 * 1024 - 250 - 254)) },
+        (parted.LOGICAL, 'ext3', 20 * 1024 - 250 - 254 - 1)) },
 
         ##
         { 'desc' : 'Empty and should just fit.',
@@ -328,10 +344,12 @@ def test_configs():
                            'grow' : True } ],
 
           'expected' : expectedParts(
+        # The MB for the extended boot record comes out of the space that
+        # is split, the logical partition gets the odd MB that is left.
         (parted.PRIMARY, 'ext3', 250),
-        (parted.PRIMARY, 'ext3', (20 * 1024 - 250) / 2),
-        (parted.EXTENDED, '', (20 * 1024 - 250) / 2),
-        (parted.LOGICAL, 'ext3', (20 * 1024 - 250) / 2)) },
+        (parted.PRIMARY, 'ext3', (20 * 1024 - 250 - 1) / 2),
+        (parted.EXTENDED, '', (20 * 1024 - 250 - 1) / 2 + 2),
+        (parted.LOGICAL, 'ext3', (20 * 1024 - 250 - 1) / 2 + 1)) },
 
         ##
         { 'desc' : 'Two grow partitions with one max size.',
@@ -354,7 +372,7 @@ def test_configs():
         (parted.PRIMARY, 'ext3', 250),
         (parted.PRIMARY, 'ext3', 250),
         (parted.EXTENDED, '', 20 * 1024 - 250 - 250),
-        (parted.LOGICAL, 'ext3', 20 * 1024 - 250 - 250)) },
+        (parted.LOGICAL, 'ext3', 20 * 1024 - 250 - 250 - 1)) },
 
         ##
         { 'desc' : 'Two grow partitions with one max size.',
@@ -377,7 +395,7 @@ def test_configs():
         (parted.PRIMARY, 'ext3', 250),
         (parted.PRIMARY, 'ext3', 250),
         (parted.EXTENDED, '', 20 * 1024 - 250 - 250),
-        (parted.LOGICAL, 'ext3', 20 * 1024 - 250 - 250)) },
+        (parted.LOGICAL, 'ext3', 20 * 1024 - 250 - 250 - 1)) },
 
         ##
         { 'desc' : 'Two grow partitions, both with a max size.',
@@ -402,7 +420,7 @@ def test_configs():
         (parted.PRIMARY, 'ext3', 250),
         (parted.EXTENDED, '', 20 * 1024 - 250 - 250),
         (parted.LOGICAL, 'ext3', 250),
-        (parted.LOGICAL | parted.FREESPACE, '', 20 * 1024 - 250 * 3)) },
+        (parted.LOGICAL | parted.FREESPACE, '', 20 * 1024 - 250 * 3 - 1)) },
 
         ##
         { 'desc' : 'Partition with oversized max.',
@@ -430,7 +448,39 @@ def test_configs():
                            'minimumSize' : 250,
                            'grow' : True }, ],
 
-          'error' : "Couldn't find a spot for the requested partition." },
+          # The max sized partition grows, but leaves room for the minimum of
+          # the one after it.
+          'expected' : expectedParts(
+        (parted.PRIMARY, 'ext3', 20 * 1024 - 250),
+        (parted.PRIMARY, 'ext3', 250)) },
+
+        ##
+        { 'desc' : 'New partitions are aligned.',
+          'init' : [
+        { 'num' : 0, 'type' : parted.PRIMARY,
+          'fs_type' : 'ext3',
+          'native_type' : 0x83,
+          'geom' : { 'start' : 0, 'end' : 62 }}, ],
+
+          'requests' : [ { 'mountPoint' : '/boot',
+                           'fsType' : 'ext3',
+                           'minimumSize' : 250 },
+                         { 'mountPoint' : '/',
+                           'fsType' : 'ext3',
+                           'minimumSize' : 100,
+                           'grow' : True } ],
+
+          'expected' : [
+        (1, parted.PRIMARY, 'ext3', 0, 62),
+        # The mock parted ends a gap on the next partition's first sector.
+        (-1, parted.FREESPACE, '', 63, 2048),
+        (2, parted.PRIMARY, 'ext3', 2048, 2048 + 250 * 2048 - 1),
+        (3, parted.EXTENDED, '', 2048 + 250 * 2048, 40 * 1024 * 1024 - 1),
+        # One alignment unit is left for the extended boot record.
+        (-1, parted.LOGICAL | parted.FREESPACE, '', 2048 + 250 * 2048,
+         2048 + 251 * 2048),
+        (4, parted.LOGICAL, 'ext3', 2048 + 251 * 2048,
+         40 * 1024 * 1024 - 1)] },
 
         ##
         { 'desc' : 'Excess primaries.',
@@ -619,6 +669,96 @@ def test_configs():
         
         yield check_one_config, conf
 
+@with_setup(None, teardown_root)
+def testAlignmentFromIOLimits():
+    setupSingleDiskPartitions([])
+
+    fsTypes = fsset.getSupportedFileSystems()
+    device = devices.DiskSet(forceReprobe=True)['vml.1111']
+    # A 768KB stripe that starts 7 sectors into the disk.
+    device._ioLimits = { 'physicalBlockSize' : 4096,
+                         'minimumIOSize' : 4096,
+                         'optimalIOSize' : 768 * 1024,
+                         'alignmentOffset' : 7 * 512 }
+
+    prs = partition.PartitionRequestSet(device.name)
+    prs.append(partition.PartitionRequest(mountPoint='/boot',
+                                          fsType=fsTypes['ext3'](),
+                                          minimumSize=250))
+    prs.append(partition.PartitionRequest(mountPoint='/',
+                                          fsType=fsTypes['ext3'](),
+                                          minimumSize=100,
+                                          grow=True))
+
+    assert prs._getAlignment() == (6144, 7)
+
+    plan = prs._planPartitions(0, 0)
+    assert [(start, end) for _type, start, end, _req in plan] == [
+        (7, 7 + 84 * 6144 - 1),
+        (7 + 84 * 6144, 40 * 1024 * 1024 - 1)]
+
+def _alignmentFor(ioLimits):
+    setupSingleDiskPartitions([])
+
+    device = devices.DiskSet(forceReprobe=True)['vml.1111']
+    device._ioLimits = ioLimits
+    return partition.PartitionRequestSet(device.name)._getAlignment()
+
+@with_setup(None, teardown_root)
+def testAlignmentIgnoresBogusIOSizes():
+    # 33553920 is not made of whole 4KB blocks.
+    assert _alignmentFor({ 'physicalBlockSize' : 4096,
+                           'minimumIOSize' : 4096,
+                           'optimalIOSize' : 33553920,
+                           'alignmentOffset' : 0 }) == (2048, 0)
+    assert _alignmentFor({ 'physicalBlockSize' : 4096,
+                           'minimumIOSize' : 3000,
+                           'optimalIOSize' : 0,
+                           'alignmentOffset' : 0 }) == (2048, 0)
+
+@with_setup(None, teardown_root)
+def testAlignmentIsCapped():
+    # With 512 byte blocks the same size is a multiple of the block size,
+    # but the lcm with 1MB would be tens of GB.
+    assert _alignmentFor({ 'physicalBlockSize' : 512,
+                           'minimumIOSize' : 512,
+                           'optimalIOSize' : 33553920,
+                           'alignmentOffset' : 7 * 512 }) == (2048, 0)
+
+    # A large, but believable, stripe is still used.
+    assert _alignmentFor({ 'physicalBlockSize' : 4096,
+                           'minimumIOSize' : 4096,
+                           'optimalIOSize' : 8 * 1024 * 1024,
+                           'alignmentOffset' : 0 }) == (16384, 0)
+
+@with_setup(None, teardown_root)
+def testMovedPartitionFails():
+    setupSingleDiskPartitions([])
+
+    fsTypes = fsset.getSupportedFileSystems()
+    device = devices.DiskSet(forceReprobe=True)['vml.1111']
+    prs = partition.PartitionRequestSet(device.name)
+    prs.append(partition.PartitionRequest(mountPoint='/boot',
+                                          fsType=fsTypes['ext3'](),
+                                          minimumSize=250))
+
+    # Act like a real libparted that had to make room in front of the
+    # partition.
+    pd = device.partitions.partedDisk
+    oldAdd = pd.add_partition
+    def movingAdd(newpart, constraint):
+        newpart.geom.start += 63
+        oldAdd(newpart, constraint)
+    pd.add_partition = movingAdd
+
+    try:
+        prs.fitPartitionsOnDevice()
+    except ValueError, e:
+        assert str(e) == \
+               "Partition 1 on vml.1111 was moved from sector 0 to 63"
+    else:
+        assert False, "a moved partition was accepted"
+
 @with_setup(None, teardown_root)
 def testAddDefaultPartitionRequests():
     setupDoubleDiskPartitions()
@@ -694,3 +834,81 @@ def testVmfsVolumeLabel():
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
+
+class StatusRecorder:
+    '''Stands in for the context.cb that the host actions report to.'''
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        def record(*args):
+            self.calls.append((name, threading.currentThread().getName()))
+        return record
+
+class FakeContext:
+    def __init__(self):
+        self.cb = StatusRecorder()
+
+def testFormatSchedulerOrdersJobsOnADisk():
+    ran = []
+    def fakeFormat(path):
+        # The first job is the slowest, it still finishes first.
+        time.sleep(0.01 * (3 - len(ran)))
+        ran.append(path)
+
+    scheduler = partition.FormatScheduler()
+    try:
+        jobs = [scheduler.submit('vml.0000', fakeFormat, path)
+                for path in ['/dev/sda1', '/dev/sda2', '/dev/sda3']]
+        for job in jobs:
+            job.result(5)
+    finally:
+        scheduler.shutdown()
+
+    assert ran == ['/dev/sda1', '/dev/sda2', '/dev/sda3']
+
+def testFormatSchedulerOverlapsDisks():
+    started = threading.Event()
+    overlapped = []
+    def firstFormat(path):
+        # Only finishes early if the other disk is formatted at the same
+        # time.
+        started.wait(5)
+        overlapped.append(started.isSet())
+    def secondFormat(path):
+        started.set()
+
+    scheduler = partition.FormatScheduler()
+    try:
+        firstJob = scheduler.submit('vml.0000', firstFormat, '/dev/sda1')
+        secondJob = scheduler.submit('vml.0001', secondFormat, '/dev/sdb1')
+        firstJob.result(10)
+        secondJob.result(10)
+    finally:
+        scheduler.shutdown()
+
+    assert overlapped == [True]
+
+def testFormatFailureReportedOnMainThread():
+    def badFormat(path):
+        raise RuntimeError("mkfs failed on %s" % path)
+
+    context = FakeContext()
+    scheduler = partition.FormatScheduler()
+    try:
+        jobs = [('/dev/sda1', scheduler.submit('vml.0000', badFormat,
+                                               '/dev/sda1'))]
+        try:
+            partition._waitForFormats(context, 'vml.0000', jobs)
+        except RuntimeError, e:
+            assert str(e) == "mkfs failed on /dev/sda1"
+        else:
+            assert False, "the format failure was lost"
+    finally:
+        scheduler.shutdown()
+
+    mainThread = threading.currentThread().getName()
+    assert context.cb.calls
+    assert [thread for _name, thread in context.cb.calls] == \
+           [mainThread] * len(context.cb.calls)
@@ -132,3 +132,615 @@ def test_remoteOpen_proxy():
 
     raises(URLError)(remoteOpen)('http://requires.a.proxy/packages.xml')
     raises(IOError)(remoteOpen)('ftp://requires.a.proxy/packages.xml')
+
+@with_setup(setup_root, teardown_root)
+def test_prepareRemoteAccess():
+    import threading
+    import workerpool
+
+    calls = []
+    def recorder(name):
+        def record():
+            calls.append((name, threading.currentThread().getName()))
+        return record
+
+    import media
+
+    oldNetwork = remote_files.checkNetworkUp
+    oldProxy = remote_files.checkProxySetUp
+    oldMount = media.runtimeActionMountMedia
+    remote_files.checkNetworkUp = recorder('network')
+    remote_files.checkProxySetUp = recorder('proxy')
+    media.runtimeActionMountMedia = recorder('mount')
+    try:
+        mainThread = threading.currentThread().getName()
+
+        remote_files.prepareRemoteAccess(['file:///mnt/source/packages.xml',
+                                          'file:///mnt/source/a.rpm'])
+        assert calls == [('mount', mainThread)]
+
+        del calls[:]
+        urls = ['http://some.server/packages.xml',
+                'http://bad.mediaroot.returns.junk/packages.xml']
+        remote_files.prepareRemoteAccess(urls + ['file:///a.rpm'])
+        assert calls == [('network', mainThread), ('proxy', mainThread)]
+
+        # The workers only read.
+        del calls[:]
+        pool = workerpool.WorkerPool(2)
+        try:
+            jobs = [pool.submit(remote_files.remoteOpen, url) for url in urls]
+            for job in jobs:
+                assert job.result()
+        finally:
+            pool.shutdown()
+        assert calls == []
+
+        # Outside of a worker the setup is still done on every open.
+        remote_files.remoteOpen(urls[0])
+        assert calls == [('network', mainThread), ('proxy', mainThread)]
+    finally:
+        remote_files.checkNetworkUp = oldNetwork
+        remote_files.checkProxySetUp = oldProxy
+        media.runtimeActionMountMedia = oldMount
+
+@with_setup(setup_root, teardown_root)
+def test_mediaMountedOnMainThread():
+    import threading
+    import workerpool
+    import media
+
+    calls = []
+    def recordMount(*args):
+        calls.append(threading.currentThread().getName())
+
+    oldMount = media.runtimeActionMountMedia
+    media.runtimeActionMountMedia = recordMount
+    try:
+        url = 'file:///mnt/source/VMware/RPMS/a.rpm'
+        results = workerpool.parallelMap(remote_files.getDirectPath,
+                                         [url] * 4, 2)
+        assert results == ['/mnt/source/VMware/RPMS/a.rpm'] * 4
+        assert calls == []
+
+        # Outside of a worker the media is still mounted on demand.
+        assert remote_files.getDirectPath(url) == results[0]
+        assert calls == [threading.currentThread().getName()]
+    finally:
+        media.runtimeActionMountMedia = oldMount
+
+# -----------------------------------------------------------------------------
+# Connection reuse and resuming downloads with Range requests
+# -----------------------------------------------------------------------------
+import threading
+import httplib
+import mimetools
+import BaseHTTPServer
+import SocketServer
+from StringIO import StringIO
+
+from networking import keepalive
+
+class KeepAliveRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.clients.append(self.client_address)
+        body = 'x' * 1000
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class KeepAliveServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           KeepAliveRequestHandler)
+        self.clients = []
+        self.stopped = False
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _serve(self):
+        while not self.stopped:
+            self.handle_request()
+
+    def handle_error(self, request, client_address):
+        # the tests drop connections on purpose
+        pass
+
+    def url(self, path='/file'):
+        return 'http://127.0.0.1:%d%s' % (self.server_address[1], path)
+
+    def stop(self):
+        self.stopped = True
+        # wake up handle_request()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(self.server_address)
+        sock.close()
+        self.thread.join(5)
+        self.server_close()
+
+def _newOpener():
+    pool = keepalive.ConnectionPool()
+    handler = keepalive.KeepAliveHandler(pool)
+    return urllib2.build_opener(handler), pool
+
+def test_keepalive_reuse():
+    server = KeepAliveServer()
+    try:
+        opener, pool = _newOpener()
+        for _attempt in range(3):
+            fp = opener.open(server.url())
+            assert len(fp.read()) == 1000
+            fp.close()
+
+        # All three requests went over the same connection.
+        assert len(server.clients) == 3
+        assert len(dict.fromkeys(server.clients)) == 1
+        pool.closeAll()
+    finally:
+        server.stop()
+
+def test_keepalive_unread_response():
+    server = KeepAliveServer()
+    try:
+        opener, pool = _newOpener()
+        fp = opener.open(server.url())
+        fp.read(10)
+        fp.close()
+        # The rest of the response is still in the connection, so it can't be
+        # used for another request.
+        host = '127.0.0.1:%d' % server.server_address[1]
+        assert pool.get(host) is None
+
+        fp = opener.open(server.url())
+        fp.read()
+        fp.close()
+        assert len(dict.fromkeys(server.clients)) == 2
+        pool.closeAll()
+    finally:
+        server.stop()
+
+class StaleConnection:
+    '''An idle connection that the server has already closed.'''
+    def __init__(self):
+        self.closed = False
+
+    def request(self, *args):
+        raise httplib.BadStatusLine('')
+
+    def close(self):
+        self.closed = True
+
+def test_keepalive_stale_connection():
+    server = KeepAliveServer()
+    try:
+        opener, pool = _newOpener()
+        host = '127.0.0.1:%d' % server.server_address[1]
+        stale = StaleConnection()
+        pool.put(host, stale)
+
+        # The request is retried on a new connection.
+        fp = opener.open(server.url())
+        assert len(fp.read()) == 1000
+        fp.close()
+        assert stale.closed
+        assert len(server.clients) == 1
+        assert pool.get(host) is not stale
+        pool.closeAll()
+    finally:
+        server.stop()
+
+def test_keepalive_new_connection_fails():
+    server = KeepAliveServer()
+    url = server.url()
+    server.stop()
+
+    # A connection that was not kept alive is not retried.
+    opener, _pool = _newOpener()
+    raises(URLError)(opener.open)(url)
+
+def test_connectionPool_maxIdle():
+    pool = keepalive.ConnectionPool(maxIdlePerHost=2)
+    conns = [StaleConnection() for _index in range(3)]
+    for conn in conns:
+        pool.put('example.com:80', conn)
+    assert [conn.closed for conn in conns] == [False, False, True]
+    assert pool.get('other.com:80') is None
+
+    pool.closeAll()
+    assert [conn.closed for conn in conns] == [True, True, True]
+    assert pool.get('example.com:80') is None
+
+class RangeServer:
+    '''Stands in for urlopen() in remote_files and answers the way a web
+    server with or without support for ranges would.'''
+
+    def __init__(self, data, supportsRanges=True, etag='"v1"',
+                 sendLength=True, dropAfter=None):
+        self.data = data
+        self.supportsRanges = supportsRanges
+        self.etag = etag
+        self.sendLength = sendLength
+        # the first response is cut off after this many bytes
+        self.dropAfter = dropAfter
+        self.requests = []
+
+    def __call__(self, req):
+        headers = {}
+        for name, value in req.header_items():
+            headers[name.lower()] = value
+        self.requests.append(headers)
+
+        url = req.get_full_url()
+        body = self.data
+        code = 200
+        rangeHeader = headers.get('range')
+        ifRange = headers.get('if-range')
+        if (rangeHeader and self.supportsRanges and
+            (ifRange is None or ifRange == self.etag)):
+            start, end = rangeHeader[len('bytes='):].split('-')
+            start = int(start)
+            if start >= len(self.data):
+                raise HTTPError(url, 416, 'Requested Range Not Satisfiable',
+                                None, StringIO(''))
+            if end:
+                body = self.data[start:int(end) + 1]
+            else:
+                body = self.data[start:]
+            code = 206
+
+        headers = 'ETag: %s\r\n' % self.etag
+        if self.sendLength:
+            headers += 'Content-Length: %d\r\n' % len(body)
+        info = mimetools.Message(StringIO(headers + '\r\n'))
+        if self.dropAfter is not None:
+            body = body[:self.dropAfter]
+            self.dropAfter = None
+        resp = urllib2.addinfourl(StringIO(body), info, url)
+        resp.code = code
+        return resp
+
+RANGE_DATA = ''.join([chr(index % 251) for index in range(5000)])
+
+def _rangeDownload(server, url):
+    oldUrlopen = remote_files.urlopen
+    remote_files.urlopen = server
+    try:
+        path = remote_files.downloadLocally(url, requestAmount=1000)
+        assert open(path).read() == RANGE_DATA[:1000]
+        path = remote_files.downloadLocally(url)
+        contents = open(path).read()
+    finally:
+        remote_files.urlopen = oldUrlopen
+        remote_files.getCacher().clobber(url)
+    return contents
+
+@with_setup(setup_root, teardown_root)
+def test_remoteOpen_range():
+    server = RangeServer(RANGE_DATA)
+    oldUrlopen = remote_files.urlopen
+    remote_files.urlopen = server
+    try:
+        url = 'http://some.server/range.rpm'
+        assert remote_files.remoteOpen(url, 100, 50).read() == \
+               RANGE_DATA[100:150]
+        assert remote_files.remoteOpen(url, 4990).read() == RANGE_DATA[4990:]
+        assert remote_files.remoteOpen(url, ifRange=('"v1"', None)).read() \
+               == RANGE_DATA
+    finally:
+        remote_files.urlopen = oldUrlopen
+
+    assert server.requests[0]['range'] == 'bytes=100-149'
+    assert server.requests[1]['range'] == 'bytes=4990-'
+    # If-Range only makes sense with a Range
+    assert 'range' not in server.requests[2]
+    assert 'if-range' not in server.requests[2]
+
+@with_setup(setup_root, teardown_root)
+def test_downloadLocally_resume():
+    server = RangeServer(RANGE_DATA)
+    assert _rangeDownload(server, 'http://some.server/resume.rpm') == \
+           RANGE_DATA
+
+    assert server.requests[0]['range'] == 'bytes=0-999'
+    # The second download picked up where the first one left off, as long as
+    # the file has not changed.
+    assert server.requests[1]['range'] == 'bytes=1000-'
+    assert server.requests[1]['if-range'] == '"v1"'
+    assert len(server.requests) == 2
+
+@with_setup(setup_root, teardown_root)
+def test_downloadLocally_resume_not_supported():
+    # The server sends the whole file back, which replaces the partial copy.
+    server = RangeServer(RANGE_DATA, supportsRanges=False)
+    assert _rangeDownload(server, 'http://some.server/noranges.rpm') == \
+           RANGE_DATA
+    assert server.requests[1]['range'] == 'bytes=1000-'
+    assert len(server.requests) == 2
+
+@with_setup(setup_root, teardown_root)
+def test_downloadLocally_resume_at_end():
+    server = RangeServer(RANGE_DATA)
+    url = 'http://some.server/complete.rpm'
+    oldUrlopen = remote_files.urlopen
+    remote_files.urlopen = server
+    try:
+        remote_files.downloadLocally(url, requestAmount=len(RANGE_DATA))
+        # Everything was already downloaded, the server says the range is
+        # past the end and the partial copy is just marked complete.
+        path = remote_files.downloadLocally(url)
+        assert open(path).read() == RANGE_DATA
+        assert remote_files.getCacher().isComplete(url)
+    finally:
+        remote_files.urlopen = oldUrlopen
+        remote_files.getCacher().clobber(url)
+
+    assert server.requests[1]['range'] == 'bytes=%d-' % len(RANGE_DATA)
+    assert len(server.requests) == 2
+
+# -----------------------------------------------------------------------------
+# The content-addressed package cache
+# -----------------------------------------------------------------------------
+import shutil
+import tempfile
+import depotindex
+
+def _writeFile(path, contents):
+    out = open(path, 'wb')
+    out.write(contents)
+    out.close()
+
+def _sha1(contents):
+    hasher = depotindex.newHasher('sha1')
+    hasher.update(contents)
+    return 'sha1:%s' % hasher.hexdigest()
+
+def _readManifest(root):
+    return open(os.path.join(root, ContentStore.MANIFEST_NAME)).read()
+
+ContentStore = remote_files.ContentStore
+storeDir = None
+srcDir = None
+
+def setup_store():
+    global storeDir, srcDir
+    storeDir = tempfile.mkdtemp()
+    srcDir = tempfile.mkdtemp()
+
+def teardown_store():
+    remote_files.getCacher().setContentStore(None)
+    shutil.rmtree(storeDir)
+    shutil.rmtree(srcDir)
+
+@with_setup(setup_store, teardown_store)
+def test_contentStore_add():
+    srcPath = os.path.join(srcDir, 'foo.rpm')
+    _writeFile(srcPath, 'foo' * 100)
+    digest = _sha1('foo' * 100)
+    hexdigest = digest.split(':')[1]
+
+    store = ContentStore(storeDir)
+    assert store.lookup(digest) is None
+
+    path = store.add(digest, srcPath)
+    assert path == os.path.join(storeDir, 'sha1', hexdigest[:2], hexdigest)
+    assert open(path).read() == 'foo' * 100
+    assert store.lookup(digest) == path
+    assert store.contains(path)
+    assert not store.contains(srcPath)
+    assert _readManifest(storeDir) == '%s 300\n' % digest
+
+    # Adding it again does not add another manifest entry.
+    assert store.add(digest, srcPath) == path
+    assert _readManifest(storeDir) == '%s 300\n' % digest
+
+    # A file that disappears is forgotten.
+    os.remove(path)
+    assert store.lookup(digest) is None
+
+@with_setup(setup_store, teardown_store)
+def test_contentStore_manifest():
+    store = ContentStore(storeDir)
+    digests = []
+    for name in ['a', 'b', 'c']:
+        srcPath = os.path.join(srcDir, name)
+        _writeFile(srcPath, name * 10)
+        digests.append(_sha1(name * 10))
+        store.add(digests[-1], srcPath)
+
+    # 'b' was truncated and 'c' was deleted behind the store's back.
+    _writeFile(store.lookup(digests[1]), 'b')
+    os.remove(store.lookup(digests[2]))
+    manifest = open(os.path.join(storeDir, ContentStore.MANIFEST_NAME), 'a')
+    manifest.write('this line is junk\n')
+    manifest.close()
+
+    reopened = ContentStore(storeDir)
+    assert reopened.lookup(digests[0]) == store.lookup(digests[0])
+    assert reopened.lookup(digests[1]) is None
+    assert reopened.lookup(digests[2]) is None
+
+def test_contentStore_not_a_directory():
+    try:
+        ContentStore('/does/not/exist')
+        assert False, "a missing directory should be rejected"
+    except RemoteFileError:
+        pass
+
+@with_setup(setup_store, teardown_store)
+def test_contentStore_importDirectory():
+    digests = {}
+    for name in ['good.rpm', 'changed.rpm', 'unknown.rpm']:
+        _writeFile(os.path.join(srcDir, name), name)
+        digests[name] = _sha1(name)
+    digests['changed.rpm'] = _sha1('something else')
+    digests['missing.rpm'] = _sha1('missing.rpm')
+    del digests['unknown.rpm']
+
+    store = ContentStore(storeDir)
+    assert store.importDirectory(srcDir, digests) == 1
+    assert open(store.lookup(digests['good.rpm'])).read() == 'good.rpm'
+    assert store.lookup(digests['changed.rpm']) is None
+
+    # Files that are already in the store are skipped.
+    assert store.importDirectory(srcDir, digests) == 0
+
+@with_setup(setup_store, teardown_store)
+def test_downloadLocally_digest():
+    srcPath = os.path.join(srcDir, 'digest.rpm')
+    _writeFile(srcPath, 'rpm contents' * 1000)
+    digest = _sha1('rpm contents' * 1000)
+    url = 'file://' + srcPath
+
+    store = ContentStore(storeDir)
+    remote_files.getCacher().setContentStore(store)
+    try:
+        path = remote_files.downloadLocally(url, digest=digest)
+        assert open(path).read() == 'rpm contents' * 1000
+        assert store.lookup(digest)
+    finally:
+        remote_files.getCacher().clobber(url)
+
+    # The next time it comes from the store, even without the source.
+    os.remove(srcPath)
+    assert remote_files.downloadLocally(url, digest=digest) == \
+           store.lookup(digest)
+
+@with_setup(setup_store, teardown_store)
+def test_downloadLocally_digest_mismatch():
+    srcPath = os.path.join(srcDir, 'corrupt.rpm')
+    _writeFile(srcPath, 'corrupted contents')
+    digest = _sha1('expected contents')
+    url = 'file://' + srcPath
+
+    store = ContentStore(storeDir)
+    remote_files.getCacher().setContentStore(store)
+    try:
+        raises(RemoteFileError)(remote_files.downloadLocally)(
+            url, digest=digest, maxAttempts=1)
+        # Nothing bad is kept around, in the store or the cache.
+        assert store.lookup(digest) is None
+        assert not remote_files.getCacher().cachedCopy(url)
+    finally:
+        remote_files.getCacher().clobber(url)
+
+# -----------------------------------------------------------------------------
+# The downloadLocally read loop
+# -----------------------------------------------------------------------------
+import types
+
+BIG_DATA = ''.join([chr(index % 253) for index in range(
+    remote_files.MAX_CHUNK_SIZE * 2 + 12345)])
+
+def test_adjustChunkSize():
+    adjust = remote_files._adjustChunkSize
+    minSize = remote_files.MIN_CHUNK_SIZE
+    maxSize = remote_files.MAX_CHUNK_SIZE
+
+    assert adjust(minSize, 0.01) == minSize * 2
+    assert adjust(maxSize, 0.01) == maxSize
+    assert adjust(maxSize, 5.0) == maxSize / 2
+    assert adjust(minSize, 5.0) == minSize
+    assert adjust(minSize * 4, 1.0) == minSize * 4
+
+def _download(server, url, **kwargs):
+    oldUrlopen = remote_files.urlopen
+    oldSleep = remote_files.sleep
+    remote_files.urlopen = server
+    remote_files.sleep = lambda seconds: None
+    try:
+        path = remote_files.downloadLocally(url, **kwargs)
+        contents = open(path).read()
+    finally:
+        remote_files.urlopen = oldUrlopen
+        remote_files.sleep = oldSleep
+        remote_files.getCacher().clobber(url)
+    return contents
+
+@with_setup(setup_root, teardown_root)
+def test_downloadLocally_dropped_connection():
+    # The connection goes away partway through the first attempt, the second
+    # attempt asks for the rest.
+    server = RangeServer(BIG_DATA, dropAfter=300000)
+    assert _download(server, 'http://some.server/dropped.rpm') == BIG_DATA
+
+    assert len(server.requests) == 2
+    assert 'range' not in server.requests[0]
+    assert server.requests[1]['range'] == 'bytes=300000-'
+
+@with_setup(setup_root, teardown_root)
+def test_downloadLocally_dropped_connection_no_resume():
+    # Without ranges the second attempt starts over.
+    server = RangeServer(BIG_DATA, supportsRanges=False, dropAfter=300000)
+    assert _download(server, 'http://some.server/restart.rpm') == BIG_DATA
+    assert len(server.requests) == 2
+
+@with_setup(setup_root, teardown_root)
+def test_downloadLocally_no_content_length():
+    # Without a Content-Length the file ends when the server stops sending.
+    server = RangeServer(BIG_DATA, sendLength=False)
+    assert _download(server, 'http://some.server/nolength.rpm') == BIG_DATA
+    assert len(server.requests) == 1
+
+@with_setup(setup_root, teardown_root)
+def test_downloadLocally_no_content_length_dropped():
+    # A connection that is dropped looks like the end of the file, so it is
+    # up to the integrity checker to notice.
+    server = RangeServer(BIG_DATA, sendLength=False, dropAfter=300000)
+    sizes = []
+    def checkSize(path):
+        sizes.append(os.path.getsize(path))
+        return sizes[-1] == len(BIG_DATA)
+
+    assert _download(server, 'http://some.server/nolength2.rpm',
+                     integrityChecker=checkSize) == BIG_DATA
+    assert sizes == [300000, len(BIG_DATA)]
+
+@with_setup(setup_store, teardown_store)
+def test_downloadLocally_local_file():
+    srcPath = os.path.join(srcDir, 'local.rpm')
+    _writeFile(srcPath, BIG_DATA)
+    url = 'file://' + srcPath
+
+    reads = []
+    oldRemoteOpen = remote_files.remoteOpen
+    def recordingRemoteOpen(*args, **kwargs):
+        fp = oldRemoteOpen(*args, **kwargs)
+        reads.append(type(fp))
+        return fp
+
+    remote_files.remoteOpen = recordingRemoteOpen
+    try:
+        path = remote_files.downloadLocally(url)
+        assert open(path).read() == BIG_DATA
+        assert remote_files.getCacher().isComplete(url)
+    finally:
+        remote_files.remoteOpen = oldRemoteOpen
+        remote_files.getCacher().clobber(url)
+
+    # Local files are real files, so they are read with readinto().
+    assert reads == [types.FileType]
+
+@with_setup(setup_store, teardown_store)
+def test_downloadLocally_local_file_partial():
+    srcPath = os.path.join(srcDir, 'partial.rpm')
+    _writeFile(srcPath, BIG_DATA)
+    url = 'file://' + srcPath
+
+    try:
+        path = remote_files.downloadLocally(url, requestAmount=1000)
+        assert open(path).read() == BIG_DATA[:1000]
+        path = remote_files.downloadLocally(url, requestAmount=1000)
+        assert open(path).read() == BIG_DATA[:2000]
+        path = remote_files.downloadLocally(url)
+        assert open(path).read() == BIG_DATA
+    finally:
+        remote_files.getCacher().clobber(url)
@@ -0,0 +1,121 @@
+
+###############################################################################
+# Copyright (c) 2008-2009 VMware, Inc.
+#
+# This file is part of Weasel.
+#
+# Weasel is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation version 2 and no later version.
+#
+# Weasel is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# version 2 for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin St, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os
+import sys
+import threading
+
+TEST_DIR = os.path.dirname(__file__)
+
+sys.path.append(os.path.join(TEST_DIR, os.path.pardir))
+
+import workerpool
+
+def testSubmit():
+    pool = workerpool.WorkerPool(2)
+    try:
+        jobs = [pool.submit(lambda x, y: x * y, i, 2) for i in range(10)]
+        assert [job.result() for job in jobs] == range(0, 20, 2)
+    finally:
+        pool.shutdown()
+
+def testJobException():
+    def fail():
+        raise ValueError("expected")
+
+    pool = workerpool.WorkerPool(1)
+    try:
+        job = pool.submit(fail)
+        try:
+            job.result()
+            assert False, "exception was not re-raised"
+        except ValueError:
+            pass
+        assert job.done
+    finally:
+        pool.shutdown()
+
+def testSubmitAfterShutdown():
+    pool = workerpool.WorkerPool(1)
+    pool.shutdown()
+    try:
+        pool.submit(lambda: None)
+        assert False, "submit should fail after shutdown"
+    except RuntimeError:
+        pass
+
+def testParallelMapOrder():
+    assert workerpool.parallelMap(lambda x: x + 1, range(20), 4) == \
+           range(1, 21)
+    assert workerpool.parallelMap(lambda x: x, []) == []
+
+def testParallelMapConcurrent():
+    # all of the workers have to be running at the same time for the barrier
+    # to be released.
+    lock = threading.Lock()
+    released = threading.Event()
+    arrived = []
+
+    def barrier(item):
+        lock.acquire()
+        arrived.append(item)
+        if len(arrived) == 3:
+            released.set()
+        lock.release()
+        released.wait(5)
+        return released.isSet()
+
+    assert workerpool.parallelMap(barrier, range(3), 3) == [True] * 3
+
+def testIsWorkerThread():
+    assert not workerpool.isWorkerThread()
+    assert workerpool.parallelMap(lambda x: workerpool.isWorkerThread(),
+                                  range(3)) == [True] * 3
+    assert not workerpool.isWorkerThread()
+
+def testCancel():
+    started = threading.Event()
+    finish = threading.Event()
+    def block():
+        started.set()
+        finish.wait(5)
+        return 'done'
+
+    pool = workerpool.WorkerPool(1)
+    try:
+        running = pool.submit(block)
+        queued = pool.submit(lambda: 'ran')
+        started.wait(5)
+
+        # only the job that hasn't started can be cancelled
+        assert not running.cancel()
+        assert queued.cancel()
+        assert queued.done
+        try:
+            queued.result()
+            assert False, "a cancelled job has no result"
+        except workerpool.JobCancelled:
+            pass
+
+        finish.set()
+        assert running.result() == 'done'
+    finally:
+        pool.shutdown()
+    assert queued.cancelled
@@ -33,6 +33,7 @@ import partition
 import storage_utils
 import userchoices
 import datastore
+import discovery
 from log import log
 
 from textrunner import TextRunner, SubstepTransitionMenu as TransMenu
@@ -73,6 +74,11 @@ class EsxLocationWindow(TextRunner):
 
     def __init__(self, partMode="basic"):
         super(EsxLocationWindow, self).__init__()
+
+        # Look at all of the disks at once, instead of one by one as they
+        # are picked.
+        discovery.prefetchReports()
+
         self.storList = \
             storage_utils.getStorageList(devices.DiskSet(),
                                          vmfsSupport=(partMode=="basic"),
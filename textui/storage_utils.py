@@ -28,6 +28,7 @@ Advanced setup to follow... someday.
 
 # import os
 import devices
+import discovery
 import util
 import partition
 from log import log
@@ -109,7 +110,7 @@ def getPartitionsList(requests):
     return partList
 
 def getDeviceHasExistingDataText(deviceName):
-    foundEsx = devices.runtimeActionFindExistingEsx(deviceName)
+    foundEsx = discovery.getReport(deviceName).foundEsx
 
     foundVmfs = False
 
@@ -24,6 +24,7 @@ from textrunner import TextRunner, SubstepTransitionMenu as TransMenu
 import media
 import task_progress
 import vmkctl
+import signal
 import sys
 
 from consts import HV_DISABLED_TEXT
@@ -51,7 +52,17 @@ The ESX Text Installer uses these input conventions in many places:
 """
 
 mediaCheckText = """\n
-Please wait... Checking the installation media.\n
+Please wait... Checking the installation media.
+Press Ctrl-C to stop the check.\n
+"""
+
+mediaCheckCancelledHead = "Media Check Stopped"
+
+mediaCheckCancelledText = """\
+The media check was stopped before it finished.
+
+Do you want to continue checking the media?  The check picks up where it
+stopped.
 """
 
 class ProgressDotPrinter(object):
@@ -110,10 +121,33 @@ class WelcomeWindow(TextRunner):
     def actionMediaCheck(self):
         textengine.render_status(mediaCheckText)
         progressPrinter = ProgressDotPrinter('brandiso.calc_md5')
-        media.runtimeActionMediaCheck()
-        # just in case - don't wait for it to be garbage collected...
-        task_progress.removeNotificationListener(progressPrinter)
-        self.setSubstepEnv({ 'next': self.stepForward })
+        # Ctrl-C only asks the check to stop, it stops cleanly between two
+        # reads so it can be resumed later.
+        oldHandler = signal.signal(signal.SIGINT,
+                                   lambda signum, frame:
+                                   media.cancelMediaCheck())
+        try:
+            result = media.runtimeActionMediaCheck()
+        finally:
+            signal.signal(signal.SIGINT, oldHandler)
+            # just in case - don't wait for it to be garbage collected...
+            task_progress.removeNotificationListener(progressPrinter)
+
+        if result is None:
+            self.mediaCheckCancelled()
+        else:
+            self.setSubstepEnv({ 'next': self.stepForward })
+
+    def mediaCheckCancelled(self):
+        ui = {
+            'title': mediaCheckCancelledHead,
+            'body': mediaCheckCancelledText + TransMenu.YesNo,
+            'menu': {
+                '1': self.actionMediaCheck,
+                '2': self.stepForward,
+            }
+        }
+        self.setSubstepEnv(ui)
 
     def help(self):
         self.helpPushPop(welcomeHelpHead, welcomeHelpText + TransMenu.Back)
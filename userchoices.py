@@ -56,6 +56,8 @@ __toggles = { 'paranoid':   False,
               'zeroMBR':    False,
               'dryrun':     False,
               'mediacheck': False,
+              'mediacheckFiles': False,
+              'directRead': False,
               'activateNetwork':        False,
               'showInstallMethod':      False,
               'resetEsxLocation':       True,
@@ -142,6 +144,20 @@ def setMediaCheck(mediacheck):
 def getMediaCheck():
     return __toggles['mediacheck']
 
+def setMediaCheckFiles(mediacheckFiles):
+    global __toggles
+    __toggles['mediacheckFiles'] = mediacheckFiles
+
+def getMediaCheckFiles():
+    return __toggles['mediacheckFiles']
+
+def setDirectRead(directRead):
+    global __toggles
+    __toggles['directRead'] = directRead
+
+def getDirectRead():
+    return __toggles['directRead']
+
 def setActivateNetwork(activateNetwork):
     global __toggles
     __toggles['activateNetwork'] = activateNetwork
@@ -399,6 +415,37 @@ def getDebugPatchLocation():
     return __debugPatchLocation.copy()
 
 
+__mediaCheckState = {}
+
+def setMediaCheckState(stateFile):
+    '''stateFile records the images that have passed the media check, so
+    they are not checked again.  Put it on persistent storage, like the USB
+    stick being installed from, to remember them across reboots.'''
+    global __mediaCheckState
+    __mediaCheckState = locals()
+
+def getMediaCheckState():
+    return __mediaCheckState.copy()
+
+def clearMediaCheckState():
+    global __mediaCheckState
+    __mediaCheckState = {}
+
+
+__packageCache = {}
+
+def setPackageCache(packageCache, seedDirectory=None):
+    '''packageCache is a directory that downloaded packages are kept in,
+    under their digests, so later installs can reuse them.  seedDirectory
+    is an optional directory of RPMs to add to the cache before installing.
+    '''
+    global __packageCache
+    __packageCache = locals()
+
+def getPackageCache():
+    return __packageCache.copy()
+
+
 __rootPassword = {}
 
 ROOTPASSWORD_TYPE_CRYPT = 'crypt'
@@ -102,6 +102,17 @@ def getValueInMegabytesFromSectors(value, sectorSize=512):
 def getValueInKilobytesFromSectors(value, sectorSize=512):
     return (value / (SIZE_MB / sectorSize))
 
+def lcm(a, b):
+    '''Return the least common multiple of two positive integers.
+
+    >>> lcm(1024 * 1024, 768 * 1024)
+    3145728
+    '''
+    x, y = a, b
+    while y:
+        x, y = y, x % y
+    return a / x * b
+
 def truncateString(fullString, length):
     '''Truncate a string to a desired length if it's too long.
 
@@ -263,8 +274,12 @@ def execWithRedirect(command, argv, stdin=STDIN, stdout=STDOUT, stderr=STDERR,
 
 def execWithCapture(command, argv, searchPath=False, root='/', stdin=STDIN,
                     catchfdList=None, closefd=-1, returnStatus=False,
-                    timeoutInSecs=0, raiseException=False):
+                    timeoutInSecs=0, raiseException=False,
+                    outputCallback=None):
     '''This is borrowed from Anaconda
+
+    If outputCallback is given, it is called with each chunk of output as it
+    is read, so long running commands can report their progress.
     '''
 
     if catchfdList is None:
@@ -329,6 +344,8 @@ def execWithCapture(command, argv, searchPath=False, root='/', stdin=STDIN,
             raise
         s = os.read(read, 1000)
         rc = rc + s
+        if s and outputCallback:
+            outputCallback(s)
     os.close(read)
 
     status = -1
@@ -366,7 +383,7 @@ def execWithRedirectAndCapture(command, argv, catchfdList=(STDOUT,), root='/',
     return (output, status)
 
 def execWithLog(command, argv, root='/', level=logging.INFO,
-                timeoutInSecs=0, raiseException=False):
+                timeoutInSecs=0, raiseException=False, outputCallback=None):
     '''Execute the given command and log its output.'''
 
     cmdline = " ".join(argv)
@@ -376,7 +393,8 @@ def execWithLog(command, argv, root='/', level=logging.INFO,
                                        returnStatus=True,
                                        catchfdList=[STDOUT,STDERR],
                                        timeoutInSecs=timeoutInSecs,
-                                       raiseException=False)
+                                       raiseException=False,
+                                       outputCallback=outputCallback)
 
     log.debug("command exited with status %d" % status)
 
@@ -54,7 +54,9 @@ def parseArgsToUserChoices(argv):
         (opts, _args) = getopt.getopt(argv[1:], "htds:p:",
                           ['help', 'text', 'debug', 'nox', 'askmedia',
                            'noeject', 'mediacheck', 'script=', 'url=',
-                           'debugpatch=', 'videodriver='])
+                           'debugpatch=', 'videodriver=', 'pkgcache=',
+                           'pkgseed=', 'directread',
+                           'mediacheckfiles', 'mediacheckstate='])
     except getopt.error, e:
         sys.stderr.write("error: %s\n" % str(e))
         sys.exit(ExitCodes.WAIT_THEN_REBOOT)
@@ -74,6 +76,7 @@ def parseArgsToUserChoices(argv):
 
     log.debug('command line options: %s' % str(opts))
 
+    packageSeed = None
     for opt, arg in opts:
         if (opt == '-t' or opt == '--text'):
             userchoices.setRunMode(userchoices.RUNMODE_TEXT)
@@ -94,8 +97,21 @@ def parseArgsToUserChoices(argv):
             userchoices.setNoEject(True)
         elif (opt == '--mediacheck'):
             userchoices.setMediaCheck(True)
+        elif (opt == '--mediacheckfiles'):
+            userchoices.setMediaCheckFiles(True)
+        elif (opt == '--mediacheckstate'):
+            userchoices.setMediaCheckState(arg)
         elif (opt == '--videodriver'):
             userchoices.setVideoDriver(arg)
+        elif (opt == '--directread'):
+            userchoices.setDirectRead(True)
+        elif (opt == '--pkgcache'):
+            userchoices.setPackageCache(arg, packageSeed)
+        elif (opt == '--pkgseed'):
+            packageSeed = arg
+            cacheChoice = userchoices.getPackageCache()
+            if cacheChoice:
+                userchoices.setPackageCache(cacheChoice['packageCache'], arg)
         elif (opt == '--serial'):
             userchoices.setWeaselTTY('/dev/console')
             
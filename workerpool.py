@@ -0,0 +1,200 @@
+###############################################################################
+# Copyright (c) 2008-2009 VMware, Inc.
+#
+# This file is part of Weasel.
+#
+# Weasel is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation version 2 and no later version.
+#
+# Weasel is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# version 2 for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin St, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+'''
+workerpool
+
+A small, bounded pool of worker threads for overlapping slow I/O (network
+downloads, disk probes, mkfs runs) with other work.
+
+The rest of the installer is single-threaded, so the rule of thumb is that
+jobs submitted to a pool should only do I/O and return a value.  Anything
+that touches the UI, userchoices or task_progress should be done by the
+caller after it collects the result from the Job.
+
+>>> pool = WorkerPool(2)
+>>> job = pool.submit(lambda x, y: x + y, 1, 2)
+>>> job.result()
+3
+>>> pool.shutdown()
+>>> parallelMap(lambda x: x * 2, [1, 2, 3])
+[2, 4, 6]
+'''
+
+import sys
+import Queue
+import threading
+
+from log import log
+
+DEFAULT_WORKERS = 4
+
+_threadState = threading.local()
+
+def isWorkerThread():
+    '''Return True if the caller is running in a WorkerPool thread.  Code
+    that sets up global state on first use can check this to leave the setup
+    to the main thread.'''
+    return getattr(_threadState, 'inWorker', False)
+
+class JobCancelled(Exception):
+    '''Raised by Job.result() for a job that was cancelled before it ran.'''
+
+class Job(object):
+    '''A unit of work submitted to a WorkerPool.  The caller can block on the
+    job to finish and collect either its return value or the exception it
+    raised.'''
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self._finished = threading.Event()
+        self._result = None
+        self._excInfo = None
+        self._lock = threading.Lock()
+        self._started = False
+        self.cancelled = False
+
+    def run(self):
+        self._lock.acquire()
+        try:
+            if self.cancelled:
+                return
+            self._started = True
+        finally:
+            self._lock.release()
+
+        try:
+            self._result = self.func(*self.args, **self.kwargs)
+        except:
+            self._excInfo = sys.exc_info()
+        self._finished.set()
+
+    def cancel(self):
+        '''Keep the job from running if a worker has not picked it up yet.
+        Returns True if the job will not run.'''
+        self._lock.acquire()
+        try:
+            if self._started:
+                return False
+            self.cancelled = True
+        finally:
+            self._lock.release()
+        self._finished.set()
+        return True
+
+    def _getDone(self):
+        return self._finished.isSet()
+    done = property(_getDone)
+
+    def wait(self, timeout=None):
+        '''Wait for the job to finish.  Returns True if the job is done.'''
+        self._finished.wait(timeout)
+        return self._finished.isSet()
+
+    def result(self, timeout=None):
+        '''Wait for the job and return its result.  If the job raised an
+        exception, it is re-raised in the calling thread.'''
+        if not self.wait(timeout):
+            raise RuntimeError("job did not finish in %s seconds" % timeout)
+        if self.cancelled:
+            raise JobCancelled("job was cancelled")
+        if self._excInfo:
+            excType, excValue, excTraceback = self._excInfo
+            raise excType, excValue, excTraceback
+        return self._result
+
+
+class WorkerPool(object):
+    '''A fixed number of daemon threads pulling Jobs off of a queue.
+
+    The threads are daemonic so a worker stuck on a dead NFS server or
+    HTTP connection will not keep the installer from exiting.
+    '''
+
+    def __init__(self, numWorkers=DEFAULT_WORKERS, name='worker'):
+        assert numWorkers > 0, 'a pool needs at least one worker'
+
+        self.name = name
+        self._queue = Queue.Queue()
+        self._threads = []
+        for index in range(numWorkers):
+            thread = threading.Thread(target=self._workerLoop,
+                                      name='%s-%d' % (name, index))
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _workerLoop(self):
+        _threadState.inWorker = True
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            job.run()
+
+    def submit(self, func, *args, **kwargs):
+        '''Queue func(*args, **kwargs) to be run by a worker and return the
+        Job object that tracks it.'''
+        if not self._threads:
+            raise RuntimeError("worker pool %s has been shut down" % self.name)
+        job = Job(func, args, kwargs)
+        self._queue.put(job)
+        return job
+
+    def shutdown(self, wait=True):
+        '''Stop the workers after the jobs that have already been queued.'''
+        for _thread in self._threads:
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        log.debug("worker pool %s shut down" % self.name)
+        self._threads = []
+
+
+def parallelMap(func, items, numWorkers=DEFAULT_WORKERS, name='map'):
+    '''Like map(func, items), but the calls are spread over a WorkerPool.
+    The results are returned in the same order as the items.  If any of the
+    calls raised an exception, the first one (in item order) is re-raised
+    after all of the calls have finished.'''
+
+    items = list(items)
+    if not items:
+        return []
+
+    pool = WorkerPool(min(numWorkers, len(items)), name)
+    finished = False
+    try:
+        jobs = [pool.submit(func, item) for item in items]
+        for job in jobs:
+            job.wait()
+        finished = True
+    finally:
+        # Once every job is done the workers are idle and exit right away,
+        # so they are joined instead of being left to the interpreter.
+        pool.shutdown(wait=finished)
+
+    return [job.result() for job in jobs]
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()